@@ -0,0 +1,213 @@
+# bulk_reconcile.py
+"""Reconcile every payment of one or more companies over a date range.
+
+    python bulk_reconcile.py --company <company_id> --start 2024-01-01 --end 2024-01-31
+
+Payments are split per normalized buyer and per `--shard-days` window. Buyers
+run in parallel on a process pool; the windows of one buyer run in date order
+so an invoice matched in an earlier window is not matched again. Every finished
+shard is appended to a checkpoint file, and a rerun with the same arguments
+skips those shards. Matches are written in batches of `--write-batch` rows to
+BigQuery invoice_reconciliations, or appended to a .jsonl file with `--output`.
+Writes are idempotent: rows already present for the same invoice_number and
+external_id are skipped, so a batch written again after a crash, or already
+written back by the API, is not duplicated.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date, timedelta
+
+import pandas as pd
+
+from utils.multi_search import match_payments_and_invoices, normalize_buyer_name
+from utils.search import merge_reconciliations, reconciliation_rows, search_invoice_for_payments, search_payment
+
+class Checkpoint:
+    """Append-only JSONL record of finished shards and of the shards already written"""
+
+    def __init__(self, path):
+        self.path = path
+        self.shards = {}  # shard id -> {'matches': [...], 'consumed': [...]}
+        self.written = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # last line cut off by a crash
+                    if 'shard' in entry:
+                        self.shards[entry['shard']] = entry
+                    else:
+                        self.written.update(entry['written'])
+
+    def record(self, shard_id, matches, consumed):
+        entry = {'shard': shard_id, 'matches': matches, 'consumed': consumed}
+        self._append(entry)
+        self.shards[shard_id] = entry
+
+    def mark_written(self, shard_ids):
+        self._append({'written': shard_ids})
+        self.written.update(shard_ids)
+
+    def _append(self, entry):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+def date_windows(start, end, days):
+    """Inclusive [start, end] cut into consecutive windows of `days` days"""
+    windows = []
+    while start <= end:
+        window_end = min(start + timedelta(days=days - 1), end)
+        windows.append((start, window_end))
+        start = window_end + timedelta(days=1)
+    return windows
+
+def plan_shards(company_id, start, end, shard_days):
+    """Buyer chains of one company: {buyer key: [(shard id, payments), ...]} in date order"""
+    payments = search_payment(start.isoformat(), company_id)
+    payment_date = pd.to_datetime(payments['created_at'], utc=True, format='ISO8601').dt.date
+    payments = payments[payment_date <= end]
+    payment_date = payment_date[payments.index]
+
+    chains = {}
+    buyers = payments['buyer_name'].map(normalize_buyer_name)
+    for buyer, buyer_payments in payments.groupby(buyers, sort=True):
+        chain = []
+        for window_start, window_end in date_windows(start, end, shard_days):
+            in_window = payment_date[buyer_payments.index].between(window_start, window_end)
+            if in_window.any():
+                shard_id = f"{company_id}|{buyer}|{window_start}|{window_end}"
+                chain.append((shard_id, buyer_payments[in_window.values].reset_index(drop=True)))
+        chains[(company_id, buyer)] = chain
+    return chains
+
+def reconcile_shard(company_id, payments, consumed, max_combinations):
+    """Matches of one shard and the invoice numbers they use, skipping invoices of earlier shards"""
+    invoices = search_invoice_for_payments(company_id, payments)
+    if not invoices.empty:
+        invoices = invoices[~invoices['invoice_number'].astype(str).isin(consumed)].reset_index(drop=True)
+
+    result = match_payments_and_invoices(payments, invoices, max_combinations=max_combinations)
+    unmatched = {i['invoice_id'] for i in result['unmatched_invoices']}
+    used = [] if invoices.empty else [i for i in invoices['invoice_number'].astype(str) if i not in unmatched]
+    return result['matches'], used
+
+def match_key(row):
+    return json.dumps([row.get('invoice_number'), row.get('external_id')], default=str)
+
+def write_matches(rows, output):
+    """Write the rows not written yet, keyed by invoice_number and external_id"""
+    if output == 'bq':
+        merge_matches(reconciliation_rows(rows))
+        return
+
+    written = set()
+    if os.path.exists(output):
+        with open(output) as f:
+            for line in f:
+                try:
+                    written.add(match_key(json.loads(line)))
+                except ValueError:
+                    pass  # last line cut off by a crash
+    with open(output, 'a') as f:
+        for row in rows:
+            if match_key(row) not in written:
+                written.add(match_key(row))
+                f.write(json.dumps(row, default=str) + '\n')
+
+def merge_matches(rows):
+    """Load rows into a staging table, then MERGE the missing ones into invoice_reconciliations"""
+    if not rows:
+        return
+    # same rows, same staging table: a batch retried after a crash replaces its own staging copy
+    digest = hashlib.sha1(''.join(sorted(match_key(row) for row in rows)).encode()).hexdigest()[:16]
+    merge_reconciliations(rows, staging=f'invoice_reconciliations_bulk_{digest}')
+
+def run(companies, start, end, shard_days=7, workers=None, checkpoint_path=None, output='bq',
+        write_batch=5000, max_combinations=3):
+    checkpoint = Checkpoint(checkpoint_path)
+
+    chains = {}
+    for company_id in companies:
+        chains.update(plan_shards(company_id, start, end, shard_days))
+    total = sum(len(chain) for chain in chains.values())
+    print('shards:', total, 'done before:', sum(s in checkpoint.shards for c in chains.values() for s, _ in c))
+
+    # shards finished in an earlier run but never written
+    unwritten = [s for s in checkpoint.shards if s not in checkpoint.written]
+
+    def flush(force=False):
+        rows = [row for s in unwritten for row in checkpoint.shards[s]['matches']]
+        if unwritten and (force or len(rows) >= write_batch):
+            if rows:
+                write_matches(rows, output)
+            checkpoint.mark_written(list(unwritten))
+            print('written:', len(rows), 'matches from', len(unwritten), 'shards')
+            unwritten.clear()
+
+    # spawn, not fork: planning already opened pooled clients and started threads in this process
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        running = {}
+
+        def submit_next(key, consumed):
+            chain = chains[key]
+            while chain:
+                shard_id, payments = chain.pop(0)
+                if shard_id in checkpoint.shards:
+                    consumed = consumed | set(checkpoint.shards[shard_id]['consumed'])
+                    continue
+                future = pool.submit(reconcile_shard, key[0], payments, consumed, max_combinations)
+                running[future] = (key, shard_id, consumed)
+                return
+
+        for key in chains:
+            submit_next(key, frozenset())
+
+        done_count = 0
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                key, shard_id, consumed = running.pop(future)
+                matches, used = future.result()
+                checkpoint.record(shard_id, matches, used)
+                unwritten.append(shard_id)
+                done_count += 1
+                print('shard done:', shard_id, 'matches:', len(matches), f'({done_count} this run)')
+                submit_next(key, consumed | set(used))
+            flush()
+
+    flush(force=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reconcile whole companies over a payment date range")
+    parser.add_argument('--company', action='append', required=True, help="company_id, repeat for several companies")
+    parser.add_argument('--start', required=True, type=date.fromisoformat, help="first payment date, YYYY-MM-DD")
+    parser.add_argument('--end', required=True, type=date.fromisoformat, help="last payment date, YYYY-MM-DD")
+    parser.add_argument('--shard-days', type=int, default=7, help="payment days per shard")
+    parser.add_argument('--workers', type=int, default=None, help="processes, default the CPU count")
+    parser.add_argument('--checkpoint', default=None, help="checkpoint file, default checkpoints/<companies>_<start>_<end>.jsonl")
+    parser.add_argument('--output', default='bq', help="'bq' for invoice_reconciliations or a .jsonl path")
+    parser.add_argument('--write-batch', type=int, default=5000, help="matches per bulk write")
+    parser.add_argument('--max-combinations', type=int, default=3,
+                        help="largest multi match group; a block stops multi matching after MATCHER_MAX_MULTI_EVALUATED (default 1000000) combinations")
+    args = parser.parse_args(argv)
+
+    checkpoint_path = args.checkpoint
+    if checkpoint_path is None:
+        os.makedirs('checkpoints', exist_ok=True)
+        companies = '-'.join(sorted(args.company))
+        checkpoint_path = os.path.join('checkpoints', f"{companies}_{args.start}_{args.end}.jsonl")
+
+    run(args.company, args.start, args.end, shard_days=args.shard_days, workers=args.workers,
+        checkpoint_path=checkpoint_path, output=args.output, write_batch=args.write_batch,
+        max_combinations=args.max_combinations)
+
+if __name__ == '__main__':
+    main()
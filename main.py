@@ -1,10 +1,98 @@
 # main.py
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
 from typing import Optional, List
-from utils.search import search_data, search_datav2
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import json
+import os
+from utils.search import search_data, search_datav2, iter_search_datav2, RECONCILIATION_WRITER
+from utils.connections import get_connection_manager
+from utils.cache import CACHES
+from utils.jobs import JOB_MANAGER, JobQueueFull
+from utils import diagnostics as search_diagnostics
 
 app = FastAPI()
 
+# blocking reconciliations (BigQuery/MySQL/Arango pulls + matching) run here so
+# the event loop stays free to accept and answer other requests
+SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('SEARCH_REQUEST_WORKERS', 8)),
+                                     thread_name_prefix='search-request')
+
+# upper bound on ids in one /search/batch body
+SEARCH_BATCH_MAX_IDS = int(os.getenv('SEARCH_BATCH_MAX_IDS', 50000))
+
+class SearchBatch(BaseModel):
+    invoice_numbers: List[str] = []
+    external_ids: List[str] = []
+
+async def ndjson_stream(batches):
+    """One JSON line per result row, pulling each batch from the blocking generator on SEARCH_EXECUTOR"""
+    loop = asyncio.get_running_loop()
+    done = object()
+    try:
+        while True:
+            batch = await loop.run_in_executor(SEARCH_EXECUTOR, next, batches, done)
+            if batch is done:
+                break
+            for row in batch:
+                yield json.dumps(jsonable_encoder(row)) + "\n"
+    except Exception as e:
+        yield json.dumps({"status": "error", "detail": str(e)}) + "\n"
+
+async def run_search(response, invoice_numbers, external_ids, with_diagnostics):
+    """search_datav2 on SEARCH_EXECUTOR; phase timings go to the Server-Timing header and, if asked, the body"""
+    loop = asyncio.get_running_loop()
+    result, diagnostics = await loop.run_in_executor(
+        SEARCH_EXECUTOR, partial(search_diagnostics.collect, search_datav2,
+                                 list_invoice_number=invoice_numbers, list_external_id=external_ids)
+    )
+    response.headers["Server-Timing"] = diagnostics.server_timing()
+    return result, diagnostics.to_dict() if with_diagnostics else None
+
+def stream_search(invoice_numbers, external_ids):
+    return StreamingResponse(
+        ndjson_stream(iter_search_datav2(list_invoice_number=invoice_numbers, list_external_id=external_ids)),
+        media_type="application/x-ndjson"
+    )
+
+@app.on_event("startup")
+def open_connections():
+    """Warm up the pooled BigQuery/MySQL/ArangoDB clients for the lifetime of the app"""
+    get_connection_manager().start()
+    JOB_MANAGER.start()
+
+@app.on_event("shutdown")
+def close_connections():
+    SEARCH_EXECUTOR.shutdown(wait=False)
+    JOB_MANAGER.stop()
+    RECONCILIATION_WRITER.close()
+    get_connection_manager().close()
+
+@app.get("/health")
+def health():
+    """Run a health check against every backend pool"""
+    manager = get_connection_manager()
+    backends = manager.health()
+    return {
+        "status": "ok" if all(backends.values()) else "degraded",
+        "backends": backends,
+        "pools": manager.stats()
+    }
+
+@app.get("/pools")
+def pools():
+    """Pool usage per backend, for saturation monitoring"""
+    return get_connection_manager().stats()
+
+@app.get("/cache")
+def cache():
+    """Hit/miss counters per in-process cache"""
+    return {name: c.stats() for name, c in CACHES.items()}
+
 # @app.get("/search")
 # async def search(input_string: Optional[str] = Query(None, description="External IDs separated by comma, space, or semicolon")):
 #     """
@@ -36,8 +124,11 @@ app = FastAPI()
         
 @app.get("/search")    
 async def search(
+    response: Response,
     input_string: Optional[str] = Query(None, description="External IDs separated by comma, space, or semicolon"),
-    input_invoice: Optional[str] = Query(None, description="Invoice Numbers separated by comma, space, or semicolon")
+    input_invoice: Optional[str] = Query(None, description="Invoice Numbers separated by comma, space, or semicolon"),
+    stream: bool = Query(False, description="Stream result rows as NDJSON, each company as soon as it is matched"),
+    diagnostics: bool = Query(False, description="Add per-phase and per-company timings and counters to the response")
 ):
     """
     Search endpoint that accepts external IDs and invoice numbers as query parameters with separators (comma, space, semicolon)
@@ -58,15 +149,21 @@ async def search(
     external_ids = split_and_clean(input_string)
     invoice_numbers = split_and_clean(input_invoice)
 
-    # Call the search function
-    result = search_datav2(list_invoice_number=invoice_numbers, list_external_id=external_ids)
+    if stream:
+        return stream_search(invoice_numbers, external_ids)
+
+    # Call the search function off the event loop
+    result, timings = await run_search(response, invoice_numbers, external_ids, diagnostics)
         
     
-    return {
+    payload = {
         "status": "success",
         "external_ids": invoice_numbers,
         "results": result  # Your search results will go here
     }
+    if timings is not None:
+        payload["diagnostics"] = timings
+    return payload
 
     
     try:
@@ -92,3 +189,75 @@ async def search(
         }
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error processing input: {str(e)}")
+
+@app.post("/search/batch")
+async def search_batch(
+    body: SearchBatch,
+    response: Response,
+    stream: bool = Query(False, description="Stream result rows as NDJSON"),
+    diagnostics: bool = Query(False, description="Add per-phase and per-company timings and counters to the response")
+):
+    """
+    Search endpoint for large lists: invoice numbers and external IDs as a JSON body,
+    queried per backend in bounded chunks
+    """
+    invoice_numbers = list(dict.fromkeys(i.strip() for i in body.invoice_numbers if i.strip()))
+    external_ids = list(dict.fromkeys(i.strip() for i in body.external_ids if i.strip()))
+    if not invoice_numbers and not external_ids:
+        raise HTTPException(status_code=400, detail="Both invoice_numbers and external_ids cannot be empty")
+    if len(invoice_numbers) + len(external_ids) > SEARCH_BATCH_MAX_IDS:
+        raise HTTPException(status_code=413, detail=f"At most {SEARCH_BATCH_MAX_IDS} ids per request")
+
+    if stream:
+        return stream_search(invoice_numbers, external_ids)
+
+    result, timings = await run_search(response, invoice_numbers, external_ids, diagnostics)
+
+    payload = {
+        "status": "success",
+        "invoice_numbers": len(invoice_numbers),
+        "external_ids": len(external_ids),
+        "results": result
+    }
+    if timings is not None:
+        payload["diagnostics"] = timings
+    return payload
+
+@app.post("/reconcile/jobs", status_code=202)
+def create_reconcile_job(body: SearchBatch):
+    """
+    Queue a reconciliation that may run longer than a request; poll GET /reconcile/jobs/{job_id}
+    on the same instance, jobs are kept in that instance's local JOB_DB_PATH
+    """
+    invoice_numbers = list(dict.fromkeys(i.strip() for i in body.invoice_numbers if i.strip()))
+    external_ids = list(dict.fromkeys(i.strip() for i in body.external_ids if i.strip()))
+    if not invoice_numbers and not external_ids:
+        raise HTTPException(status_code=400, detail="Both invoice_numbers and external_ids cannot be empty")
+    if len(invoice_numbers) + len(external_ids) > SEARCH_BATCH_MAX_IDS:
+        raise HTTPException(status_code=413, detail=f"At most {SEARCH_BATCH_MAX_IDS} ids per request")
+
+    try:
+        job_id = JOB_MANAGER.submit(invoice_numbers, external_ids)
+    except JobQueueFull:
+        raise HTTPException(status_code=429, detail="Too many reconciliation jobs queued, retry later")
+
+    return {"job_id": job_id, "status": "queued"}
+
+@app.get("/reconcile/jobs/{job_id}")
+def get_reconcile_job(
+    job_id: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(1000, ge=1, le=10000)
+):
+    """
+    Status, per-company progress and a page of results of a reconciliation job
+    """
+    job = JOB_MANAGER.store.get(job_id, offset=offset, limit=limit)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/reconcile/jobs")
+def reconcile_jobs():
+    """Job queue usage"""
+    return JOB_MANAGER.stats()
@@ -0,0 +1,112 @@
+import random
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.multi_search import (ExactAmountIndex, Invoice, Payment, PaymentInvoiceMatcher,
+                                VectorizedPaymentInvoiceMatcher, to_minor_units)
+from utils.search import filter_amount_windows
+
+DAY = datetime(2024, 1, 1)
+
+def payment(amount, external_id='P', date=DAY):
+    return Payment(external_id, amount, date, 'c', 'B')
+
+def invoice(amount, invoice_id='I', date=DAY):
+    return Invoice(invoice_id, amount, date, date + timedelta(days=30), 'c', 'B', 30, '0')
+
+# amounts are compared in whole sen: the exact and +10K rules accept amounts that round to the same sen
+@pytest.mark.parametrize('payment_amount, invoice_amount, status', [
+    (100000.0, 100000.0, 'exactly match'),
+    (100000.004, 100000.0, 'exactly match'),
+    (99999.995, 100000.0, 'exactly match'),
+    (100000.006, 100000.0, 'match with difference: 0.005999999993946403 within tolerance 2000'),
+    (99999.994, 100000.0, 'match with difference: 0.005999999993946403 within tolerance 2000'),
+    (100000.004, 110000.0, 'match with add 10K'),
+    (100000.006, 110000.0, 'match with add 10K within tolerance 2000'),
+    (98000.0, 99979.6, 'exactly match with tax (2.02%)'),
+    (98000.0, 99979.604, 'exactly match with tax (2.02%)'),
+    (98000.0, 99979.606, 'match with difference: 1979.6059999999998 within tolerance 2000'),
+])
+def test_exact_rules_compare_whole_sen(payment_amount, invoice_amount, status):
+    match = PaymentInvoiceMatcher()._evaluate_match(payment(payment_amount), invoice(invoice_amount))
+    assert match.status == status
+
+    score = VectorizedPaymentInvoiceMatcher()._score_block(np.array([payment_amount]), np.array([invoice_amount]))
+    assert score[0, 0] == match.score
+
+def test_amounts_that_are_not_numbers_never_match():
+    assert to_minor_units(float('nan')) is None
+    assert PaymentInvoiceMatcher()._evaluate_match(payment(float('nan')), invoice(float('nan'))) is None
+
+def test_exact_probe_takes_the_first_unused_invoice_dated_before_the_payment():
+    invoices = [invoice(100.0, f'I{k}', DAY + timedelta(days=k)) for k in range(4)]
+    index = ExactAmountIndex(invoices)
+    # the used set only grows, as it does while matching
+    assert index.first_available(10000, DAY + timedelta(days=2), set()) == 0
+    assert index.first_available(10000, DAY + timedelta(days=2), {'I0', 'I2'}) == 1
+    assert index.first_available(10000, DAY + timedelta(days=2), {'I0', 'I1', 'I2'}) is None
+    assert index.first_available(10000, DAY + timedelta(days=9), {'I0', 'I1', 'I2'}) == 3
+    assert index.first_available(12345, DAY, set()) is None
+
+def test_exact_probe_on_a_bucket_out_of_date_order():
+    invoices = [invoice(100.0, 'I0', DAY + timedelta(days=5)), invoice(100.0, 'I1', DAY)]
+    assert ExactAmountIndex(invoices).first_available(10000, DAY, set()) == 1
+
+def test_one_amount_with_many_rows_stays_linear():
+    count = 20_000
+    invoices = [invoice(100000.0, f'I{k}', DAY + timedelta(minutes=k)) for k in range(count)]
+    payments = [payment(100000.0, f'P{k}', DAY + timedelta(minutes=k + 1)) for k in range(count)]
+
+    matcher = PaymentInvoiceMatcher()
+    start = time.perf_counter()
+    matcher.find_single_matches(payments, invoices)
+    assert time.perf_counter() - start < 3
+    assert [m['invoice_number'] for m in matcher.matches] == [f'I{k}' for k in range(count)]
+
+def inside(amount, windows):
+    return any(low <= amount <= high for low, high in windows)
+
+@pytest.mark.parametrize('seed', range(20))
+def test_amount_windows_keep_every_matched_payment(seed):
+    rng = random.Random(seed)
+    invoices = [invoice(float(rng.choice([100000, 250000, 1000000]) + rng.choice([0, 1500, -3000, 10000])), f'I{k}')
+                for k in range(rng.randrange(8, 20))]
+    totals = [i.amount for i in invoices]
+    # single matches, parts, whole and taxed groups of the invoices, and payments nothing matches
+    amounts = []
+    for _ in range(20):
+        total = rng.choice(totals)
+        group = total + rng.choice(totals)
+        amounts.append(rng.choice([total / 2, total / 3, total / 2, group, group / 1.0202, group + 3000,
+                                   total, total / 1.0202, total - 10000, 5000000.0]))
+    payments = [payment(round(amount, 2), f'P{k}') for k, amount in enumerate(amounts)]
+
+    matcher = PaymentInvoiceMatcher()
+    windows = matcher.payment_amount_windows([i.amount for i in invoices])
+    matcher.find_matches(payments, invoices)
+    amounts = {p.external_id: p.amount for p in payments}
+    assert matcher.matches
+    for match in matcher.matches:
+        external_ids = match['external_id'] if isinstance(match['external_id'], list) else [match['external_id']]
+        assert all(inside(amounts[external_id], windows) for external_id in external_ids)
+
+def test_amount_windows_keep_negative_payments_and_drop_what_no_group_reaches():
+    windows = PaymentInvoiceMatcher().payment_amount_windows([100000.0, 250000.0])
+    assert inside(-50000.0, windows)
+    assert inside(250000.0 + 4000, windows)           # part of a multi payment, or a single match
+    assert inside(350000.0, windows)                  # both invoices
+    assert inside(350000.0 / 1.0202, windows)         # both invoices with tax
+    assert not inside(700000.0, windows)              # above every group of these invoices
+    assert not inside(420000.0, windows)
+
+    frame = pd.DataFrame({'amount.grand_total': [-50000.0, 350000.0, 420000.0, 700000.0]})
+    assert filter_amount_windows(frame, windows)['amount.grand_total'].tolist() == [-50000.0, 350000.0]
+
+def test_amount_windows_without_multi_matching_are_the_single_windows():
+    windows = PaymentInvoiceMatcher(max_combinations=1).payment_amount_windows([100000.0])
+    assert inside(100000.0, windows) and inside(90000.0, windows) and inside(100000.0 / 1.0202, windows)
+    assert not inside(50000.0, windows) and not inside(-1.0, windows)
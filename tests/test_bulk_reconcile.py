@@ -0,0 +1,68 @@
+import json
+from contextlib import contextmanager
+from unittest import mock
+
+import pytest
+
+import bulk_reconcile
+from utils import search
+
+MATCHES = [
+    {'type': 'single_match', 'company_id': 'c', 'buyer_name': 'B', 'external_id': 'E1', 'invoice_number': 'I1',
+     'payment_amount': 100.0, 'invoice_amount': 100.0, 'status': 'exactly match'},
+    {'type': 'multi_invoice', 'company_id': 'c', 'buyer_name': 'B', 'external_id': 'E2',
+     'invoice_number': ['I2', 'I3'], 'payment_amount': 300.0, 'invoice_amount': 300.0},
+]
+
+@pytest.fixture
+def bq(monkeypatch):
+    client = mock.MagicMock()
+
+    @contextmanager
+    def bq_client():
+        yield client
+
+    monkeypatch.setattr(search, 'bq_client', bq_client)
+    return client
+
+def statements(client):
+    """(kind, detail) of every BigQuery call, in order"""
+    calls = []
+    for name, args, _ in client.mock_calls:
+        if name == 'to_push_data':
+            calls.append(('load', args[2]))
+        elif name == 'initialize_client().query':
+            calls.append(('query', args[0].split()[0]))
+        elif name == 'initialize_client().query().result':
+            calls.append(('wait', None))
+    return calls
+
+def test_merge_matches_loads_staging_then_merges_then_drops(bq):
+    bulk_reconcile.write_matches(MATCHES, 'bq')
+
+    calls = statements(bq)
+    staging = calls[0][1]
+    assert staging.startswith('invoice_reconciliations_bulk_')
+    assert calls == [('load', staging), ('query', 'MERGE'), ('wait', None), ('query', 'DROP'), ('wait', None)]
+
+    pushed = bq.to_push_data.call_args[0][0]
+    assert list(pushed.columns) == search.RECONCILIATION_COLUMNS
+    assert pushed['external_id'].tolist() == ['E1']
+    merge = bq.initialize_client().query.call_args_list[0][0][0]
+    assert f'datascience_public.{staging}' in merge and 'WHEN NOT MATCHED THEN INSERT' in merge
+
+def test_staging_is_dropped_when_merge_fails(bq):
+    bq.initialize_client().query().result.side_effect = [RuntimeError('merge failed'), None]
+    bq.reset_mock()
+    with pytest.raises(RuntimeError):
+        bulk_reconcile.write_matches(MATCHES, 'bq')
+    assert [kind for kind, _ in statements(bq)] == ['load', 'query', 'wait', 'query', 'wait']
+
+def test_jsonl_output_skips_rows_already_written(tmp_path):
+    output = str(tmp_path / 'matches.jsonl')
+    bulk_reconcile.write_matches(MATCHES, output)
+    bulk_reconcile.write_matches(MATCHES + [dict(MATCHES[0], external_id='E9')], output)
+
+    with open(output) as f:
+        written = [json.loads(line) for line in f]
+    assert [row['external_id'] for row in written] == ['E1', 'E2', 'E9']
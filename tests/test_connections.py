@@ -0,0 +1,45 @@
+import threading
+
+from utils.connections import ClientPool, background_work
+
+def test_background_checkouts_leave_reserved_clients():
+    pool = ClientPool('test', object, lambda client: None, size=4, reserved=2)
+    held = threading.Event()
+    release = threading.Event()
+    blocked = []
+
+    def background_query():
+        with background_work(), pool.client():
+            held.set()
+            release.wait(5)
+
+    threads = [threading.Thread(target=background_query) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    held.wait(5)
+
+    # a third background checkout waits for a slot, interactive ones still get the reserved clients
+    third = threading.Thread(target=lambda: blocked.append(pool.background_slots.acquire(timeout=0.2)))
+    third.start()
+    third.join()
+    with pool.client(), pool.client():
+        assert pool.stats()['in_use'] == 4
+        assert pool.stats()['background_in_use'] == 2
+
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert blocked == [False]
+    assert pool.stats()['background_in_use'] == 0
+
+def test_reserved_never_takes_the_whole_pool():
+    pool = ClientPool('test', object, lambda client: None, size=1, reserved=2)
+    with background_work(), pool.client():
+        assert pool.stats()['in_use'] == 1
+
+def test_clients_returned_after_close_are_dropped():
+    pool = ClientPool('test', object, lambda client: None, size=2)
+    with pool.client():
+        pool.close()
+    assert pool.stats()['idle'] == 0
+    assert pool.stats()['created'] == 0
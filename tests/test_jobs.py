@@ -0,0 +1,29 @@
+import time
+
+from utils import jobs
+from utils.connections import in_background_work
+
+def test_failing_company_fails_the_job_and_its_running_siblings(tmp_path, monkeypatch):
+    def companies(list_invoice_number, list_external_id, executor=None):
+        assert in_background_work()
+        yield 'cached', None, []
+        yield 'companies', None, [('invoice', 'c1'), ('invoice', 'c2'), ('invoice', 'c3')]
+        yield 'company', ('invoice', 'c1'), [{'invoice_number': 'I1'}]
+        raise RuntimeError('mysql down')
+
+    monkeypatch.setattr(jobs, 'iter_search_companies', companies)
+    store = jobs.JobStore(str(tmp_path / 'jobs.sqlite3'))
+    manager = jobs.JobManager(store, workers=1, queue_size=2, company_workers=1, retention=3600)
+    manager.start()
+    job_id = manager.submit(['I1'], [])
+
+    for _ in range(100):
+        job = store.get(job_id)
+        if job['status'] not in ('queued', 'running'):
+            break
+        time.sleep(0.05)
+    manager.stop()
+
+    assert job['status'] == 'failed'
+    assert job['error'] == 'mysql down'
+    assert [c['status'] for c in job['progress']['per_company']] == ['done', 'failed', 'failed']
@@ -0,0 +1,210 @@
+import copy
+import itertools
+import random
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
+import pytest
+
+from utils import multi_search
+from utils.multi_search import (Invoice, Payment, PaymentInvoiceMatcher, VectorizedPaymentInvoiceMatcher,
+                                find_matches_by_buyer, normalize_buyer_name, partition_buyer_blocks)
+
+BUYERS = ['PT Alpha', 'Alpha', 'CV Beta', 'Gamma', 'Alpha Jaya', 'Sinar', 'Sinar Abadi', 'Sinar Jaya']
+
+def related(buyer, partner):
+    return buyer == partner or bool(partner) and (buyer in partner or partner in buyer)
+
+def buyer_groups(payments, invoices):
+    """{normalized name: group label}, labels joined while a related payment and invoice name differ"""
+    buyers = {normalize_buyer_name(p.buyer_name) for p in payments}
+    partners = {normalize_buyer_name(i.buyer_name) for i in invoices}
+    label = {name: name for name in buyers | partners}
+    changed = True
+    while changed:
+        changed = False
+        for buyer, partner in itertools.product(buyers, partners):
+            if related(buyer, partner) and label[buyer] != label[partner]:
+                old, new = max(label[buyer], label[partner]), min(label[buyer], label[partner])
+                label = {name: new if group == old else group for name, group in label.items()}
+                changed = True
+    return label
+
+class FullScanMatcher(PaymentInvoiceMatcher):
+    """The matcher before the indexes: every pair and every combination is scored.
+
+    With `groups` only payments and invoices whose normalized names are in the
+    same group are paired, which is what partitioning by buyer does.
+    """
+
+    def __init__(self, max_combinations=3, groups=None):
+        super().__init__(max_combinations=max_combinations)
+        self.groups = groups
+
+    def _pairs(self, payment, invoice):
+        return self.groups is None or \
+            self.groups[normalize_buyer_name(payment.buyer_name)] == self.groups[normalize_buyer_name(invoice.buyer_name)]
+
+    def find_single_matches(self, payments, invoices):
+        for payment in payments:
+            if payment.external_id in self.used_payments:
+                continue
+            best, best_score = None, -float('inf')
+            for invoice in invoices:
+                if invoice.invoice_id in self.used_invoices or payment.date < invoice.date or not self._pairs(payment, invoice):
+                    continue
+                match = self._evaluate_match(payment, invoice)
+                if match and match.score > best_score:
+                    best, best_score = match, match.score
+            if best:
+                self._add_match(best)
+
+    def find_multi_payment_matches(self, payments, invoices, max_combinations=None):
+        for invoice in invoices:
+            if invoice.invoice_id in self.used_invoices:
+                continue
+            valid = [p for p in payments
+                     if p.external_id not in self.used_payments and p.date >= invoice.date and self._pairs(p, invoice)]
+            best, best_score = None, -float('inf')
+            for n in range(2, self.MAX_COMBINATIONS + 1):
+                for combo in itertools.combinations(valid, n):
+                    match = self._evaluate_multi_payment_match(combo, invoice, sum(p.amount for p in combo))
+                    if match and match.score > best_score:
+                        best, best_score = match, match.score
+            if best:
+                self._add_multi_payment_match(best)
+
+    def find_multi_invoice_matches(self, payments, invoices, max_combinations=None):
+        for payment in payments:
+            if payment.external_id in self.used_payments:
+                continue
+            valid = [i for i in invoices
+                     if i.invoice_id not in self.used_invoices and payment.date >= i.date and self._pairs(payment, i)]
+            best, best_score = None, -float('inf')
+            for n in range(2, self.MAX_COMBINATIONS + 1):
+                for combo in itertools.combinations(valid, n):
+                    match = self._evaluate_multi_invoice_match(payment, combo, sum(i.amount for i in combo))
+                    if match and match.score > best_score:
+                        best, best_score = match, match.score
+            if best:
+                self._add_multi_invoice_match(best)
+
+def generate(seed, payments, invoices, buyers=1):
+    """Payments and invoices around a few shared amounts, including tax, +10K and sub-rupiah amounts"""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    amounts = [rng.choice([100000, 250000, 500000, 1000000, 1234567, 75000]) for _ in range(10)]
+
+    invoice_rows = []
+    for k in range(invoices):
+        amount = rng.choice(amounts) + rng.choice([0, 0, 0, 1500, -3000, 4999, 10000, -7000, 20000])
+        if rng.random() < 0.1:
+            amount = round(rng.choice(amounts) * 1.0202, 2)
+        invoice_date = start + timedelta(days=rng.randint(0, 60))
+        invoice_rows.append(Invoice(f'INV{k}', float(amount), invoice_date, invoice_date + timedelta(days=30),
+                                    'c', rng.choice(BUYERS[:buyers]), 30, '0'))
+
+    payment_rows = []
+    for k in range(payments):
+        amount = rng.choice(amounts) + rng.choice([0, 0, 2000, -2500, 10000, 6000, -10000])
+        if rng.random() < 0.1:
+            amount = invoice_rows[rng.randrange(invoices)].amount / 1.0202
+        if rng.random() < 0.1:
+            amount = round(amount + rng.choice([0.004, 0.01, 0.3, 0.5]), 3)
+        payment_rows.append(Payment(f'P{k}', float(amount), start + timedelta(days=rng.randint(0, 90)), 'c',
+                                    rng.choice(BUYERS[:buyers])))
+    return payment_rows, invoice_rows
+
+def installments(seed, count, noise=0):
+    """One buyer paying invoices in two to four parts, so most groups of payments are in range"""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    invoices = []
+    for k in range(count):
+        invoice_date = start + timedelta(days=rng.randint(0, 60))
+        invoices.append(Invoice(f'I{k}', float(rng.choice([300000, 450000, 600000, 900000])), invoice_date,
+                                invoice_date + timedelta(days=30), 'c', 'B', 30, '0'))
+    payments = [Payment(f'P{k}', float(rng.choice([100000, 150000, 200000, 299999]) + rng.randint(-noise, noise)),
+                        start + timedelta(days=rng.randint(0, 90)), 'c', 'B') for k in range(count)]
+    return payments, invoices
+
+def matches(matcher, payments, invoices):
+    matcher.find_matches(copy.deepcopy(payments), copy.deepcopy(invoices))
+    return matcher.matches
+
+@pytest.mark.parametrize('max_combinations, size', [(3, 24), (4, 14)])
+@pytest.mark.parametrize('seed', range(40))
+def test_engines_match_the_full_scan(seed, max_combinations, size):
+    payments, invoices = generate(seed, size, size)
+    expected = matches(FullScanMatcher(max_combinations), payments, invoices)
+    assert matches(PaymentInvoiceMatcher(max_combinations), payments, invoices) == expected
+    assert matches(VectorizedPaymentInvoiceMatcher(max_combinations), payments, invoices) == expected
+
+@pytest.mark.parametrize('max_combinations', [3, 4])
+@pytest.mark.parametrize('noise', [0, 1500])
+@pytest.mark.parametrize('seed', range(20))
+def test_repeated_amounts_match_the_full_scan(seed, noise, max_combinations):
+    payments, invoices = installments(seed, 16, noise=noise)
+    expected = matches(FullScanMatcher(max_combinations), payments, invoices)
+    assert matches(PaymentInvoiceMatcher(max_combinations), payments, invoices) == expected
+
+@pytest.mark.parametrize('engine', ['index', 'vector'])
+@pytest.mark.parametrize('seed', range(30))
+def test_partitioned_match_equals_full_scan_within_buyers(seed, engine):
+    payments, invoices = generate(seed, 30, 30, buyers=len(BUYERS))
+    expected = matches(FullScanMatcher(3, groups=buyer_groups(payments, invoices)), payments, invoices)
+    found = find_matches_by_buyer(copy.deepcopy(payments), copy.deepcopy(invoices), max_combinations=3,
+                                  engine=engine, workers=1)[0]
+    assert found == expected
+
+@pytest.mark.parametrize('max_combinations', [3, 4])
+def test_multi_phases_stay_fast_with_hundreds_of_rows_per_buyer(max_combinations):
+    payments, invoices = installments(0, 400)
+    matcher = PaymentInvoiceMatcher(max_combinations)
+    start = time.perf_counter()
+    matcher.find_matches(payments, invoices)
+    assert time.perf_counter() - start < 5
+    assert matcher.phase_stats['multi_payment']['matches'] > 50
+    assert matcher.phase_stats['multi_payment']['capped'] == 0
+
+def test_multi_phases_stop_at_the_combination_cap(capsys):
+    payments, invoices = installments(0, 60, noise=1500)
+    matcher = PaymentInvoiceMatcher(3, max_multi_evaluated=500)
+    matcher.find_matches(payments, invoices)
+
+    assert matcher.multi_evaluated == 500
+    assert matcher.phase_stats['multi_payment']['capped'] == 1
+    assert matcher.phase_stats['multi_invoice']['evaluated'] == 0
+    assert capsys.readouterr().out.count('multi match cap reached') == 1
+
+def test_buyer_blocks_join_names_that_contain_one_another():
+    day = datetime(2024, 1, 1)
+    payments = [Payment(f'P{k}', 100.0, day, 'c', name) for k, name in enumerate(['Sinar', 'Beta', 'Gamma', ''])]
+    invoices = [Invoice(f'I{k}', 100.0, day, day, 'c', name, 0, '0')
+                for k, name in enumerate(['PT Sinar Jaya', 'Sinar Abadi', 'CV Beta', 'Delta', ''])]
+
+    blocks = partition_buyer_blocks(payments[:3], invoices)
+    assert sorted(blocks) == [([0], [0, 1]), ([1], [2])]
+    # a payment without a buyer name is related to every named invoice, as in /search
+    assert partition_buyer_blocks(payments, invoices) == [([0, 1, 3], [0, 1, 2, 3, 4])]
+
+def test_only_large_blocks_go_to_the_pool(monkeypatch):
+    submitted = []
+
+    class Pool:
+        def submit(self, fn, *args):
+            submitted.append(len(args[0]) * len(args[1]))
+            future = Future()
+            future.set_result(fn(*args))
+            return future
+
+    monkeypatch.setattr(multi_search, 'get_matcher_pool', lambda workers, name: Pool())
+    monkeypatch.setattr(multi_search, 'POOL_MIN_BLOCK_PAIRS', 100)
+    payments, invoices = generate(0, 30, 30, buyers=len(BUYERS))
+    found = find_matches_by_buyer(copy.deepcopy(payments), copy.deepcopy(invoices), workers=4)[0]
+
+    sizes = [len(p) * len(i) for p, i in partition_buyer_blocks(payments, invoices)]
+    assert sorted(submitted) == sorted(size for size in sizes if size >= 100)
+    assert 0 < len(submitted) < len(sizes)
+    assert found == find_matches_by_buyer(copy.deepcopy(payments), copy.deepcopy(invoices), workers=1)[0]
@@ -0,0 +1,88 @@
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from utils.multi_search import (Invoice, OptimalPaymentInvoiceMatcher, Payment, PaymentInvoiceMatcher,
+                                max_weight_assignment)
+
+def brute_force_weight(weights):
+    """Weight of the best matching, trying every partial matching"""
+    rows, columns = weights.shape
+    def best(row, used):
+        if row == rows:
+            return 0.0
+        options = [best(row + 1, used)]
+        for column in range(columns):
+            if column not in used and weights[row, column] > 0:
+                options.append(weights[row, column] + best(row + 1, used | {column}))
+        return max(options)
+    return best(0, frozenset())
+
+def generate(seed, payments=80, invoices=80):
+    """Payments and invoices of one buyer with amounts close enough to compete"""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    amounts = [rng.choice([100000, 250000, 500000, 1000000, 1234567, 75000]) for _ in range(10)]
+
+    invoice_rows = []
+    for k in range(invoices):
+        amount = rng.choice(amounts) + rng.choice([0, 0, 0, 1500, -3000, 4999, 10000, -7000, 20000])
+        if rng.random() < 0.1:
+            amount = round(rng.choice(amounts) * 1.0202, 2)
+        invoice_date = start + timedelta(days=rng.randint(0, 60))
+        invoice_rows.append(Invoice(f'INV{k}', float(amount), invoice_date, invoice_date + timedelta(days=30),
+                                    'c', 'B', 30, '0'))
+
+    payment_rows = []
+    for k in range(payments):
+        amount = rng.choice(amounts) + rng.choice([0, 0, 2000, -2500, 10000, 6000, -10000])
+        if rng.random() < 0.1:
+            amount = invoice_rows[rng.randrange(invoices)].amount / 1.0202
+        payment_rows.append(Payment(f'P{k}', float(amount), start + timedelta(days=rng.randint(0, 90)), 'c', 'B'))
+    return payment_rows, invoice_rows
+
+@pytest.mark.parametrize('seed', range(200))
+def test_max_weight_assignment_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    rows, columns = rng.integers(1, 6, 2)
+    weights = np.where(rng.random((rows, columns)) < 0.5, rng.integers(1, 100, (rows, columns)).astype(float), 0.0)
+
+    pairs = max_weight_assignment(weights)
+    assert len({row for row, _ in pairs}) == len(pairs) == len({column for _, column in pairs})
+    assert all(weights[row, column] > 0 for row, column in pairs)
+    assert sum(weights[row, column] for row, column in pairs) == pytest.approx(brute_force_weight(weights))
+
+@pytest.mark.parametrize('seed', range(40))
+def test_optimal_matcher_never_scores_below_greedy(seed):
+    payments, invoices = generate(seed)
+    greedy = PaymentInvoiceMatcher()
+    greedy.find_matches(payments, invoices)
+    optimal = OptimalPaymentInvoiceMatcher()
+    optimal.find_matches(payments, invoices)
+    stats = optimal.assignment_stats
+
+    greedy_singles = [m for m in greedy.matches if m['type'] == 'single_match']
+    assert stats['greedy_single_matches'] == len(greedy_singles)
+    assert stats['greedy_score'] == pytest.approx(sum(m['score'] for m in greedy_singles))
+
+    singles = [m for m in optimal.matches if m['type'] == 'single_match']
+    assert len({m['invoice_number'] for m in singles}) == len(singles)
+    assert len({m['external_id'] for m in singles}) == len(singles)
+    assert stats['single_matches'] == len(singles)
+
+    offset = OptimalPaymentInvoiceMatcher.ASSIGNMENT_OFFSET
+    assert stats['score'] + stats['single_matches'] * offset \
+        >= stats['greedy_score'] + stats['greedy_single_matches'] * offset - 1e-6
+
+def test_large_components_keep_the_greedy_choice():
+    payments, invoices = generate(3)
+    greedy = PaymentInvoiceMatcher()
+    greedy.find_matches(payments, invoices)
+    optimal = OptimalPaymentInvoiceMatcher(max_component=1)
+    optimal.find_matches(payments, invoices)
+
+    assert optimal.assignment_stats['solved_components'] == 0
+    assert optimal.assignment_stats['differs_from_greedy'] == 0
+    assert optimal.matches == greedy.matches
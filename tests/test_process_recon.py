@@ -0,0 +1,116 @@
+import random
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from utils.names import normalize_name
+from utils.search import process_recon
+
+NAMES = ['PT Alpha', 'Alpha', 'CV Beta', 'Beta Jaya', 'Gamma', 'PT. Gamma Tbk']
+
+def names_match(buyer_name, name):
+    """Normalized names contain one another; invoices without a name never match"""
+    buyer, partner = normalize_name(buyer_name), normalize_name(name)
+    return bool(partner) and (buyer in partner or partner in buyer)
+
+def scan_recon(prt, data_invoice):
+    """The original process_recon: a filter over the whole invoice frame and the tolerance loop per payment"""
+    found = []
+    remarks = []
+    for _, i in prt.iterrows():
+        amount = i['amount.grand_total']
+        with_wht = i['amount.grand_total'] * 1.0202
+        buyer_name = i['buyer_name']
+        payment_date = datetime.strptime(i['created_at'].split('T')[0], '%Y-%m-%d').date()
+
+        invoices = data_invoice[(data_invoice['invoice_date'] <= payment_date)
+                                & (~data_invoice['invoice_number'].isin(remarks))
+                                & (data_invoice['name'].transform(lambda s: names_match(buyer_name, s)))
+                                & (data_invoice['company_id'] == i['company_id'])]
+        status = ''
+        for _, j in invoices.iterrows():
+            invoice_number = j['invoice_number']
+            invoice_date = j['invoice_date']
+            grand_total = j['grandTotalUnformatted']
+            top = j['top']
+            ontime = 1 if (payment_date - invoice_date).days <= top else 0
+
+            status = None
+            for tolerance in [2_000, 5_000]:
+                if grand_total == amount:
+                    status = "exactly match"
+                elif grand_total == with_wht:
+                    status = "exactly match with wht"
+                elif abs(grand_total - amount) <= tolerance:
+                    status = f"match with difference: {abs(grand_total - amount)}"
+                elif abs(grand_total - with_wht) <= tolerance:
+                    status = f"include wht match with difference: {abs(grand_total - with_wht)} "
+                elif grand_total == amount + 10_000:
+                    status = "match with add 10K"
+                elif grand_total == with_wht + 10_000:
+                    status = "match with wht and add 10K"
+                elif abs(grand_total - (amount + 10_000)) <= tolerance:
+                    status = f"match with add 10K, with difference: {abs(grand_total - amount)}"
+                elif abs(grand_total - (with_wht + 10_000)) <= tolerance:
+                    status = f"include wht and add 10K, with difference: {abs(grand_total - with_wht)} "
+                if status:
+                    break
+            if status:
+                break
+
+        row = {'company_id': i['company_id'], 'buyer_name': buyer_name, 'top': None, 'ontime': None,
+               'payment_date': payment_date.strftime('%Y-%m-%d'), 'invoice_date': None,
+               'external_id': i['external_id'], 'invoice_number': None, 'payment_amount': amount,
+               'payment_amount_wht': with_wht, 'invoice_amount': None, 'status': 'not found'}
+        if status:
+            row.update({'top': top, 'ontime': ontime, 'invoice_date': invoice_date.strftime('%Y-%m-%d'),
+                        'invoice_number': invoice_number, 'invoice_amount': grand_total, 'status': status})
+            remarks.append(invoice_number)
+        found.append(row)
+    return found
+
+def generate(seed, payments, invoices):
+    """Payments and invoices hitting every recon_status rule, with repeated invoice numbers"""
+    rng = random.Random(seed)
+    bases = [rng.choice([100000, 250000, 1000000, 1234567.0, 99999.5]) for _ in range(8)]
+
+    rows = []
+    for _ in range(invoices):
+        base = rng.choice(bases)
+        total = rng.choice([
+            base,
+            round(base * 1.0202, 2),
+            base + rng.choice([-5001, -5000, -2000, -1999, 1500, 4999, 5000, 5000.5]),
+            base + 10000,
+            base * 1.0202 + 10000 + rng.choice([0, -3000, 4000]),
+            base + rng.randrange(-20000, 20000),
+        ])
+        invoice_date = date(2024, 1, 1) + timedelta(days=rng.randrange(40))
+        rows.append({'name': rng.choice(NAMES), 'invoice_number': f'I{rng.randrange(invoices * 3 // 4 + 1)}',
+                     'invoice_date': invoice_date, 'deleted_at': None,
+                     'due_date': invoice_date + timedelta(days=rng.choice([0, 7, 30])), 'invoice_status': 0,
+                     'company_id': rng.choice(['c1', 'c2']), 'document_type_id': 1,
+                     'grandTotalUnformatted': float(total)})
+    data_invoice = pd.DataFrame(rows)
+    data_invoice['top'] = [(row['due_date'] - row['invoice_date']).days for row in rows]
+
+    prt = pd.DataFrame([{
+        'created_at': (datetime(2024, 1, 1) + timedelta(days=rng.randrange(45), hours=3)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+        'updated_at': None, 'company_id': rng.choice(['c1', 'c2']), 'external_id': f'E{k}',
+        'buyer_name': rng.choice(NAMES + ['PT Delta']), 'supplier_name': 'S', 'status': 'paid',
+        'amount.buyer_fee_amount': 0, 'amount.cashback_amount': 0, 'amount.discount_amount': 0,
+        'amount.grand_total': float(rng.choice(bases)), 'amount.sub_total': 0, 'amount.supplier_fee_amount': 0,
+    } for k in range(payments)])
+    return prt, data_invoice
+
+@pytest.mark.parametrize('seed', range(60))
+def test_process_recon_matches_full_scan(seed):
+    rng = random.Random(seed)
+    prt, data_invoice = generate(seed, rng.randrange(1, 40), rng.randrange(1, 60))
+    assert repr(process_recon(prt, data_invoice)) == repr(scan_recon(prt, data_invoice))
+
+def test_process_recon_without_invoices():
+    prt, data_invoice = generate(0, 5, 1)
+    found = process_recon(prt, data_invoice.iloc[:0])
+    assert [row['status'] for row in found] == ['not found'] * 5
@@ -0,0 +1,61 @@
+from utils.writeback import ReconciliationWriter
+
+def rows(count):
+    return [{'invoice_number': f'I{k}', 'external_id': f'E{k}'} for k in range(count)]
+
+class Backend:
+    def __init__(self, bad=(), down=False):
+        self.bad = set(bad)
+        self.down = down
+        self.written = []
+
+    def push(self, batch):
+        if self.down or any(row['invoice_number'] in self.bad for row in batch):
+            raise RuntimeError('push failed')
+        self.written.extend(batch)
+
+def test_outage_keeps_rows_buffered_without_counting_attempts(tmp_path):
+    backend = Backend(down=True)
+    writer = ReconciliationWriter(backend.push, max_attempts=5, dead_letter=str(tmp_path / 'dead.jsonl'))
+    writer.add(rows(100))
+    for _ in range(20):
+        assert writer.flush() == 0
+
+    stats = writer.stats()
+    assert stats['buffered'] == 100
+    assert stats['dead_lettered'] == 0
+    assert stats['retrying'] == 0
+    assert stats['outages'] == 20
+    assert stats['backoff_seconds'] == writer.max_backoff
+
+    backend.down = False
+    assert writer.flush() == 100
+    assert writer.stats()['backoff_seconds'] == 0.0
+
+def test_row_failing_on_its_own_is_dead_lettered(tmp_path):
+    backend = Backend(bad={'I7'})
+    dead_letter = tmp_path / 'dead.jsonl'
+    writer = ReconciliationWriter(backend.push, max_attempts=3, dead_letter=str(dead_letter))
+    writer.add(rows(20))
+
+    assert writer.flush() == 19
+    writer.add(rows(21)[20:])  # a second row, so the bad one is narrowed down again
+    assert writer.flush() == 1
+    writer.add(rows(22)[21:])
+    assert writer.flush() == 1
+
+    stats = writer.stats()
+    assert stats['dead_lettered'] == 1
+    assert stats['buffered'] == 0
+    assert stats['outages'] == 0
+    assert 'I7' in dead_letter.read_text()
+    assert len(backend.written) == 21
+
+def test_duplicates_are_not_buffered_again():
+    backend = Backend()
+    writer = ReconciliationWriter(backend.push)
+    writer.add(rows(5))
+    writer.flush()
+    writer.add(rows(5))
+    assert writer.stats()['duplicates'] == 5
+    assert writer.flush() == 0
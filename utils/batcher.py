@@ -0,0 +1,84 @@
+import threading
+from concurrent.futures import Future
+
+from .cache import CACHES
+
+class _Batch:
+    def __init__(self):
+        self.keys = {}  # ordered set of lookup keys
+        self.future = Future()
+        self.closed = threading.Event()
+
+class LookupBatcher:
+    """Merges ID lookups from concurrent requests into one backend query.
+
+    The first caller of a batch waits `window` seconds (less if the batch
+    reaches `max_keys`) for other callers to add their keys, then runs
+    `fetch(keys)` once for all of them. Every caller gets back the rows whose
+    `key_column` is one of its own keys. With `window` 0 each call goes
+    straight to `fetch`.
+    """
+
+    def __init__(self, name, fetch, key_column, window, max_keys=1000):
+        self.name = name
+        self.fetch = fetch
+        self.key_column = key_column
+        self.window = window
+        self.max_keys = max_keys
+
+        self.pending = None  # batch still taking keys
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.keys = 0
+        CACHES[name] = self
+
+    def get(self, keys):
+        keys = list(dict.fromkeys(keys))
+        if self.window <= 0:
+            with self.lock:
+                self.requests += 1
+                self.batches += 1
+                self.keys += len(keys)
+            return self.fetch(keys)
+
+        with self.lock:
+            self.requests += 1
+            batch = self.pending
+            if batch is not None and batch.keys and len(set(batch.keys) | set(keys)) > self.max_keys:
+                # full, send it now and start a new one
+                batch.closed.set()
+                batch = None
+            leader = batch is None
+            if leader:
+                batch = self.pending = _Batch()
+            batch.keys.update(dict.fromkeys(keys))
+            if len(batch.keys) >= self.max_keys:
+                batch.closed.set()
+
+        if leader:
+            batch.closed.wait(self.window)
+            with self.lock:
+                if self.pending is batch:
+                    self.pending = None
+                self.batches += 1
+                self.keys += len(batch.keys)
+            try:
+                batch.future.set_result(self.fetch(list(batch.keys)))
+            except BaseException as exc:
+                batch.future.set_exception(exc)
+
+        rows = batch.future.result()
+        if rows.empty:
+            return rows
+        return rows[rows[self.key_column].isin(keys)]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'window_ms': self.window * 1000,
+                'requests': self.requests,
+                'batches': self.batches,
+                'keys': self.keys,
+                'requests_per_batch': round(self.requests / self.batches, 2) if self.batches else 0.0,
+            }
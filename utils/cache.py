@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+# every cache by name, for the /cache stats endpoint
+CACHES = {}
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after a TTL.
+
+    `get` returns `default` for missing or expired keys. When the cache holds
+    more than `maxsize` entries the least recently used ones are evicted.
+    Hits, misses, expirations and evictions are counted for `stats`.
+    """
+
+    def __init__(self, name, ttl, maxsize):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        CACHES[name] = self
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                self.expired += 1
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'expired': self.expired,
+                'evictions': self.evictions,
+            }
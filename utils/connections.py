@@ -1,7 +1,12 @@
+import contextvars
 import os
-from askquinta import About_ArangoDB, About_BQ, About_MySQL
+import threading
+import time
+from contextlib import contextmanager
 
+# askquinta is imported when the first client is created, so the matching code imports without it
 def call_arangodb():
+    from askquinta import About_ArangoDB
     return About_ArangoDB(
         arango_url=os.getenv('ARANGO_URL'),
         username=os.getenv('ARANGO_USERNAME'),
@@ -9,6 +14,7 @@ def call_arangodb():
     )
 
 def call_bq():
+    from askquinta import About_BQ
     return About_BQ(
         project_id='paper-prod',
         credentials_loc='credential_bq.json',
@@ -16,6 +22,7 @@ def call_bq():
     )
 
 def call_mysql():
+    from askquinta import About_MySQL
     return About_MySQL(
         host=os.getenv('MYSQL_HOST'),
         port=int(os.getenv('MYSQL_PORT')),
@@ -23,3 +30,230 @@ def call_mysql():
         password=os.getenv('MYSQL_PASSWORD'),
         database_name=os.getenv('MYSQL_DATABASE')
     )
+
+def check_arangodb(client):
+    client.to_pull_data('paper_payment', 'RETURN 1', batch_size=1)
+
+def check_bq(client):
+    client.to_pull_data('SELECT 1')
+
+def check_mysql(client):
+    client.to_pull_data('SELECT 1')
+
+class ClientPool:
+    """Thread-safe pool of backend clients.
+
+    Clients are created on demand up to `size` and handed to one thread at a
+    time, so a checkout also bounds how many queries hit the backend at once.
+    An idle client that has not been checked for `health_interval` seconds is
+    health-checked before it is handed out, and a client whose query raised is
+    dropped instead of being returned to the pool.
+
+    Checkouts made inside `background_work()` share at most `size - reserved`
+    clients (at least one), so background jobs cannot hold every client and
+    `reserved` stay free for interactive requests.
+    """
+
+    def __init__(self, name, factory, health_check, size, health_interval=60.0, reserved=0):
+        self.name = name
+        self.factory = factory
+        self.health_check = health_check
+        self.size = size
+        self.health_interval = health_interval
+        self.reserved = min(reserved, size - 1)
+        self.background_slots = threading.BoundedSemaphore(size - self.reserved)
+
+        self.idle = []  # (client, last_checked), most recently used last
+        self.available = threading.Condition()
+        self.closed = False
+        self.created = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.discarded = 0
+        self.failed_checks = 0
+        self.background_in_use = 0
+
+    @contextmanager
+    def client(self):
+        if not _BACKGROUND.get():
+            with self._checkout() as client:
+                yield client
+            return
+        with self.background_slots:
+            with self.available:
+                self.background_in_use += 1
+            try:
+                with self._checkout() as client:
+                    yield client
+            finally:
+                with self.available:
+                    self.background_in_use -= 1
+
+    @contextmanager
+    def _checkout(self):
+        client = self._acquire()
+        try:
+            yield client
+        except Exception:
+            self._release(client, healthy=False)
+            raise
+        else:
+            self._release(client, healthy=True)
+
+    def _acquire(self):
+        started = time.monotonic()
+        waited = False
+        while True:
+            client = None
+            with self.available:
+                while not self.idle and self.created >= self.size:
+                    # pool saturated, wait for another thread to give one back
+                    if not waited:
+                        self.waits += 1
+                        waited = True
+                    self.available.wait()
+                if self.idle:
+                    client, last_checked = self.idle.pop()
+                else:
+                    self.created += 1
+
+            if client is None:
+                try:
+                    client = self.factory()
+                except Exception:
+                    self._drop()
+                    raise
+            elif time.monotonic() - last_checked > self.health_interval and not self._check(client):
+                self._drop()
+                continue
+
+            with self.available:
+                self.in_use += 1
+                self.checkouts += 1
+                self.wait_seconds += time.monotonic() - started
+            return client
+
+    def _release(self, client, healthy):
+        with self.available:
+            self.in_use -= 1
+            if healthy and not self.closed:
+                self.idle.append((client, time.monotonic()))
+                self.available.notify()
+                return
+        self._drop()
+
+    def _drop(self):
+        """Forget a client and let a waiting thread create a replacement"""
+        with self.available:
+            self.created -= 1
+            self.discarded += 1
+            self.available.notify()
+
+    def _check(self, client):
+        try:
+            self.health_check(client)
+            return True
+        except Exception:
+            with self.available:
+                self.failed_checks += 1
+            return False
+
+    def check_health(self):
+        """Run the health check on a pooled client"""
+        try:
+            with self.client() as client:
+                self.health_check(client)
+            return True
+        except Exception:
+            return False
+
+    def stats(self):
+        with self.available:
+            return {
+                'size': self.size,
+                'reserved': self.reserved,
+                'created': self.created,
+                'in_use': self.in_use,
+                'idle': len(self.idle),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'avg_wait_ms': round(self.wait_seconds / self.checkouts * 1000, 2) if self.checkouts else 0.0,
+                'discarded': self.discarded,
+                'failed_checks': self.failed_checks,
+                'background_in_use': self.background_in_use,
+            }
+
+    def close(self):
+        """Drop the idle clients; checked-out clients are dropped as they come back"""
+        with self.available:
+            self.closed = True
+            self.created -= len(self.idle)
+            self.idle.clear()
+
+class ConnectionManager:
+    """App-lifetime pools for BigQuery, MySQL and ArangoDB clients"""
+
+    def __init__(self):
+        health_interval = float(os.getenv('DB_HEALTH_CHECK_INTERVAL', 60))
+        # clients per pool that background jobs never take
+        reserved = int(os.getenv('DB_POOL_RESERVED', 2))
+        self.pools = {
+            'bq': ClientPool('bq', call_bq, check_bq, int(os.getenv('BQ_POOL_SIZE', 4)), health_interval, reserved),
+            'mysql': ClientPool('mysql', call_mysql, check_mysql, int(os.getenv('MYSQL_POOL_SIZE', 4)), health_interval, reserved),
+            'arango': ClientPool('arango', call_arangodb, check_arangodb, int(os.getenv('ARANGO_POOL_SIZE', 4)), health_interval, reserved),
+        }
+
+    def start(self):
+        """Open one client per backend up front so the first request does not pay the handshake"""
+        for pool in self.pools.values():
+            pool.check_health()
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+    def health(self):
+        return {name: pool.check_health() for name, pool in self.pools.items()}
+
+    def stats(self):
+        return {name: pool.stats() for name, pool in self.pools.items()}
+
+_MANAGER = None
+_MANAGER_LOCK = threading.Lock()
+
+def get_connection_manager():
+    global _MANAGER
+    with _MANAGER_LOCK:
+        if _MANAGER is None:
+            _MANAGER = ConnectionManager()
+        return _MANAGER
+
+_BACKGROUND = contextvars.ContextVar('background_work', default=False)
+
+@contextmanager
+def background_work():
+    """Mark the client checkouts of this context, and of work bound to it, as background"""
+    token = _BACKGROUND.set(True)
+    try:
+        yield
+    finally:
+        _BACKGROUND.reset(token)
+
+def in_background_work():
+    return _BACKGROUND.get()
+
+def bq_client():
+    return get_connection_manager().pools['bq'].client()
+
+def mysql_client():
+    return get_connection_manager().pools['mysql'].client()
+
+def arangodb_client():
+    return get_connection_manager().pools['arango'].client()
+
+def run_bq_statement(BQ, statement):
+    """Run DML/DDL on a pooled BigQuery client as a query job and wait for it; raises if the job fails"""
+    BQ.load_credentials()
+    return BQ.initialize_client().query(statement, location=BQ.location_bq).result()
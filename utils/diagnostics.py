@@ -0,0 +1,110 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Diagnostics of the request the current thread works for, and the company unit inside it
+_CURRENT = contextvars.ContextVar('diagnostics', default=None)
+_COMPANY = contextvars.ContextVar('diagnostics_company', default=None)
+
+class Diagnostics:
+    """Wall time and counters per phase of one search request.
+
+    Phases are the backends ('bigquery', 'mysql', 'arango'), 'parse' and the
+    matcher phases ('single_match', 'multi_payment', 'multi_invoice'). Every
+    phase keeps its summed milliseconds, how often it ran and counters such as
+    rows, queries or evaluated candidates. Phases recorded by work bound to a
+    company with `bind` also go to that company. Companies run in parallel,
+    so phase times can add up to more than the request took.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished = None
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.companies = {}
+
+    def add(self, phase, seconds=0.0, company=None, calls=1, **counters):
+        with self.lock:
+            targets = [self.phases]
+            if company is not None:
+                targets.append(self.companies.setdefault(str(company), {}))
+            for phases in targets:
+                stats = phases.setdefault(phase, {'ms': 0.0, 'calls': 0})
+                stats['ms'] += seconds * 1000
+                stats['calls'] += calls
+                for name, value in counters.items():
+                    stats[name] = stats.get(name, 0) + value
+
+    def total_ms(self):
+        return ((self.finished or time.perf_counter()) - self.started) * 1000
+
+    def server_timing(self):
+        """Server-Timing header value, one metric per phase plus the total"""
+        with self.lock:
+            metrics = [f'{phase};dur={stats["ms"]:.1f}' for phase, stats in self.phases.items()]
+        metrics.append(f'total;dur={self.total_ms():.1f}')
+        return ', '.join(metrics)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'total_ms': round(self.total_ms(), 1),
+                'phases': {phase: _rounded(stats) for phase, stats in self.phases.items()},
+                'companies': {company: {phase: _rounded(stats) for phase, stats in phases.items()}
+                              for company, phases in self.companies.items()},
+            }
+
+def _rounded(stats):
+    return {name: round(value, 1) if name == 'ms' else value for name, value in stats.items()}
+
+def collect(fn, *args, **kwargs):
+    """(fn(*args, **kwargs), Diagnostics of the run)"""
+    diagnostics = Diagnostics()
+    token = _CURRENT.set(diagnostics)
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        _CURRENT.reset(token)
+        diagnostics.finished = time.perf_counter()
+    return result, diagnostics
+
+def bind(fn, company_id=None):
+    """fn running in the caller's context, for work handed to another thread.
+
+    With `company_id` the phases it records also count for that company.
+    Every call gets its own copy, so the result can go to `Executor.map`.
+    """
+    context = contextvars.copy_context()
+    if company_id is not None:
+        context.run(_COMPANY.set, company_id)
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+@contextmanager
+def phase(name, **counters):
+    """Time the block as one call of `name`; the yielded dict takes counters, e.g. rows"""
+    diagnostics = _CURRENT.get()
+    if diagnostics is None:
+        yield counters
+        return
+    start = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        diagnostics.add(name, time.perf_counter() - start, company=_COMPANY.get(), **counters)
+
+def count(name, **counters):
+    """Add counters to `name` without timing anything"""
+    diagnostics = _CURRENT.get()
+    if diagnostics is not None:
+        diagnostics.add(name, company=_COMPANY.get(), calls=0, **counters)
+
+def record(phases):
+    """Add phase stats measured elsewhere, {phase: {'seconds': ..., counter: ...}}"""
+    diagnostics = _CURRENT.get()
+    if diagnostics is None:
+        return
+    for name, stats in phases.items():
+        counters = {k: v for k, v in stats.items() if k not in ('seconds', 'calls')}
+        diagnostics.add(name, stats.get('seconds', 0.0), company=_COMPANY.get(), calls=stats.get('calls', 1), **counters)
@@ -0,0 +1,226 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
+
+import pandas as pd
+
+from .cache import CACHES
+
+class PartnerInvoices:
+    """Invoices of one (company, partner) for the invoice_date ranges in `ranges`"""
+
+    def __init__(self):
+        self.frame = None
+        self.ranges = []  # merged inclusive (start, end) dates
+        self.watermark = None  # newest invoices.updated_at seen, or when a pull found no rows
+        self.refreshed_at = 0.0
+
+class CompanyInvoices:
+    def __init__(self):
+        self.partners = {}  # lower-cased partner name -> PartnerInvoices
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+class InvoiceStore:
+    """In-memory invoice candidates per company and partner, filled by date range.
+
+    A request for (company, partners, start, end) only queries the parts of
+    [start, end] not yet held for each partner; partners missing the same
+    sub-ranges share one query. Held partners are refreshed by pulling rows
+    whose `updated_at` is newer than the newest one seen (minus `overlap`),
+    without the status/deleted_at filter, so invoices that were paid,
+    cancelled or deleted drop out and reopened ones come back. A partner whose
+    pulls found no rows keeps the time of its first pull as watermark, so
+    names without invoices are refreshed incrementally too. Partners are
+    refreshed at most every `refresh_interval` seconds. Least recently used
+    companies are evicted once the held frames exceed `max_bytes`.
+
+    `pull(company_id, partner_names, start_date, end_date, changed_since=None)`
+    returns the invoice frame for one query, including `invoice_uuid` and
+    `updated_at`. Without `changed_since` it applies the usual
+    `deleted_at is null and status in (0,3)` filter.
+    """
+
+    def __init__(self, pull, max_bytes, refresh_interval=30.0, overlap=timedelta(minutes=5)):
+        self.pull = pull
+        self.max_bytes = max_bytes
+        self.refresh_interval = refresh_interval
+        self.overlap = overlap
+
+        self.companies = OrderedDict()  # company_id -> CompanyInvoices, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.range_queries = 0
+        self.refreshes = 0
+        self.refreshed_rows = 0
+        self.evictions = 0
+        CACHES['invoices'] = self
+
+    def window(self, company_id, partner_names, start_date, end_date):
+        """Open invoices of these partners with start_date <= invoice_date <= end_date"""
+        start, end = to_date(start_date), to_date(end_date)
+        names = list(dict.fromkeys(name.lower() for name in partner_names))
+
+        with self.lock:
+            entry = self.companies.get(company_id)
+            if entry is None:
+                entry = self.companies[company_id] = CompanyInvoices()
+            self.companies.move_to_end(company_id)
+
+        with entry.lock:
+            for name in names:
+                entry.partners.setdefault(name, PartnerInvoices())
+
+            # ranges already held get the changes since the last pull
+            stale = [
+                name for name in names
+                if entry.partners[name].ranges and time.monotonic() - entry.partners[name].refreshed_at >= self.refresh_interval
+            ]
+            if stale:
+                self._refresh(company_id, entry, stale)
+
+            # partners missing the same sub-ranges share a query
+            gaps = {}
+            for name in names:
+                gaps.setdefault(tuple(missing_ranges(entry.partners[name].ranges, start, end)), []).append(name)
+            for missing, group in gaps.items():
+                if not missing:
+                    self.hits += len(group)
+                    continue
+                self.misses += len(group)
+                for gap_start, gap_end in missing:
+                    self.range_queries += 1
+                    pulled_at = now()
+                    rows = self.pull(company_id, group, gap_start.isoformat(), gap_end.isoformat())
+                    self._add(entry, group, rows, pulled_at, (gap_start, gap_end))
+
+            frames = [entry.partners[name].frame for name in names if entry.partners[name].frame is not None]
+            entry.nbytes = sum(int(p.frame.memory_usage(deep=True).sum()) for p in entry.partners.values() if p.frame is not None)
+
+        self._evict(keep=company_id)
+        if not frames:
+            return pd.DataFrame()
+        return open_invoices(pd.concat(frames, ignore_index=True), start, end)
+
+    def _add(self, entry, names, rows, pulled_at, covered=None):
+        """Upsert pulled rows into their partners, marking `covered` as held for every name"""
+        lower_names = rows['name'].str.lower() if not rows.empty else pd.Series(dtype=object)
+        for name in names:
+            partner = entry.partners[name]
+            partner_rows = rows[lower_names == name] if not rows.empty else rows
+            partner.frame = upsert(partner.frame, partner_rows)
+            # nothing seen yet: everything updated before this pull is known to be absent
+            partner.watermark = latest_update(partner.frame, partner.watermark) or pulled_at
+            if covered:
+                if not partner.ranges:
+                    partner.refreshed_at = time.monotonic()
+                partner.ranges = merge_ranges(partner.ranges + [covered])
+            else:
+                partner.refreshed_at = time.monotonic()
+
+    def _refresh(self, company_id, entry, names):
+        # every held partner has a watermark, so this only returns rows changed since then
+        watermark = min(entry.partners[name].watermark for name in names)
+        changed_since = (pd.Timestamp(watermark) - self.overlap).strftime('%Y-%m-%d %H:%M:%S')
+        hull_start = min(entry.partners[name].ranges[0][0] for name in names)
+        hull_end = max(entry.partners[name].ranges[-1][1] for name in names)
+
+        pulled_at = now()
+        rows = self.pull(company_id, names, hull_start.isoformat(), hull_end.isoformat(), changed_since=changed_since)
+        self.refreshes += 1
+        self.refreshed_rows += len(rows)
+        self._add(entry, names, rows, pulled_at)
+
+    def _evict(self, keep):
+        with self.lock:
+            total = sum(entry.nbytes for entry in self.companies.values())
+            for company_id in list(self.companies):
+                if total <= self.max_bytes:
+                    break
+                if company_id == keep:
+                    continue
+                total -= self.companies.pop(company_id).nbytes
+                self.evictions += 1
+
+    def invalidate(self, company_ids=None):
+        with self.lock:
+            for company_id in list(self.companies) if company_ids is None else company_ids:
+                self.companies.pop(company_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'companies': len(self.companies),
+                'partners': sum(len(e.partners) for e in self.companies.values()),
+                'bytes': sum(e.nbytes for e in self.companies.values()),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'range_queries': self.range_queries,
+                'refreshes': self.refreshes,
+                'refreshed_rows': self.refreshed_rows,
+                'evictions': self.evictions,
+            }
+
+def now():
+    """Current time in the format of invoices.updated_at"""
+    return pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def to_date(value):
+    return value if isinstance(value, date) else pd.Timestamp(value).date()
+
+def merge_ranges(ranges):
+    """Union of inclusive date ranges; adjacent days are joined"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def missing_ranges(ranges, start, end):
+    """Parts of the inclusive range [start, end] not covered by `ranges`"""
+    missing = []
+    for covered_start, covered_end in ranges:
+        if covered_end < start or covered_start > end:
+            continue
+        if covered_start > start:
+            missing.append((start, covered_start - timedelta(days=1)))
+        start = max(start, covered_end + timedelta(days=1))
+        if start > end:
+            return missing
+    missing.append((start, end))
+    return missing
+
+def latest_update(frame, watermark):
+    if frame is None or frame.empty:
+        return watermark
+    newest = frame['updated_at'].dropna()
+    if newest.empty:
+        return watermark
+    newest = str(newest.astype(str).max())
+    return max(watermark, newest) if watermark else newest
+
+def upsert(frame, changed):
+    """`frame` with the rows of `changed` added or replacing the rows with the same invoice_uuid"""
+    if frame is None or frame.empty:
+        return changed.reset_index(drop=True)
+    if changed.empty:
+        return frame
+    kept = frame[~frame['invoice_uuid'].isin(changed['invoice_uuid'])]
+    return pd.concat([kept, changed], ignore_index=True)
+
+def open_invoices(frame, start, end):
+    """Rows search_invoice would return: not deleted, status 0/3, inside the date range, in date order"""
+    invoice_date = pd.to_datetime(frame['invoice_date']).dt.date
+    keep = (
+        frame['deleted_at'].isna()
+        & pd.to_numeric(frame['invoice_status'], errors='coerce').isin([0, 3])
+        & (invoice_date >= start)
+        & (invoice_date <= end)
+    )
+    frame = frame[keep]
+    return frame.sort_values(['invoice_date', 'due_date'], kind='stable').reset_index(drop=True)
@@ -0,0 +1,215 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .connections import background_work
+from .search import iter_search_companies
+
+class JobQueueFull(Exception):
+    pass
+
+class JobStore:
+    """Reconciliation jobs and their result rows in a local SQLite file.
+
+    The file is local to one instance: with several instances behind a load
+    balancer, GET /reconcile/jobs/{id} only finds jobs the answering instance
+    took. Run a single instance for jobs, or route by job id.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.executescript("""
+            create table if not exists jobs (
+                id text primary key, status text, created_at real, started_at real, finished_at real,
+                request text, error text, results integer default 0
+            );
+            create table if not exists job_companies (
+                job_id text, branch text, company_id text, status text, matches integer default 0,
+                primary key (job_id, branch, company_id)
+            );
+            create table if not exists job_results (
+                job_id text, seq integer, row text, primary key (job_id, seq)
+            );
+            """)
+
+    def create(self, request):
+        job_id = uuid.uuid4().hex
+        with self.lock, self.db:
+            self.db.execute("insert into jobs (id, status, created_at, request) values (?, 'queued', ?, ?)",
+                            (job_id, time.time(), json.dumps(request)))
+        return job_id
+
+    def start(self, job_id):
+        with self.lock, self.db:
+            self.db.execute("update jobs set status = 'running', started_at = ? where id = ?", (time.time(), job_id))
+
+    def set_companies(self, job_id, companies):
+        with self.lock, self.db:
+            self.db.executemany("insert or ignore into job_companies (job_id, branch, company_id, status) values (?, ?, ?, 'running')",
+                                [(job_id, branch, str(company_id)) for branch, company_id in companies])
+
+    def add_results(self, job_id, rows, company=None):
+        with self.lock, self.db:
+            (seq,) = self.db.execute("select results from jobs where id = ?", (job_id,)).fetchone()
+            self.db.executemany("insert into job_results (job_id, seq, row) values (?, ?, ?)",
+                                [(job_id, seq + i, json.dumps(row, default=str)) for i, row in enumerate(rows)])
+            self.db.execute("update jobs set results = ? where id = ?", (seq + len(rows), job_id))
+            if company is not None:
+                branch, company_id = company
+                self.db.execute("update job_companies set status = 'done', matches = ? where job_id = ? and branch = ? and company_id = ?",
+                                (len(rows), job_id, branch, str(company_id)))
+
+    def fail_companies(self, job_id):
+        """Companies of a failed job that were still running will not report anymore"""
+        with self.lock, self.db:
+            self.db.execute("update job_companies set status = 'failed' where job_id = ? and status = 'running'", (job_id,))
+
+    def finish(self, job_id, error=None):
+        with self.lock, self.db:
+            self.db.execute("update jobs set status = ?, finished_at = ?, error = ? where id = ?",
+                            ('failed' if error else 'done', time.time(), error, job_id))
+
+    def interrupt_unfinished(self):
+        """Jobs left queued or running by a previous process will never finish"""
+        with self.lock, self.db:
+            self.db.execute("update jobs set status = 'failed', finished_at = ?, error = 'interrupted' where status in ('queued', 'running')",
+                            (time.time(),))
+
+    def purge(self, older_than):
+        with self.lock, self.db:
+            old = [r[0] for r in self.db.execute("select id from jobs where finished_at < ?", (older_than,))]
+            for table, column in (('job_results', 'job_id'), ('job_companies', 'job_id'), ('jobs', 'id')):
+                self.db.executemany(f"delete from {table} where {column} = ?", [(job_id,) for job_id in old])
+        return len(old)
+
+    def get(self, job_id, offset=0, limit=1000):
+        with self.lock:
+            job = self.db.execute("select id, status, created_at, started_at, finished_at, error, results from jobs where id = ?",
+                                  (job_id,)).fetchone()
+            if job is None:
+                return None
+            companies = self.db.execute("select branch, company_id, status, matches from job_companies where job_id = ? order by branch, company_id",
+                                        (job_id,)).fetchall()
+            rows = self.db.execute("select row from job_results where job_id = ? and seq >= ? order by seq limit ?",
+                                   (job_id, offset, limit)).fetchall()
+
+        job_id, status, created_at, started_at, finished_at, error, total = job
+        done = sum(1 for c in companies if c[2] == 'done')
+        next_offset = offset + len(rows)
+        return {
+            'job_id': job_id,
+            'status': status,
+            'created_at': created_at,
+            'started_at': started_at,
+            'finished_at': finished_at,
+            'error': error,
+            'progress': {
+                'companies': len(companies),
+                'companies_done': done,
+                'per_company': [{'branch': b, 'company_id': c, 'status': s, 'matches': m} for b, c, s, m in companies],
+            },
+            'total_results': total,
+            'offset': offset,
+            'results': [json.loads(r[0]) for r in rows],
+            'next_offset': next_offset if next_offset < total or status in ('queued', 'running') else None,
+        }
+
+class JobManager:
+    """Runs reconciliation jobs in the background.
+
+    Submitted jobs wait in a bounded queue; `submit` raises JobQueueFull once
+    `queue_size` jobs are waiting, so a burst of jobs is refused instead of
+    piling up. `workers` jobs run at a time and their company units use their
+    own executor, leaving the /search executors to interactive requests. Jobs
+    run as `background_work`: their DB checkouts leave DB_POOL_RESERVED clients
+    of every pool to /search and they match on their own process pool
+    (JOB_MATCHER_WORKERS). When one company raises, the job fails, its
+    companies still running are marked failed and the ones not started yet
+    are cancelled.
+    """
+
+    def __init__(self, store, workers, queue_size, company_workers, retention):
+        self.store = store
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.company_executor = ThreadPoolExecutor(max_workers=company_workers, thread_name_prefix='job-company')
+        self.retention = retention
+        self.threads = []
+        self.running = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.store.interrupt_unfinished()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+        for _ in self.threads:
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                break  # every worker finds the stop flag when it takes its next job
+        self.company_executor.shutdown(wait=False)
+
+    def submit(self, list_invoice_number, list_external_id):
+        self.store.purge(time.time() - self.retention)
+        job_id = self.store.create({'invoice_numbers': list_invoice_number, 'external_ids': list_external_id})
+        try:
+            self.queue.put_nowait((job_id, list_invoice_number, list_external_id))
+        except queue.Full:
+            self.store.finish(job_id, error='rejected, job queue full')
+            raise JobQueueFull(job_id)
+        return job_id
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None or self.stopped.is_set():
+                return
+            with self.lock:
+                self.running += 1
+            try:
+                self._run(*job)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+    def _run(self, job_id, list_invoice_number, list_external_id):
+        self.store.start(job_id)
+        try:
+            with background_work():
+                events = iter_search_companies(list_invoice_number, list_external_id, executor=self.company_executor)
+                for event, company, rows in events:
+                    if event == 'companies':
+                        self.store.set_companies(job_id, rows)
+                    else:
+                        self.store.add_results(job_id, rows, company)
+        except Exception as e:
+            self.store.fail_companies(job_id)
+            self.store.finish(job_id, error=str(e))
+        else:
+            self.store.finish(job_id)
+
+    def stats(self):
+        with self.lock:
+            return {'workers': self.workers, 'running': self.running,
+                    'queued': self.queue.qsize(), 'queue_size': self.queue.maxsize}
+
+JOB_MANAGER = JobManager(
+    JobStore(os.getenv('JOB_DB_PATH', '/tmp/reconcile_jobs.sqlite3')),
+    workers=int(os.getenv('JOB_WORKERS', 2)),
+    queue_size=int(os.getenv('JOB_QUEUE_SIZE', 20)),
+    company_workers=int(os.getenv('JOB_COMPANY_WORKERS', 4)),
+    retention=float(os.getenv('JOB_RETENTION_HOURS', 24)) * 3600,
+)
@@ -1,20 +1,55 @@
 from datetime import datetime, timedelta
-from typing import List, Dict, Set, Optional, Tuple
+from typing import List, Dict, Set, Optional, Tuple, Union
 from dataclasses import dataclass
-import itertools
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from itertools import islice
+import bisect
 import json
+import multiprocessing
+import os
+import threading
+import time
 from datetime import timezone
 
+import numpy as np
+import pandas as pd
+
+from .subset_sum import SubsetSumIndex
+from .names import normalize_name
+
+MINOR_UNITS = 100  # sen per rupiah
+MULTI_EXACT_SCORE = 950.0  # exact multi match, the highest score a multi rule gives
+MULTI_TOLERANCE_SCORE = 650.0  # multi match within tolerance, less the difference
+
+# combinations the multi phases of one block may evaluate before the rest of its
+# multi matching is skipped; bounds a block where almost every group is in range
+MAX_MULTI_EVALUATED = int(os.getenv('MATCHER_MAX_MULTI_EVALUATED', 1_000_000))
+
+def to_minor_units(amount: float) -> Optional[int]:
+    """Amount as an integer number of sen, None when it is not a number"""
+    return int(round(amount * MINOR_UNITS)) if amount == amount else None
+
+# Payment/Invoice use __slots__ so a company window of hundreds of thousands of
+# rows stays one small object per row instead of a dict per row.
+# `amount_minor` is the amount in sen, set once when the object is built; the
+# exact rules compare it instead of floats.
 @dataclass
 class Payment:
+    __slots__ = ('external_id', 'amount', 'date', 'company_id', 'buyer_name', 'amount_minor')
     external_id: str
     amount: float
     date: datetime
     company_id: str
     buyer_name: str
 
+    def __post_init__(self):
+        self.amount_minor = to_minor_units(self.amount)
+
 @dataclass
 class Invoice:
+    __slots__ = ('invoice_id', 'amount', 'date', 'due_date', 'company_id', 'buyer_name', 'top', 'invoice_status',
+                 'amount_minor')
     invoice_id: str
     amount: float
     date: datetime
@@ -24,6 +59,9 @@ class Invoice:
     top: int
     invoice_status: str
 
+    def __post_init__(self):
+        self.amount_minor = to_minor_units(self.amount)
+
 @dataclass
 class MatchResult:
     payment: Payment | List[Payment]
@@ -36,106 +74,408 @@ class MatchResult:
 def calculate_ontime(payment_date, due_date) -> int:
     return 1 if payment_date <= due_date else 0
 
+class InvoiceAmountIndex:
+    """Amount-sorted view over a list of invoices, filled in date order.
+
+    Invoices enter the index through `advance_to(date)`, so when payments are
+    walked in date order an invoice dated after the current payment is never
+    looked at. Lookups are bisects over the sorted amounts and return positions
+    into the original invoice list.
+    """
+
+    def __init__(self, invoices: List[Invoice]):
+        self.invoices = invoices
+        # invoices without a usable amount can never satisfy a rule
+        self.pending = sorted(
+            (position for position, invoice in enumerate(invoices) if invoice.amount == invoice.amount),
+            key=lambda position: invoices[position].date
+        )
+        self.next_pending = 0
+        self.entries: List[Tuple[float, int]] = []
+
+    def advance_to(self, date: datetime):
+        """Add every invoice dated on or before `date`"""
+        while self.next_pending < len(self.pending):
+            position = self.pending[self.next_pending]
+            invoice = self.invoices[position]
+            if invoice.date > date:
+                break
+            bisect.insort(self.entries, (invoice.amount, position))
+            self.next_pending += 1
+
+    def remove(self, position: int):
+        """Drop an invoice from the index once it has been matched"""
+        entry = (self.invoices[position].amount, position)
+        i = bisect.bisect_left(self.entries, entry)
+        if i < len(self.entries) and self.entries[i] == entry:
+            del self.entries[i]
+
+    def candidates(self, windows: List[Tuple[float, float]]) -> List[int]:
+        """Positions of indexed invoices whose amount falls in any of the windows, in list order"""
+        positions = set()
+        for low, high in windows:
+            if low != low or high != high:
+                continue
+            start = bisect.bisect_left(self.entries, (low, -1))
+            end = bisect.bisect_right(self.entries, (high, len(self.invoices)))
+            positions.update(position for _, position in self.entries[start:end])
+        return sorted(positions)
+
+class ExactAmountIndex:
+    """Invoice positions keyed by amount in sen, each bucket in original invoice order.
+
+    Matched invoices are popped off the front of a bucket as probes meet them.
+    When a bucket is also in date order, which it is for the date-sorted
+    invoices `find_matches` passes in, the first unused position settles the
+    probe, so a run of payments over one amount costs O(P + B) instead of
+    O(P * B). Other buckets are scanned past the used invoices in the middle.
+    """
+
+    def __init__(self, invoices: List[Invoice]):
+        self.invoices = invoices
+        self.positions: Dict[int, deque] = {}
+        for position, invoice in enumerate(invoices):
+            if invoice.amount_minor is not None:
+                self.positions.setdefault(invoice.amount_minor, deque()).append(position)
+        self.date_ordered = {
+            amount: all(invoices[a].date <= invoices[b].date for a, b in zip(positions, islice(positions, 1, None)))
+            for amount, positions in self.positions.items()
+        }
+
+    def first_available(self, amount_minor: Optional[int], date: datetime, used_invoices: Set[str]) -> Optional[int]:
+        """Lowest position with this amount that is unused and dated on/before `date`"""
+        positions = self.positions.get(amount_minor)
+        if not positions:
+            return None
+        # matched invoices never come back
+        while positions and self.invoices[positions[0]].invoice_id in used_invoices:
+            positions.popleft()
+        if not positions:
+            return None
+        if self.date_ordered[amount_minor]:
+            # every later position is dated on or after the first one
+            return positions[0] if self.invoices[positions[0]].date <= date else None
+        for position in positions:
+            invoice = self.invoices[position]
+            if invoice.date <= date and invoice.invoice_id not in used_invoices:
+                return position
+        return None
+
+def merge_windows(windows: List[Tuple[float, float]], max_windows: Optional[int] = None) -> List[Tuple[float, float]]:
+    """Union of (low, high) ranges; with `max_windows`, the smallest gaps are closed until it fits"""
+    merged = []
+    for low, high in sorted(windows):
+        if merged and low <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+
+    if max_windows and len(merged) > max_windows:
+        gaps = sorted(range(len(merged) - 1), key=lambda k: merged[k + 1][0] - merged[k][1])
+        closed = set(gaps[:len(merged) - max_windows])
+        coarse = [merged[0]]
+        for k in range(1, len(merged)):
+            if k - 1 in closed:
+                coarse[-1] = (coarse[-1][0], merged[k][1])
+            else:
+                coarse.append(merged[k])
+        merged = coarse
+    return merged
+
 class PaymentInvoiceMatcher:
-    def __init__(self):
+    def __init__(self, max_combinations: int = 3, max_multi_evaluated: Optional[int] = None):
         self.TAX_TOLERANCES = [0.0202]  # 2.02%
         self.GENERAL_TOLERANCE = [2000, 5000]
         self.ADD_IDR = 10000  # 10K rule
+        self.MAX_COMBINATIONS = max_combinations  # largest group in multi payment/invoice matches
+        # combinations the multi phases may evaluate, see MAX_MULTI_EVALUATED
+        self.max_multi_evaluated = MAX_MULTI_EVALUATED if max_multi_evaluated is None else max_multi_evaluated
+        self.multi_evaluated = 0
         self.used_payments: Set[str] = set()
         self.used_invoices: Set[str] = set()
         self.matches = []
+        self.match_sources = []  # outer payment/invoice behind each entry of self.matches
+        self.evaluated = 0  # pairs/combinations scored by the _evaluate_* rules
+        self.phase_stats = empty_phase_stats()
 
     def find_matches(self, payments: List[Payment], invoices: List[Invoice]):
         sorted_payments = sorted(payments, key=lambda x: x.date)
         sorted_invoices = sorted(invoices, key=lambda x: x.date)
 
         # First try single matches
-        self.find_single_matches(sorted_payments, sorted_invoices)
+        self._timed_phase('single_match', self.find_single_matches, sorted_payments, sorted_invoices)
         
         # Then try multi-payment matches
-        self.find_multi_payment_matches(sorted_payments, sorted_invoices)
+        self._timed_phase('multi_payment', self.find_multi_payment_matches, sorted_payments, sorted_invoices)
         
         # Finally try multi-invoice matches
-        self.find_multi_invoice_matches(sorted_payments, sorted_invoices)
+        self._timed_phase('multi_invoice', self.find_multi_invoice_matches, sorted_payments, sorted_invoices)
+
+    def _timed_phase(self, phase: str, find, payments: List[Payment], invoices: List[Invoice]):
+        """Run one matching phase and add its time, evaluated candidates and matches to `phase_stats`"""
+        start, evaluated, matches = time.perf_counter(), self.evaluated, len(self.matches)
+        find(payments, invoices)
+        stats = self.phase_stats[phase]
+        stats['seconds'] += time.perf_counter() - start
+        stats['evaluated'] += self.evaluated - evaluated
+        stats['matches'] += len(self.matches) - matches
 
     def find_single_matches(self, payments: List[Payment], invoices: List[Invoice]):
         """Find best 1:1 matches between payments and invoices"""
+        index = InvoiceAmountIndex(invoices)
+        exact = ExactAmountIndex(invoices)
+
         for payment in payments:
             if payment.external_id in self.used_payments:
                 continue
 
+            # only invoices dated on/before the payment enter the index
+            index.advance_to(payment.date)
+
+            # an exact match outscores every other rule, so one probe settles it
+            position = exact.first_available(payment.amount_minor, payment.date, self.used_invoices)
+            if position is not None:
+                self._add_match(self._evaluate_match(payment, invoices[position]))
+                index.remove(position)
+                continue
+
             best_match = None
+            best_position = None
             best_score = -float('inf')
-            
-            for invoice in invoices:
+
+            # candidates come back in the original invoice order, so ties on score
+            # resolve to the same invoice as a full scan would
+            for position in index.candidates(self._candidate_windows(payment)):
+                invoice = invoices[position]
                 if invoice.invoice_id in self.used_invoices or payment.date < invoice.date:
                     continue
 
-                    
                 match_result = self._evaluate_match(payment, invoice)
                 if match_result and match_result.score > best_score:
                     best_match = match_result
+                    best_position = position
                     best_score = match_result.score
-            
+
             if best_match:
                 self._add_match(best_match)
+                index.remove(best_position)
+
+    def _candidate_windows(self, payment: Payment) -> List[Tuple[float, float]]:
+        """Amount ranges an invoice must fall into for `_evaluate_match` to accept it"""
+        centers = [payment.amount, payment.amount + self.ADD_IDR]
+        for tax in self.TAX_TOLERANCES:
+            amount_with_tax = payment.amount * (1 + tax)
+            centers.extend([amount_with_tax, amount_with_tax + self.ADD_IDR])
+
+        # widen by one rupiah so float rounding at the edge never drops a candidate;
+        # the final decision is still made by _evaluate_match
+        radius = max(self.GENERAL_TOLERANCE, default=0) + 1
+        return [(center - radius, center + radius) for center in centers]
 
-    def find_multi_payment_matches(self, payments: List[Payment], invoices: List[Invoice], max_combinations: int = 3):
+    def find_multi_payment_matches(self, payments: List[Payment], invoices: List[Invoice], max_combinations: Optional[int] = None):
         """Find matches where multiple payments combine to match one invoice"""
+        if max_combinations is None:
+            max_combinations = self.MAX_COMBINATIONS
+        index = SubsetSumIndex([p.amount for p in payments], max_combinations,
+                               exclude={k for k, p in enumerate(payments) if p.external_id in self.used_payments})
+
         for invoice in invoices:
             if invoice.invoice_id in self.used_invoices:
                 continue
+            if self._multi_capped('multi_payment'):
+                return
 
-            valid_payments = [p for p in payments 
-                            if p.external_id not in self.used_payments 
-                            and p.date >= invoice.date]
+            def is_valid(position: int) -> bool:
+                payment = payments[position]
+                return payment.external_id not in self.used_payments and payment.date >= invoice.date
 
             best_combo_match = None
             best_combo_score = -float('inf')
+            best_positions = ()
 
-            for n in range(2, min(max_combinations + 1, len(valid_payments) + 1)):
-                for payment_combo in itertools.combinations(valid_payments, n):
+            # smaller groups first, each size in itertools.combinations order
+            for n in range(2, max_combinations + 1):
+                # a larger group only has to be searched where it could still beat the best
+                windows = self._multi_candidate_windows(invoice.amount, inverse_tax=True, best_score=best_combo_score)
+                for positions in index.combinations(n, windows, is_valid):
+                    payment_combo = tuple(payments[position] for position in positions)
                     total_amount = sum(p.amount for p in payment_combo)
-                    
+
                     combo_match = self._evaluate_multi_payment_match(payment_combo, invoice, total_amount)
+                    self.multi_evaluated += 1
                     if combo_match and combo_match.score > best_combo_score:
                         best_combo_match = combo_match
                         best_combo_score = combo_match.score
+                        best_positions = positions
+                    # a later combination could only tie an exact match, and ties keep the first
+                    if best_combo_score >= MULTI_EXACT_SCORE or self._multi_capped('multi_payment'):
+                        break
+                if best_combo_score >= MULTI_EXACT_SCORE or self._multi_capped('multi_payment'):
+                    break
 
             if best_combo_match:
                 self._add_multi_payment_match(best_combo_match)
+                for position in best_positions:
+                    index.remove(position)
 
-    def find_multi_invoice_matches(self, payments: List[Payment], invoices: List[Invoice], max_combinations: int = 3):
+    def find_multi_invoice_matches(self, payments: List[Payment], invoices: List[Invoice], max_combinations: Optional[int] = None):
         """Find matches where one payment matches multiple invoices"""
+        if max_combinations is None:
+            max_combinations = self.MAX_COMBINATIONS
+        index = SubsetSumIndex([i.amount for i in invoices], max_combinations,
+                               exclude={k for k, i in enumerate(invoices) if i.invoice_id in self.used_invoices})
+
         for payment in payments:
             if payment.external_id in self.used_payments:
                 continue
+            if self._multi_capped('multi_invoice'):
+                return
 
-            valid_invoices = [i for i in invoices 
-                            if i.invoice_id not in self.used_invoices 
-                            and payment.date >= i.date]
+            def is_valid(position: int) -> bool:
+                invoice = invoices[position]
+                return invoice.invoice_id not in self.used_invoices and payment.date >= invoice.date
 
             best_combo_match = None
             best_combo_score = -float('inf')
+            best_positions = ()
 
-            for n in range(2, min(max_combinations + 1, len(valid_invoices) + 1)):
-                for invoice_combo in itertools.combinations(valid_invoices, n):
+            for n in range(2, max_combinations + 1):
+                windows = self._multi_candidate_windows(payment.amount, inverse_tax=False, best_score=best_combo_score)
+                for positions in index.combinations(n, windows, is_valid):
+                    invoice_combo = tuple(invoices[position] for position in positions)
                     total_amount = sum(i.amount for i in invoice_combo)
-                    
+
                     combo_match = self._evaluate_multi_invoice_match(payment, invoice_combo, total_amount)
+                    self.multi_evaluated += 1
                     if combo_match and combo_match.score > best_combo_score:
                         best_combo_match = combo_match
                         best_combo_score = combo_match.score
+                        best_positions = positions
+                    if best_combo_score >= MULTI_EXACT_SCORE or self._multi_capped('multi_invoice'):
+                        break
+                if best_combo_score >= MULTI_EXACT_SCORE or self._multi_capped('multi_invoice'):
+                    break
 
             if best_combo_match:
                 self._add_multi_invoice_match(best_combo_match)
+                for position in best_positions:
+                    index.remove(position)
+
+    def _multi_capped(self, phase: str) -> bool:
+        """True once the multi phases evaluated `max_multi_evaluated` combinations; logged once"""
+        if self.multi_evaluated < self.max_multi_evaluated:
+            return False
+        if not any(stats['capped'] for stats in self.phase_stats.values()):
+            self.phase_stats[phase]['capped'] += 1
+            print('multi match cap reached in', phase, 'after', self.multi_evaluated,
+                  'combinations, the remaining multi matches of this block are skipped')
+        return True
+
+    def _multi_candidate_windows(self, amount: float, inverse_tax: bool,
+                                 best_score: float = -float('inf')) -> List[Tuple[float, float]]:
+        """Ranges a combined total must fall into for the multi-match rules to accept it.
+
+        `amount` is the single side of the match. For multi-payment the payments'
+        total is taxed, so the tax target is amount / (1 + tax); for multi-invoice
+        the payment is taxed, so it is amount * (1 + tax). With `best_score` the
+        tolerance range only keeps totals that would score higher.
+        """
+        difference = max(self.GENERAL_TOLERANCE, default=0)
+        if best_score > -float('inf'):
+            difference = max(0.0, min(difference, MULTI_TOLERANCE_SCORE - best_score))
+        # one rupiah of slack so float rounding never drops a candidate
+        radius = difference + 1
+        windows = [(amount - radius, amount + radius)]
+        for tax in self.TAX_TOLERANCES:
+            target = amount / (1 + tax) if inverse_tax else amount * (1 + tax)
+            windows.append((target - 1, target + 1))
+        return windows
+
+    def single_match_amount_windows(self, invoice_amounts: List[float]) -> List[Tuple[float, float]]:
+        """Payment amount ranges a single match against one of these invoices needs.
+
+        The payment must be near an invoice amount directly, before tax,
+        before the 10K fee, or both.
+        """
+        radius = max(self.GENERAL_TOLERANCE, default=0) + 1
+        windows = []
+        for amount in invoice_amounts:
+            if amount != amount:
+                continue
+            for target in (amount, amount - self.ADD_IDR):
+                windows.append((target - radius, target + radius))
+                for tax in self.TAX_TOLERANCES:
+                    windows.append(((target - radius) / (1 + tax), (target + radius) / (1 + tax)))
+        return windows
+
+    def multi_payment_amount_bound(self, invoice_amounts: List[float]) -> Optional[Tuple[float, float]]:
+        """(-inf, upper bound) of a payment that is one part of a multi payment match, None without multi matching.
+
+        A part is at most the largest invoice plus the tolerance when the other
+        parts are not negative. Any smaller payment could be a part, so there
+        is no lower bound; negative payments (refunds) are kept as well.
+        """
+        amounts = [a for a in invoice_amounts if a == a]
+        if self.MAX_COMBINATIONS < 2 or not amounts:
+            return None
+        radius = max(self.GENERAL_TOLERANCE, default=0) + 1
+        return (-float('inf'), max(amounts) + radius)
+
+    def multi_invoice_amount_windows(self, invoice_amounts: List[float], max_windows: int = 64) -> List[Tuple[float, float]]:
+        """Payment amount ranges a multi invoice match against these invoices needs.
+
+        The payment must be near the sum of 2 to MAX_COMBINATIONS invoices,
+        directly or before tax. The sums of each size are built from the merged
+        ranges of the size before, at most `max_windows` of them, so they only
+        ever widen: no group is missed, some payments no group matches are kept.
+        """
+        amounts = sorted({a for a in invoice_amounts if a == a})
+        if self.MAX_COMBINATIONS < 2 or not amounts:
+            return []
+        sums = merge_windows([(a, a) for a in amounts], max_windows)
+        group_sums = []
+        for _ in range(2, self.MAX_COMBINATIONS + 1):
+            sums = merge_windows([(low + a, high + a) for low, high in sums for a in amounts], max_windows)
+            group_sums.extend(sums)
+
+        radius = max(self.GENERAL_TOLERANCE, default=0) + 1
+        windows = []
+        for low, high in group_sums:
+            windows.append((low - radius, high + radius))
+            for tax in self.TAX_TOLERANCES:
+                windows.append(((low - 1) / (1 + tax), (high + 1) / (1 + tax)))
+        return windows
+
+    def payment_amount_windows(self, invoice_amounts: List[float], max_windows: int = 64) -> List[Tuple[float, float]]:
+        """Payment amount ranges that can take part in any match against these invoices.
+
+        The union of `single_match_amount_windows`,
+        `multi_payment_amount_bound` and `multi_invoice_amount_windows`, merged
+        down to `max_windows`. With multi matching on, every payment up to the
+        largest invoice is kept, since any of them could be one part of a multi
+        payment match; above it only payments near a single match or near the
+        sum of a group of invoices are. A multi payment match whose positive
+        part is larger than every invoice, offset by a negative part, is not
+        found. With MAX_COMBINATIONS at 1 only the single windows are left.
+        """
+        windows = self.single_match_amount_windows(invoice_amounts)
+        bound = self.multi_payment_amount_bound(invoice_amounts)
+        if bound is not None:
+            windows.append(bound)
+        windows.extend(self.multi_invoice_amount_windows(invoice_amounts, max_windows))
+        return merge_windows(windows, max_windows)
 
     def _evaluate_match(self, payment: Payment, invoice: Invoice) -> Optional[MatchResult]:
         """Evaluate a single payment to single invoice match"""
         """Evaluate a single payment-invoice match and return match details if valid"""
-        
+        self.evaluated += 1
+
+        payment_minor, invoice_minor = payment.amount_minor, invoice.amount_minor
+        if payment_minor is None or invoice_minor is None:
+            return None
+
         # Exact match (highest priority)
-        if payment.amount == invoice.amount:
+        if payment_minor == invoice_minor:
             return MatchResult(
                 payment=payment,
                 invoice=invoice,
@@ -146,8 +486,8 @@ class PaymentInvoiceMatcher:
 
         # Tax matches
         for tax in self.TAX_TOLERANCES:
-            amount_with_tax = payment.amount * (1 + tax)
-            if amount_with_tax == invoice.amount:
+            # the taxed amount rounded to the sen, as it would be invoiced
+            if to_minor_units(payment.amount * (1 + tax)) == invoice_minor:
                 return MatchResult(
                     payment=payment,
                     invoice=invoice,
@@ -157,7 +497,7 @@ class PaymentInvoiceMatcher:
                 )
 
         # 10K Rule
-        if invoice.amount == (payment.amount + self.ADD_IDR):
+        if invoice_minor == payment_minor + self.ADD_IDR * MINOR_UNITS:
             return MatchResult(
                 payment=payment,
                 invoice=invoice,
@@ -223,13 +563,15 @@ class PaymentInvoiceMatcher:
 
     def _evaluate_multi_payment_match(self, payments: List[Payment], invoice: Invoice, total_amount: float) -> Optional[MatchResult]:
         """Evaluate multiple payments to single invoice match"""
-        if total_amount == invoice.amount:
+        self.evaluated += 1
+        total_minor = sum(p.amount_minor for p in payments)
+        if total_minor == invoice.amount_minor:
             return MatchResult(
                 payment=list(payments),
                 invoice=invoice,
                 status="multi payment exact match",
                 difference=0.0,
-                score=950.0,  # Slightly lower than single payment exact match
+                score=MULTI_EXACT_SCORE,  # Slightly lower than single payment exact match
                 match_type='multi_payment'
             )
 
@@ -238,8 +580,7 @@ class PaymentInvoiceMatcher:
         
         # Tax matches
         for tax in self.TAX_TOLERANCES:
-            amount_with_tax = total_amount * (1 + tax)
-            if amount_with_tax == invoice.amount:
+            if to_minor_units(total_amount * (1 + tax)) == invoice.amount_minor:
                 return MatchResult(
                     payment=list(payments),
                     invoice=invoice,
@@ -253,7 +594,7 @@ class PaymentInvoiceMatcher:
         for tolerance in self.GENERAL_TOLERANCE:
             diff = abs(total_amount - invoice.amount)
             if diff <= tolerance:
-                score = 650.0 - diff  # Lower base score for multi-payment tolerance matches
+                score = MULTI_TOLERANCE_SCORE - diff  # Lower base score for multi-payment tolerance matches
                 return MatchResult(
                     payment=list(payments),
                     invoice=invoice,
@@ -267,13 +608,15 @@ class PaymentInvoiceMatcher:
 
     def _evaluate_multi_invoice_match(self, payment: Payment, invoices: List[Invoice], total_amount: float) -> Optional[MatchResult]:
         """Evaluate single payment to multiple invoice match"""
-        if payment.amount == total_amount:
+        self.evaluated += 1
+        total_minor = sum(i.amount_minor for i in invoices)
+        if payment.amount_minor == total_minor:
             return MatchResult(
                 payment=payment,
                 invoice=list(invoices),
                 status="multi invoice exact match",
                 difference=0.0,
-                score=950.0,  # Slightly lower than single invoice exact match
+                score=MULTI_EXACT_SCORE,  # Slightly lower than single invoice exact match
                 match_type='multi_invoice'
             )
 
@@ -282,8 +625,7 @@ class PaymentInvoiceMatcher:
         
         # Tax matches
         for tax in self.TAX_TOLERANCES:
-            amount_with_tax = payment.amount * (1 + tax)
-            if amount_with_tax == total_amount:
+            if to_minor_units(payment.amount * (1 + tax)) == total_minor:
                 return MatchResult(
                     payment=payment,
                     invoice=list(invoices),
@@ -297,7 +639,7 @@ class PaymentInvoiceMatcher:
         for tolerance in self.GENERAL_TOLERANCE:
             diff = abs(payment.amount - total_amount)
             if diff <= tolerance:
-                score = 650.0 - diff  # Lower base score for multi-invoice tolerance matches
+                score = MULTI_TOLERANCE_SCORE - diff  # Lower base score for multi-invoice tolerance matches
                 return MatchResult(
                     payment=payment,
                     invoice=list(invoices),
@@ -331,6 +673,7 @@ class PaymentInvoiceMatcher:
             "score": match_result.score,
             "type": 'single_match'
         })
+        self.match_sources.append(match_result.payment)
         self.used_payments.add(match_result.payment.external_id)
         self.used_invoices.add(match_result.invoice.invoice_id)
         
@@ -359,6 +702,8 @@ class PaymentInvoiceMatcher:
             "type": 'multi_payment'
         })
         
+        self.match_sources.append(match_result.invoice)
+
         # Mark all payments and the invoice as used
         for payment in match_result.payment:
             self.used_payments.add(payment.external_id)
@@ -389,54 +734,543 @@ class PaymentInvoiceMatcher:
             "type": 'multi_invoice'
         })
         
+        self.match_sources.append(match_result.payment)
+
         # Mark payment and all invoices as used
         self.used_payments.add(match_result.payment.external_id)
         for invoice in match_result.invoice:
             self.used_invoices.add(invoice.invoice_id)
 
-def match_payments_and_invoices(raw_payments: List[Dict], raw_invoices: List[Dict]) -> Dict:
-    """Main function to process raw data and return matches"""
+class VectorizedPaymentInvoiceMatcher(PaymentInvoiceMatcher):
+    """Matcher backend that scores 1:1 pairs with NumPy instead of per-pair Python calls.
+
+    Payment and invoice amounts/dates become float64/int64 arrays and every rule
+    from `_evaluate_match` is applied as a broadcasted operation over a
+    payment x invoice block, keeping the first rule that fires just like the
+    Python version. Blocks are tiled so the temporaries of one block stay under
+    `max_block_bytes`. The greedy assignment still walks payments in order and
+    takes the best-scoring unused invoice (lowest position on ties), so matches
+    are identical to `PaymentInvoiceMatcher`. Multi matches are inherited.
+    """
+
+    def __init__(self, max_combinations: int = 3, max_block_bytes: int = 64 * 1024 * 1024):
+        super().__init__(max_combinations=max_combinations)
+        self.max_block_bytes = max_block_bytes
+
+    def find_single_matches(self, payments: List[Payment], invoices: List[Invoice]):
+        """Find best 1:1 matches between payments and invoices"""
+        if not payments or not invoices:
+            return
+
+        payment_amounts = np.array([p.amount for p in payments], dtype=np.float64)
+        invoice_amounts = np.array([i.amount for i in invoices], dtype=np.float64)
+        payment_dates = np.array([p.date for p in payments], dtype='datetime64[us]').astype(np.int64)
+        invoice_dates = np.array([i.date for i in invoices], dtype='datetime64[us]').astype(np.int64)
+
+        rows, cols, scores = self._score_pairs(payment_amounts, invoice_amounts, payment_dates, invoice_dates)
+
+        # per payment: best score first, then earliest invoice position
+        order = np.lexsort((cols, -scores, rows))
+        rows, cols = rows[order], cols[order]
+        starts = np.searchsorted(rows, np.arange(len(payments)), side='left')
+        ends = np.searchsorted(rows, np.arange(len(payments)), side='right')
+        cols = cols.tolist()
+
+        for row, payment in enumerate(payments):
+            if payment.external_id in self.used_payments:
+                continue
+
+            for position in cols[starts[row]:ends[row]]:
+                invoice = invoices[position]
+                if invoice.invoice_id in self.used_invoices:
+                    continue
+                self._add_match(self._evaluate_match(payment, invoice))
+                break
+
+    def _score_pairs(self, payment_amounts: np.ndarray, invoice_amounts: np.ndarray,
+                     payment_dates: np.ndarray, invoice_dates: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(payment row, invoice column, score) of every pair some rule accepts"""
+        n_rules = 3 + len(self.TAX_TOLERANCES) + len(self.GENERAL_TOLERANCE) * (2 + 2 * len(self.TAX_TOLERANCES))
+        # each rule keeps a float64 score and a bool mask per cell
+        block_cells = max(1, self.max_block_bytes // (9 * n_rules + 16))
+        col_step = min(len(invoice_amounts), block_cells)
+        row_step = max(1, block_cells // col_step)
+
+        found_rows, found_cols, found_scores = [], [], []
+        for row_start in range(0, len(payment_amounts), row_step):
+            row_end = row_start + row_step
+            for col_start in range(0, len(invoice_amounts), col_step):
+                col_end = col_start + col_step
+                scores = self._score_block(payment_amounts[row_start:row_end], invoice_amounts[col_start:col_end])
+                self.evaluated += scores.size
+                scores[invoice_dates[None, col_start:col_end] > payment_dates[row_start:row_end, None]] = -np.inf
+
+                block_rows, block_cols = np.nonzero(scores > -np.inf)
+                found_rows.append(block_rows + row_start)
+                found_cols.append(block_cols + col_start)
+                found_scores.append(scores[block_rows, block_cols])
+
+        return np.concatenate(found_rows), np.concatenate(found_cols), np.concatenate(found_scores)
+
+    def _score_block(self, payment_amounts: np.ndarray, invoice_amounts: np.ndarray) -> np.ndarray:
+        """Score matrix of one block, -inf where no rule applies; mirrors `_evaluate_match` rule order"""
+        payment = payment_amounts[:, None]
+        invoice = invoice_amounts[None, :]
+        # whole sen as float64, exact well past any rupiah amount; NaN never compares equal
+        payment_minor = np.rint(payment * MINOR_UNITS)
+        invoice_minor = np.rint(invoice * MINOR_UNITS)
+        conditions, choices = [], []
+
+        # Exact match
+        conditions.append(payment_minor == invoice_minor)
+        choices.append(1000.0)
+
+        # Tax matches
+        for tax in self.TAX_TOLERANCES:
+            conditions.append(np.rint(payment * (1 + tax) * MINOR_UNITS) == invoice_minor)
+            choices.append(900.0 - np.abs(payment - invoice))
+
+        # 10K Rule
+        conditions.append(invoice_minor == payment_minor + self.ADD_IDR * MINOR_UNITS)
+        choices.append(800.0 - self.ADD_IDR)
+
+        # General Tolerances
+        diff = np.abs(payment - invoice)
+        diff_with_10k = np.abs(payment + self.ADD_IDR - invoice)
+        for tolerance in self.GENERAL_TOLERANCE:
+            conditions.append(diff <= tolerance)
+            choices.append(700.0 - diff)
+
+            for tax in self.TAX_TOLERANCES:
+                amount_with_tax = payment * (1 + tax)
+                diff_with_tax = np.abs(amount_with_tax - invoice)
+                conditions.append(diff_with_tax <= tolerance)
+                choices.append(600.0 - diff_with_tax)
+
+                diff_with_tax_and_10k = np.abs(amount_with_tax + self.ADD_IDR - invoice)
+                conditions.append(diff_with_tax_and_10k <= tolerance)
+                choices.append(500.0 - diff_with_tax_and_10k)
+
+            conditions.append(diff_with_10k <= tolerance)
+            choices.append(600.0 - diff_with_10k)
+
+        shape = (len(payment_amounts), len(invoice_amounts))
+        choices = [np.broadcast_to(choice, shape) for choice in choices]
+        return np.select(conditions, choices, default=-np.inf)
+
+def max_weight_assignment(weights: np.ndarray) -> List[Tuple[int, int]]:
+    """(row, column) pairs of a maximum-weight matching; zero weight means no edge.
+
+    Hungarian algorithm (shortest augmenting paths with potentials) on the
+    dense matrix, O(rows^2 * columns); meant for small components.
+    """
+    transposed = weights.shape[0] > weights.shape[1]
+    cost = -(weights.T if transposed else weights)
+    n, m = cost.shape
+
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    assigned_row = np.zeros(m + 1, dtype=np.int64)  # 1-based row assigned to column j, 0 if free
+    way = np.zeros(m + 1, dtype=np.int64)
+    for row in range(1, n + 1):
+        assigned_row[0] = row
+        column = 0
+        min_slack = np.full(m + 1, np.inf)
+        visited = np.zeros(m + 1, dtype=bool)
+        while True:
+            visited[column] = True
+            current_row = assigned_row[column]
+            reduced = cost[current_row - 1] - u[current_row] - v[1:]
+            free = ~visited[1:]
+            better = free & (reduced < min_slack[1:])
+            min_slack[1:][better] = reduced[better]
+            way[1:][better] = column
+            slack = np.where(free, min_slack[1:], np.inf)
+            next_column = int(np.argmin(slack)) + 1
+            delta = slack[next_column - 1]
+            u[assigned_row[visited]] += delta
+            v[visited] -= delta
+            min_slack[1:][free] -= delta
+            column = next_column
+            if assigned_row[column] == 0:
+                break
+        while column:
+            previous = way[column]
+            assigned_row[column] = assigned_row[previous]
+            column = previous
+
+    pairs = []
+    for column in range(1, m + 1):
+        row = assigned_row[column]
+        if row and weights[(column - 1, row - 1) if transposed else (row - 1, column - 1)] > 0:
+            pairs.append((column - 1, row - 1) if transposed else (row - 1, column - 1))
+    return pairs
+
+class OptimalPaymentInvoiceMatcher(PaymentInvoiceMatcher):
+    """Matcher backend that picks 1:1 matches by maximum total score instead of greedily.
+
+    Every (payment, invoice) pair `_evaluate_match` accepts becomes an edge of
+    a bipartite graph. Each connected component is solved on its own with a
+    max-weight assignment, so the solver only pays for the payments and
+    invoices that actually compete; components larger than `max_component`
+    on either side keep the greedy choice. Scores are shifted by
+    ASSIGNMENT_OFFSET so any valid pair is worth more than no pair. Multi
+    matches are inherited and run greedily on what is left.
+
+    `assignment_stats` reports the components, and how many single matches
+    differ from what the greedy matcher would have picked.
+    """
+
+    ASSIGNMENT_OFFSET = 20_000.0
+
+    def __init__(self, max_combinations: int = 3, max_component: int = 300):
+        super().__init__(max_combinations=max_combinations)
+        self.max_component = max_component
+        self.assignment_stats = empty_assignment_stats()
+
+    def find_single_matches(self, payments: List[Payment], invoices: List[Invoice]):
+        """Find the 1:1 matches with the highest total score"""
+        edges = self._single_edges(payments, invoices)
+        greedy = self._greedy_pairs(payments, invoices, edges)
+
+        # connected components over payment nodes (p) and invoice nodes (len(payments) + i)
+        parent = list(range(len(payments) + len(invoices)))
+        def find(node):
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+        for p, i, _ in edges:
+            parent[find(p)] = find(len(payments) + i)
+        components: Dict[int, List[Tuple[int, int, float]]] = {}
+        for edge in edges:
+            components.setdefault(find(edge[0]), []).append(edge)
+
+        chosen = []
+        stats = self.assignment_stats
+        for component in components.values():
+            rows = sorted({p for p, _, _ in component})
+            cols = sorted({i for _, i, _ in component})
+            stats['components'] += 1
+            stats['largest_component'] = max(stats['largest_component'], len(rows) + len(cols))
+            if len(component) == 1:
+                chosen.extend((p, i) for p, i, _ in component)
+                continue
+            if max(len(rows), len(cols)) > self.max_component:
+                stats['greedy_components'] += 1
+                component_payments = set(rows)
+                chosen.extend((p, i) for p, i in greedy if p in component_payments)
+                continue
+
+            stats['solved_components'] += 1
+            row_of = {p: k for k, p in enumerate(rows)}
+            col_of = {i: k for k, i in enumerate(cols)}
+            weights = np.zeros((len(rows), len(cols)))
+            for p, i, score in component:
+                weights[row_of[p], col_of[i]] = score + self.ASSIGNMENT_OFFSET
+            chosen.extend((rows[r], cols[c]) for r, c in max_weight_assignment(weights))
+
+        # report in payment order like the greedy matcher
+        for p, i in sorted(chosen):
+            payment, invoice = payments[p], invoices[i]
+            if payment.external_id in self.used_payments or invoice.invoice_id in self.used_invoices:
+                continue
+            self._add_match(self._evaluate_match(payment, invoice))
+
+        scores = {(p, i): score for p, i, score in edges}
+        optimal = {(p, i) for p, i in chosen}
+        stats['single_matches'] += len(optimal)
+        stats['greedy_single_matches'] += len(greedy)
+        stats['differs_from_greedy'] += len(optimal - set(greedy))
+        stats['score'] += sum(scores[pair] for pair in optimal)
+        stats['greedy_score'] += sum(scores[pair] for pair in greedy)
+
+    def _single_edges(self, payments: List[Payment], invoices: List[Invoice]) -> List[Tuple[int, int, float]]:
+        """(payment position, invoice position, score) of every pair `_evaluate_match` accepts"""
+        index = InvoiceAmountIndex(invoices)
+        edges = []
+        for p, payment in enumerate(payments):
+            if payment.external_id in self.used_payments:
+                continue
+            index.advance_to(payment.date)
+            for i in index.candidates(self._candidate_windows(payment)):
+                invoice = invoices[i]
+                if invoice.invoice_id in self.used_invoices or payment.date < invoice.date:
+                    continue
+                match_result = self._evaluate_match(payment, invoice)
+                if match_result:
+                    edges.append((p, i, match_result.score))
+        return edges
+
+    def _greedy_pairs(self, payments: List[Payment], invoices: List[Invoice],
+                      edges: List[Tuple[int, int, float]]) -> List[Tuple[int, int]]:
+        """The pairs PaymentInvoiceMatcher.find_single_matches would pick from these edges"""
+        by_payment: Dict[int, List[Tuple[float, int]]] = {}
+        for p, i, score in edges:
+            by_payment.setdefault(p, []).append((-score, i))
+        used_payments, used_invoices, pairs = set(), set(), []
+        for p in sorted(by_payment):
+            if payments[p].external_id in used_payments:
+                continue
+            for _, i in sorted(by_payment[p]):
+                if invoices[i].invoice_id not in used_invoices:
+                    pairs.append((p, i))
+                    used_payments.add(payments[p].external_id)
+                    used_invoices.add(invoices[i].invoice_id)
+                    break
+        return pairs
+
+def empty_phase_stats() -> Dict:
+    return {phase: {'seconds': 0.0, 'evaluated': 0, 'matches': 0, 'capped': 0} for phase in MATCH_PHASES}
+
+def merge_phase_stats(total: Dict, stats: Dict) -> Dict:
+    for phase, phase_stats in stats.items():
+        for key, value in phase_stats.items():
+            total[phase][key] += value
+    return total
+
+def empty_assignment_stats() -> Dict:
+    return {'components': 0, 'solved_components': 0, 'greedy_components': 0, 'largest_component': 0,
+            'single_matches': 0, 'greedy_single_matches': 0, 'differs_from_greedy': 0,
+            'score': 0.0, 'greedy_score': 0.0}
+
+def merge_assignment_stats(total: Dict, stats: Dict) -> Dict:
+    for key, value in stats.items():
+        total[key] = max(total[key], value) if key == 'largest_component' else total[key] + value
+    return total
+
+MATCHER_ENGINES = {
+    'index': PaymentInvoiceMatcher,
+    'vector': VectorizedPaymentInvoiceMatcher,
+    'optimal': OptimalPaymentInvoiceMatcher,
+}
+
+MATCH_PHASES = ['single_match', 'multi_payment', 'multi_invoice']
+
+def normalize_buyer_name(name: str) -> str:
+    """Key used to decide whether a payment buyer and an invoice partner are the same party"""
+    return normalize_name(name)
+
+def partition_buyer_blocks(payments: List[Payment], invoices: List[Invoice]) -> List[Tuple[List[int], List[int]]]:
+    """Group payment and invoice positions into independent blocks of related buyers.
+
+    A payment buyer and an invoice partner are related when their normalized
+    names are equal or, for a named invoice, one contains the other: the rule
+    /search uses to pick a buyer's invoices. Related names share a block, also
+    through a third name ('SINAR' joins 'SINAR JAYA' and 'SINAR ABADI'), so a
+    block can pair names /search would not; names related to none are never
+    matched together. Blocks without both a payment and an invoice cannot
+    produce a match and are dropped.
+    """
+    payment_names: Dict[str, List[int]] = {}
+    for position, payment in enumerate(payments):
+        payment_names.setdefault(normalize_buyer_name(payment.buyer_name), []).append(position)
+    invoice_names: Dict[str, List[int]] = {}
+    for position, invoice in enumerate(invoices):
+        invoice_names.setdefault(normalize_buyer_name(invoice.buyer_name), []).append(position)
+
+    # connected components over name nodes, a payment and an invoice name can be the same node
+    names = list(dict.fromkeys([*payment_names, *invoice_names]))
+    node = {name: k for k, name in enumerate(names)}
+    parent = list(range(len(names)))
+    def find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+    for buyer in payment_names:
+        for partner in invoice_names:
+            if buyer != partner and partner and (buyer in partner or partner in buyer):
+                parent[find(node[buyer])] = find(node[partner])
+
+    blocks: Dict[int, Tuple[List[int], List[int]]] = {}
+    for name, positions in payment_names.items():
+        blocks.setdefault(find(node[name]), ([], []))[0].extend(positions)
+    for name, positions in invoice_names.items():
+        blocks.setdefault(find(node[name]), ([], []))[1].extend(positions)
+    # positions stay in date order inside a block, as the matcher expects them
+    return [(sorted(block[0]), sorted(block[1])) for block in blocks.values() if block[0] and block[1]]
+
+# blocks with fewer payment x invoice pairs are matched in the calling process,
+# sending them to a worker costs more than matching them
+POOL_MIN_BLOCK_PAIRS = int(os.getenv('MATCHER_POOL_MIN_PAIRS', 10_000))
+
+_MATCHER_POOLS: Dict[Tuple[str, int], ProcessPoolExecutor] = {}
+_MATCHER_POOLS_LOCK = threading.Lock()
+
+def default_matcher_workers() -> int:
+    """MATCHER_WORKERS, else the CPUs this process may run on, at most 4"""
+    if os.getenv('MATCHER_WORKERS'):
+        return int(os.getenv('MATCHER_WORKERS'))
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        cpus = os.cpu_count() or 1
+    return min(4, cpus)
+
+def get_matcher_pool(workers: int, name: str = 'search') -> ProcessPoolExecutor:
+    """Process pool shared by every partitioned match with this name and worker count"""
+    # requests match concurrently from several threads, only one may create the pool
+    with _MATCHER_POOLS_LOCK:
+        if (name, workers) not in _MATCHER_POOLS:
+            # spawn, not fork: forking the threaded server could copy a lock held by another thread
+            _MATCHER_POOLS[name, workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return _MATCHER_POOLS[name, workers]
+
+def _match_block(payments: List[Payment], invoices: List[Invoice], payment_ranks: List[int], invoice_ranks: List[int],
+                 max_combinations: int, engine: str) -> Tuple[List[Tuple[Tuple[int, int], Dict]], Set[str], Set[str], Optional[Dict], Dict]:
+    """Match one buyer block; every match is keyed by (phase, global rank of the item it was found for)"""
+    matcher = MATCHER_ENGINES[engine](max_combinations=max_combinations)
+    matcher.find_matches(payments, invoices)
+
+    rank_of = {id(p): rank for p, rank in zip(payments, payment_ranks)}
+    rank_of.update({id(i): rank for i, rank in zip(invoices, invoice_ranks)})
+    keyed = [
+        ((MATCH_PHASES.index(match['type']), rank_of[id(source)]), match)
+        for match, source in zip(matcher.matches, matcher.match_sources)
+    ]
+    return keyed, matcher.used_payments, matcher.used_invoices, getattr(matcher, 'assignment_stats', None), matcher.phase_stats
+
+def find_matches_by_buyer(payments: List[Payment], invoices: List[Invoice], max_combinations: int = 3,
+                          engine: str = 'index', workers: Optional[int] = None,
+                          pool_name: str = 'search') -> Tuple[List[Dict], Set[str], Set[str], Optional[Dict], Dict]:
+    """Run the matcher per buyer block, in parallel on the `pool_name` pool when `workers` > 1.
+
+    Only blocks of at least POOL_MIN_BLOCK_PAIRS payment x invoice pairs go to
+    the pool; smaller ones, and every block of a single-block call, are matched
+    in this process. See `partition_buyer_blocks` for which buyers share a block.
+
+    Matches come back in the order a single matcher would report them: by
+    phase, then by the date order of the payment (or, for multi payment
+    matches, the invoice) they were found for. The last two values sum the
+    blocks' `assignment_stats` for the optimal engine (else None) and their
+    `phase_stats`; block times are summed even when blocks ran in parallel.
+    """
+    workers = workers or default_matcher_workers()
+
+    # global date order, the same stable sort find_matches applies
+    sorted_payments = sorted(payments, key=lambda x: x.date)
+    sorted_invoices = sorted(invoices, key=lambda x: x.date)
+
+    tasks = [
+        ([sorted_payments[p] for p in payment_ranks], [sorted_invoices[i] for i in invoice_ranks],
+         payment_ranks, invoice_ranks, max_combinations, engine)
+        for payment_ranks, invoice_ranks in partition_buyer_blocks(sorted_payments, sorted_invoices)
+    ]
+    # biggest blocks first so one large buyer does not start last
+    tasks.sort(key=lambda task: len(task[0]) * len(task[1]), reverse=True)
+
+    pooled = [task for task in tasks if len(task[0]) * len(task[1]) >= POOL_MIN_BLOCK_PAIRS]
+    if workers > 1 and len(tasks) > 1 and pooled:
+        pool = get_matcher_pool(workers, pool_name)
+        futures = [pool.submit(_match_block, *task) for task in pooled]
+        # the small blocks are matched here while the workers run the large ones
+        results = [_match_block(*task) for task in tasks[len(pooled):]]
+        results.extend(future.result() for future in futures)
+    else:
+        results = [_match_block(*task) for task in tasks]
+
+    keyed_matches = []
+    used_payments: Set[str] = set()
+    used_invoices: Set[str] = set()
+    assignment_stats = empty_assignment_stats() if engine == 'optimal' else None
+    phase_stats = empty_phase_stats()
+    for keyed, block_used_payments, block_used_invoices, block_stats, block_phase_stats in results:
+        keyed_matches.extend(keyed)
+        used_payments |= block_used_payments
+        used_invoices |= block_used_invoices
+        if block_stats:
+            merge_assignment_stats(assignment_stats, block_stats)
+        merge_phase_stats(phase_stats, block_phase_stats)
+
+    keyed_matches.sort(key=lambda keyed_match: keyed_match[0])
+    return [match for _, match in keyed_matches], used_payments, used_invoices, assignment_stats, phase_stats
+
+def match_payments_and_invoices(raw_payments: Union[List[Dict], pd.DataFrame], raw_invoices: Union[List[Dict], pd.DataFrame],
+                                max_combinations: int = 3, engine: str = 'index',
+                                partition_by_buyer: bool = False, workers: Optional[int] = None,
+                                pool_name: str = 'search') -> Dict:
+    """Main function to process raw data and return matches
+
+    Payments and invoices can be lists of records or the DataFrames returned by
+    `search_payment`/`search_invoice`; DataFrames are parsed column-wise.
+    `engine` picks the matcher backend, see MATCHER_ENGINES; 'optimal' also
+    returns its `assignment` stats. `phases` holds the time, rows or
+    evaluated candidates and matches of parsing and each matcher phase. With
+    `partition_by_buyer` a payment is only matched against invoices of related
+    buyer names (see `partition_buyer_blocks`) and the buyer blocks run on `workers` processes
+    (default MATCHER_WORKERS, else the available CPUs up to 4) of the
+    process pool named `pool_name`, so background work can keep its own.
+    """
+    if engine not in MATCHER_ENGINES:
+        raise ValueError(f"Unknown matcher engine '{engine}', expected one of {list(MATCHER_ENGINES)}")
+
     # Parse the data
-    payments = [parse_payment(p) for p in raw_payments]
-    invoices = [parse_invoice(i) for i in raw_invoices]
+    parse_start = time.perf_counter()
+    if isinstance(raw_payments, pd.DataFrame):
+        payments = parse_payments_frame(raw_payments)
+    else:
+        payments = [parse_payment(p) for p in raw_payments]
+
+    if isinstance(raw_invoices, pd.DataFrame):
+        invoices = parse_invoices_frame(raw_invoices)
+    else:
+        invoices = [parse_invoice(i) for i in raw_invoices]
+    parse_stats = {'seconds': time.perf_counter() - parse_start, 'rows': len(payments) + len(invoices)}
     
     # Create matcher and find matches
-    matcher = PaymentInvoiceMatcher()
-    matcher.find_matches(payments, invoices)
+    if partition_by_buyer:
+        matches, used_payments, used_invoices, assignment_stats, phase_stats = find_matches_by_buyer(
+            payments, invoices, max_combinations=max_combinations, engine=engine, workers=workers,
+            pool_name=pool_name
+        )
+    else:
+        matcher = MATCHER_ENGINES[engine](max_combinations=max_combinations)
+        matcher.find_matches(payments, invoices)
+        matches, used_payments, used_invoices = matcher.matches, matcher.used_payments, matcher.used_invoices
+        assignment_stats = getattr(matcher, 'assignment_stats', None)
+        phase_stats = matcher.phase_stats
     
     # Get unmatched items
     unmatched_payments = [
         {"external_id": p.external_id, "amount": p.amount}
         for p in payments 
-        if p.external_id not in matcher.used_payments
+        if p.external_id not in used_payments
     ]
     
     unmatched_invoices = [
         {"invoice_id": i.invoice_id, "amount": i.amount}
         for i in invoices 
-        if i.invoice_id not in matcher.used_invoices
+        if i.invoice_id not in used_invoices
     ]
     
-    return {
-        "matches": matcher.matches,
+    result = {
+        "matches": matches,
         "unmatched_payments": unmatched_payments,
         "unmatched_invoices": unmatched_invoices
     }
+    if assignment_stats is not None:
+        result["assignment"] = assignment_stats
+    result["phases"] = {"parse": parse_stats, **phase_stats}
+    return result
 
-def parse_payment(raw_payment: Dict) -> Payment:
-    """Convert raw payment data to Payment object"""
-    date_str = raw_payment['created_at'].replace('Z', '+00:00')
+def parse_payment_date(created_at: str) -> datetime:
+    """Payment created_at as a naive UTC datetime"""
+    date_str = created_at.replace('Z', '+00:00')
     try:
         date = datetime.fromisoformat(date_str)
         date = date.astimezone(timezone.utc)
         date = date.replace(tzinfo=None)
     except ValueError:
         date = datetime.fromisoformat(date_str.split('+')[0])
+    return date
 
+def parse_payment(raw_payment: Dict) -> Payment:
+    """Convert raw payment data to Payment object"""
     return Payment(
         external_id=raw_payment['external_id'],
         amount=float(raw_payment['amount.grand_total']),
-        date=date,
+        date=parse_payment_date(raw_payment['created_at']),
         company_id=raw_payment['company_id'],
         buyer_name=raw_payment['buyer_name']
     )
@@ -455,4 +1289,51 @@ def parse_invoice(raw_invoice: Dict) -> Invoice:
         buyer_name=raw_invoice['name'],
         top=int(raw_invoice['top']),
         invoice_status=raw_invoice['invoice_status']
-    )
\ No newline at end of file
+    )
+
+def parse_payments_frame(payment: pd.DataFrame) -> List[Payment]:
+    """Convert a `search_payment`/`search_by_external_id` frame to Payment objects column-wise"""
+    if payment.empty:
+        return []
+
+    created_at = payment['created_at'].astype(str)
+    dates = pd.to_datetime(created_at, utc=True, format='ISO8601', errors='coerce').dt.tz_convert(None)
+    # whatever pandas could not read goes through the per-row parser
+    dates = [
+        parse_payment_date(raw) if pd.isna(date) else date
+        for date, raw in zip(dates.dt.to_pydatetime().tolist(), created_at.tolist())
+    ]
+
+    return [
+        Payment(external_id=external_id, amount=amount, date=date, company_id=company_id, buyer_name=buyer_name)
+        for external_id, amount, date, company_id, buyer_name in zip(
+            payment['external_id'].astype(str).tolist(),
+            pd.to_numeric(payment['amount.grand_total']).astype(float).tolist(),
+            dates,
+            payment['company_id'].astype(str).tolist(),
+            payment['buyer_name'].astype(str).tolist(),
+        )
+    ]
+
+def parse_invoices_frame(invoice: pd.DataFrame) -> List[Invoice]:
+    """Convert a `search_invoice`/`search_by_invoice` frame to Invoice objects column-wise"""
+    if invoice.empty:
+        return []
+
+    dates = pd.to_datetime(invoice['invoice_date']).dt.normalize().dt.to_pydatetime().tolist()
+    due_dates = pd.to_datetime(invoice['due_date']).dt.normalize().dt.to_pydatetime().tolist()
+
+    return [
+        Invoice(invoice_id=invoice_id, amount=amount, date=date, due_date=due_date, company_id=company_id,
+                buyer_name=buyer_name, top=top, invoice_status=invoice_status)
+        for invoice_id, amount, date, due_date, company_id, buyer_name, top, invoice_status in zip(
+            invoice['invoice_number'].astype(str).tolist(),
+            pd.to_numeric(invoice['grandTotalUnformatted']).astype(float).tolist(),
+            dates,
+            due_dates,
+            invoice['company_id'].astype(str).tolist(),
+            invoice['name'].astype(str).tolist(),
+            pd.to_numeric(invoice['top']).astype('int64').tolist(),
+            invoice['invoice_status'].astype(str).tolist(),
+        )
+    ]
@@ -0,0 +1,60 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# legal-entity forms that say nothing about who the party is
+LEGAL_PREFIXES = {'PT', 'CV', 'UD', 'PD', 'FA'}
+LEGAL_SUFFIXES = {'TBK', 'PT', 'CV', 'PERSERO'}
+
+def normalize_name(name) -> str:
+    """Buyer/partner name without casing, punctuation and legal-entity affixes.
+
+    'PT. Sinar Jaya, Tbk', 'sinar jaya' and 'CV Sinar-Jaya' all become 'SINAR JAYA'.
+    """
+    name = re.sub(r'[^0-9A-Z ]+', ' ', str(name).upper())
+    name = re.sub(r'\bP T\b', 'PT', name)  # P.T.
+    tokens = name.split()
+    while len(tokens) > 1 and tokens[0] in LEGAL_PREFIXES:
+        tokens = tokens[1:]
+    while len(tokens) > 1 and tokens[-1] in LEGAL_SUFFIXES:
+        tokens = tokens[:-1]
+    return ' '.join(tokens)
+
+def group_by_normalized_name(names) -> dict:
+    """{normalized name: lower-cased names that normalize to it}; names without a key are left out"""
+    groups = {}
+    for name in names:
+        key = normalize_name(name)
+        if key:
+            groups.setdefault(key, [])
+            if str(name).lower() not in groups[key]:
+                groups[key].append(str(name).lower())
+    return groups
+
+class NameIndex:
+    """Rows of a name column grouped by normalized name.
+
+    `mask(buyer_name)` marks the rows whose normalized name contains the
+    normalized buyer name or is contained in it. The scan runs once per
+    distinct normalized name and its result is kept per buyer. Rows without a
+    name never match.
+    """
+
+    def __init__(self, names):
+        codes, uniques = pd.factorize(pd.Series(names, dtype=object).fillna(''), sort=False)
+        normalized = [normalize_name(name) for name in uniques]
+        keys, key_codes = np.unique(np.array(normalized, dtype=object), return_inverse=True) if normalized else ([], [])
+        self.keys = list(keys)
+        self.row_keys = np.asarray(key_codes, dtype=np.int64)[codes] if len(codes) else np.zeros(0, dtype=np.int64)
+        self.memo = {}
+
+    def key_codes(self, buyer_name):
+        buyer = normalize_name(buyer_name)
+        if buyer not in self.memo:
+            self.memo[buyer] = np.array([code for code, key in enumerate(self.keys) if key and (buyer in key or key in buyer)],
+                                        dtype=np.int64)
+        return self.memo[buyer]
+
+    def mask(self, buyer_name):
+        return np.isin(self.row_keys, self.key_codes(buyer_name))
@@ -0,0 +1,160 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+import pandas as pd
+
+from .cache import CACHES
+
+class CompanyPayments:
+    """Payments of one company created on or after `covered_from`"""
+
+    def __init__(self, frame, covered_from):
+        self.frame = frame
+        self.covered_from = covered_from
+        self.watermark = latest_change(frame)
+        self.refreshed_at = time.monotonic()
+        self.loaded_at = self.refreshed_at
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+class PaymentStore:
+    """In-memory payment history per company, refreshed incrementally.
+
+    The first request for a company pulls every payment since its start date.
+    Later requests only pull payments created or updated after the newest
+    `created_at`/`updated_at` already held (minus `overlap` for late writes)
+    and upsert them by `_key`; an earlier start date pulls just the missing
+    older range. Changed rows with `deleted_at` set are dropped. Payments
+    removed from Arango outright leave no trace to pull, so a company held
+    longer than `max_age` seconds is pulled whole again. Windows are then cut
+    from memory. Least recently used companies are evicted once the held
+    frames exceed `max_bytes`.
+
+    `pull(company_id, start_date=None, end_date=None, changed_since=None)`
+    returns the payment frame for one query, including `_key` and
+    `deleted_at`. Without `changed_since` deleted payments are left out.
+    """
+
+    def __init__(self, pull, max_bytes, refresh_interval=0.0, max_age=3600.0, overlap=timedelta(minutes=5)):
+        self.pull = pull
+        self.max_bytes = max_bytes
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.overlap = overlap
+
+        self.companies = OrderedDict()  # company_id -> CompanyPayments, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.backfills = 0
+        self.refreshes = 0
+        self.refreshed_rows = 0
+        self.reloads = 0
+        self.evictions = 0
+        CACHES['payments'] = self
+
+    def window(self, company_id, start_date):
+        """Payments of `company_id` with created_at >= start_date"""
+        with self.lock:
+            entry = self.companies.get(company_id)
+            if entry is None:
+                entry = self.companies[company_id] = CompanyPayments(None, None)
+            self.companies.move_to_end(company_id)
+
+        # one fetch per company at a time, other companies are not blocked
+        with entry.lock:
+            if entry.frame is not None and time.monotonic() - entry.loaded_at >= self.max_age:
+                self._count('reloads')
+                entry.frame = None
+                start_date = min(start_date, entry.covered_from)
+            if entry.frame is None:
+                self._count('misses')
+                entry.frame = self.pull(company_id, start_date=start_date)
+                entry.covered_from = start_date
+                entry.watermark = latest_change(entry.frame)
+                entry.refreshed_at = entry.loaded_at = time.monotonic()
+            else:
+                self._count('hits')
+                if start_date < entry.covered_from:
+                    self._count('backfills')
+                    older = self.pull(company_id, start_date=start_date, end_date=entry.covered_from)
+                    entry.frame = upsert(older, entry.frame)
+                    entry.covered_from = start_date
+                if time.monotonic() - entry.refreshed_at >= self.refresh_interval:
+                    self._refresh(company_id, entry)
+
+            frame = entry.frame
+            entry.nbytes = int(frame.memory_usage(deep=True).sum())
+
+        self._evict(keep=company_id)
+        return frame[frame['created_at'].fillna('') >= start_date]
+
+    def _refresh(self, company_id, entry):
+        changed_since = None
+        if entry.watermark:
+            changed_since = (pd.Timestamp(entry.watermark) - self.overlap).strftime('%Y-%m-%dT%H:%M:%S')
+        changed = self.pull(company_id, start_date=entry.covered_from, changed_since=changed_since)
+
+        self._count('refreshes')
+        self._count('refreshed_rows', len(changed))
+        if not changed.empty:
+            entry.watermark = max(entry.watermark or '', latest_change(changed) or '') or None
+            # deleted payments leave the store
+            deleted = changed['deleted_at'].notna()
+            entry.frame = upsert(entry.frame, changed[~deleted])
+            entry.frame = entry.frame[~entry.frame['_key'].isin(changed.loc[deleted, '_key'])].reset_index(drop=True)
+        entry.refreshed_at = time.monotonic()
+
+    def _count(self, name, value=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def _evict(self, keep):
+        with self.lock:
+            total = sum(entry.nbytes for entry in self.companies.values())
+            for company_id in list(self.companies):
+                if total <= self.max_bytes:
+                    break
+                if company_id == keep:
+                    continue
+                total -= self.companies.pop(company_id).nbytes
+                self.evictions += 1
+
+    def invalidate(self, company_ids=None):
+        with self.lock:
+            for company_id in list(self.companies) if company_ids is None else company_ids:
+                self.companies.pop(company_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'companies': len(self.companies),
+                'rows': sum(len(e.frame) for e in self.companies.values() if e.frame is not None),
+                'bytes': sum(e.nbytes for e in self.companies.values()),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'backfills': self.backfills,
+                'refreshes': self.refreshes,
+                'refreshed_rows': self.refreshed_rows,
+                'reloads': self.reloads,
+                'evictions': self.evictions,
+            }
+
+def latest_change(frame):
+    """Newest created_at/updated_at in the frame, as stored"""
+    if frame is None or frame.empty:
+        return None
+    stamps = pd.concat([frame['created_at'], frame['updated_at']]).dropna().astype(str)
+    return stamps.max() if not stamps.empty else None
+
+def upsert(frame, changed):
+    """`frame` with the rows of `changed` added or replacing the rows with the same _key"""
+    if frame.empty:
+        return changed.reset_index(drop=True)
+    if changed.empty:
+        return frame
+    kept = frame[~frame['_key'].isin(changed['_key'])]
+    return pd.concat([kept, changed], ignore_index=True)
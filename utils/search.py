@@ -1,12 +1,143 @@
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import zip_longest
+import json
+import os
+import time
+import uuid
+import numpy as np
 import pandas as pd
+from .cache import TTLCache
 from .connections import *
-from .multi_search import match_payments_and_invoices
+from .payment_store import PaymentStore
+from .invoice_store import InvoiceStore
+from .singleflight import SingleFlight
+from .batcher import LookupBatcher
+from .writeback import ReconciliationWriter
+from .names import NameIndex, group_by_normalized_name, normalize_name
+from . import diagnostics
+from .multi_search import PaymentInvoiceMatcher, match_payments_and_invoices
+
+PAYMENT_COLUMNS = [ 'created_at', 'updated_at', 'company_id',
+        'external_id', 'buyer_name',
+       'supplier_name', 'status', 
+       'amount.buyer_fee_amount', 'amount.cashback_amount',
+       'amount.discount_amount', 'amount.grand_total', 'amount.sub_total',
+       'amount.supplier_fee_amount']
+
+# only the payment fields the matcher and the result rows use
+PAYMENT_PROJECTION = """{
+        _key: i._key, created_at: i.created_at, updated_at: i.updated_at, deleted_at: i.deleted_at, company_id: i.company_id,
+        external_id: i.external_id, buyer_name: i.buyer_name, supplier_name: i.supplier_name, status: i.status,
+        amount: KEEP(i.amount, 'buyer_fee_amount', 'cashback_amount', 'discount_amount',
+                     'grand_total', 'sub_total', 'supplier_fee_amount')
+    }"""
+
+def payment_amount_filter(amount_windows):
+    """AQL condition keeping payments whose grand total falls in any (low, high) window"""
+    if amount_windows is None:
+        return ''
+    if not amount_windows:
+        return 'and false'
+
+    conditions = []
+    for low, high in amount_windows:
+        bounds = []
+        if low != float('-inf'):
+            bounds.append(f"i.amount.grand_total >= {float(low)!r}")
+        if high != float('inf'):
+            bounds.append(f"i.amount.grand_total <= {float(high)!r}")
+        conditions.append(f"({' and '.join(bounds) or 'true'})")
+    return f"and ({' or '.join(conditions)})"
+
+INVOICE_COLUMNS = ['name', 'invoice_number', 'invoice_date', 'deleted_at', 'due_date', 'invoice_status',
+       'company_id', 'document_type_id', 'grandTotalUnformatted']
+
+# invoice rows per invoice number for search_by_invoice; [] means no open invoice with that number
+INVOICE_NUMBER_CACHE = TTLCache('invoices_by_number',
+                                ttl=float(os.getenv('INVOICE_CACHE_TTL', 60)),
+                                maxsize=int(os.getenv('INVOICE_CACHE_SIZE', 100_000)))
+
+# invoice_reconciliations rows per ('invoice_number' | 'external_id', id); [] means not reconciled yet
+RECONCILIATION_CACHE = TTLCache('invoice_reconciliations',
+                                ttl=float(os.getenv('RECON_CACHE_TTL', 300)),
+                                maxsize=int(os.getenv('RECON_CACHE_SIZE', 100_000)))
+RECON_CACHE_NEGATIVE_TTL = float(os.getenv('RECON_CACHE_NEGATIVE_TTL', 60))
+
+# concurrent requests for the same rows wait on one backend fetch
+PAYMENT_FLIGHTS = SingleFlight('inflight_payments')
+INVOICE_FLIGHTS = SingleFlight('inflight_invoices')
+EXTERNAL_ID_FLIGHTS = SingleFlight('inflight_external_ids')
+RECONCILIATION_FLIGHTS = SingleFlight('inflight_reconciliations')
+
+# id lookups of concurrent requests collected for this long go out as one query, 0 disables batching
+LOOKUP_BATCH_WINDOW = float(os.getenv('LOOKUP_BATCH_WINDOW_MS', 0)) / 1000
+LOOKUP_BATCH_MAX_KEYS = int(os.getenv('LOOKUP_BATCH_MAX_KEYS', 1000))
+
+# big id lists are queried in chunks of at most this many ids, a few chunks at a time
+MYSQL_IN_CHUNK = int(os.getenv('MYSQL_IN_CHUNK', 1000))
+ARANGO_IN_CHUNK = int(os.getenv('ARANGO_IN_CHUNK', 1000))
+BQ_IN_CHUNK = int(os.getenv('BQ_IN_CHUNK', 10000))
+CHUNK_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('LOOKUP_CHUNK_WORKERS', 4)),
+                                    thread_name_prefix='search-chunk')
+
+def sql_in(values):
+    """SQL list literal for an IN clause, also for a single value"""
+    return f"({', '.join(repr(str(i)) for i in values)})"
+
+def chunked(values, size):
+    values = list(values)
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+def pull_chunks(pull, chunks):
+    """pull(chunk) for every chunk on CHUNK_EXECUTOR, concatenated in chunk order"""
+    if len(chunks) == 1:
+        return pull(chunks[0])
+    frames = list(CHUNK_EXECUTOR.map(diagnostics.bind(pull), chunks))
+    return pd.concat(frames, ignore_index=True)
+
+# matcher backend of search_datav2, 'optimal' solves single matches globally instead of greedily
+MATCHER_ENGINE = os.getenv('MATCHER_ENGINE', 'index')
+
+# runs the per-company fetch+match units of search_datav2
+COMPANY_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('SEARCH_COMPANY_WORKERS', 16)),
+                                      thread_name_prefix='search-company')
 
 #FROM INVOICE NUMBER
 def search_by_invoice(list_invoice_number):
-    list_invoice_number = tuple(list_invoice_number) if len(list_invoice_number)>1 else f"('{list_invoice_number[0]}')"
-    
+    #dari INVOICE_NUMBER_CACHE, hanya nomor yang belum ada yang ditarik dari MySQL
+    numbers = list(dict.fromkeys(list_invoice_number))
+    rows = {}
+    missing = []
+    for number in numbers:
+        cached = INVOICE_NUMBER_CACHE.get(number)
+        if cached is None:
+            missing.append(number)
+        else:
+            rows[number] = cached
+
+    if missing:
+        fetched = INVOICE_NUMBER_BATCHER.get(missing)
+        found = {number: [] for number in missing}
+        for row in fetched.to_dict(orient = 'records'):
+            found.setdefault(row['invoice_number'], []).append(row)
+        for number, number_rows in found.items():
+            INVOICE_NUMBER_CACHE.set(number, number_rows)
+        rows.update(found)
+
+    data_invoice = pd.DataFrame([row for number in numbers for row in rows.get(number, [])], columns = INVOICE_COLUMNS)
+    data_invoice = data_invoice.sort_values(['invoice_date', 'due_date'], kind='stable').reset_index(drop=True)
+    try:
+        data_invoice['top'] = data_invoice.apply(lambda s: (s['due_date'] - s['invoice_date']).days, axis=1)
+    except:
+        data_invoice['top'] = None
+
+    return data_invoice  
+
+def pull_invoices_by_number(list_invoice_number):
+    return pull_chunks(pull_invoice_number_chunk, chunked(list_invoice_number, MYSQL_IN_CHUNK))
+
+def pull_invoice_number_chunk(list_invoice_number):
     query = f"""select partners.name, invoices.number invoice_number, invoices.invoice_date, invoices.deleted_at, invoices.due_date, invoices.status invoice_status,
     invoices.company_id, invoices.document_type_id, invoice_totals.grandTotalUnformatted
     from invoices 
@@ -18,39 +149,90 @@ def search_by_invoice(list_invoice_number):
     where 
     invoices.company_id = '74e5d47e-5b78-4921-9058-054704d2ed22'
     and invoice_date >='2024-01-01'
-    and invoices.number IN {list_invoice_number}
+    and invoices.number IN {sql_in(list_invoice_number)}
     and invoices.deleted_at is null
     and invoices.status in (0,3)
     order by invoice_date , due_date
     """
 
     print(query)
-    data_invoice = MySQL.to_pull_data(query) 
-    try:
-        data_invoice['top'] = data_invoice.apply(lambda s: (s['due_date'] - s['invoice_date']).days, axis=1)
-    except:
-        data_invoice['top'] = None
+    with mysql_client() as MySQL:
+        data_invoice = MySQL.to_pull_data(query)
+    diagnostics.count('mysql', queries=1)
+    return data_invoice
 
-    return data_invoice  
+INVOICE_NUMBER_BATCHER = LookupBatcher('batch_invoice_numbers', pull_invoices_by_number, 'invoice_number',
+                                       window=LOOKUP_BATCH_WINDOW, max_keys=LOOKUP_BATCH_MAX_KEYS)
+
+def search_payment(start_date:str, company_id:list, amount_windows:list = None):
+    """Payments of one company since start_date, only those inside `amount_windows` if given.
+
+    Without PAYMENT_STORE the windows become an AQL filter. With the store
+    the company history is pulled whole and kept for every request, so the
+    windows are only applied to the rows in memory.
+    """
+    #kalau request lain sedang menarik window yang sama atau lebih lebar, tunggu hasilnya saja
+    windows = None if PAYMENT_STORE is not None or amount_windows is None else tuple(map(tuple, amount_windows))
+    prt = PAYMENT_FLIGHTS.do(
+        (company_id, start_date, windows),
+        lambda: fetch_payments(company_id, start_date, amount_windows),
+        covers=lambda key: key[0] == company_id and key[1] <= start_date and key[2] in (None, windows),
+    )
+
+    prt = prt[prt['created_at'].fillna('') >= start_date]
+    if amount_windows is not None:
+        prt = filter_amount_windows(prt, amount_windows)
+    return prt[PAYMENT_COLUMNS].reset_index(drop=True)
+
+def fetch_payments(company_id, start_date, amount_windows=None):
+    if PAYMENT_STORE is not None:
+        #dari memory, hanya perubahan terbaru yang ditarik dari Arango
+        return PAYMENT_STORE.window(company_id, start_date)
+    return pull_payments(company_id, start_date=start_date, amount_windows=amount_windows)
+
+def pull_payments(company_id, start_date=None, end_date=None, changed_since=None, amount_windows=None):
+    """Payments of one company from Arango, including `_key` and `deleted_at`.
+
+    With `changed_since` deleted payments are returned too, so the store can drop them.
+    """
+    filters = [f"filter i.company_id == '{company_id}'"]
+    if start_date:
+        filters.append(f"and i.created_at >= '{start_date}'")
+    if end_date:
+        filters.append(f"and i.created_at < '{end_date}'")
+    if changed_since:
+        filters.append(f"and (i.created_at >= '{changed_since}' or i.updated_at >= '{changed_since}')")
+    else:
+        filters.append("and i.deleted_at == null")
+    filters.append(payment_amount_filter(amount_windows))
+    filters = '\n    '.join(f for f in filters if f)
 
-def search_payment(start_date:str, company_id:list):
-    list_columns = [ 'created_at', 'updated_at', 'company_id',
-        'external_id', 'buyer_name',
-       'supplier_name', 'status', 
-       'amount.buyer_fee_amount', 'amount.cashback_amount',
-       'amount.discount_amount', 'amount.grand_total', 'amount.sub_total',
-       'amount.supplier_fee_amount']
-    
     query = f"""for i in payment_reconciliation_transactions
-    filter i.company_id == '{company_id}'
-    and i.created_at >= '{start_date}'
-    return i"""
-    prt =  ArangoDB.to_pull_data('paper_payment',query, batch_size = 1000000)
-    
+    {filters}
+    return {PAYMENT_PROJECTION}"""
+    with arangodb_client() as ArangoDB:
+        prt =  ArangoDB.to_pull_data('paper_payment',query, batch_size = 1000000)
+    diagnostics.count('arango', queries=1)
+
     if prt.empty:
-        return pd.DataFrame(columns = list_columns)
-    
-    return prt[list_columns]
+        return pd.DataFrame(columns = ['_key', 'deleted_at'] + PAYMENT_COLUMNS)
+
+    return prt[['_key', 'deleted_at'] + PAYMENT_COLUMNS]
+
+def filter_amount_windows(prt, amount_windows):
+    amounts = pd.to_numeric(prt['amount.grand_total'], errors='coerce')
+    keep = pd.Series(False, index=prt.index)
+    for low, high in amount_windows:
+        keep |= amounts.between(low, high)
+    return prt[keep]
+
+# per-company payment history kept in memory, every worker holds its own copy so it is opt-in
+PAYMENT_STORE = PaymentStore(
+    pull_payments,
+    max_bytes=int(os.getenv('PAYMENT_STORE_MAX_BYTES', 128 * 1024 * 1024)),
+    refresh_interval=float(os.getenv('PAYMENT_STORE_REFRESH_SECONDS', 0)),
+    max_age=float(os.getenv('PAYMENT_STORE_MAX_AGE_SECONDS', 3600)),
+) if os.getenv('PAYMENT_STORE_ENABLED', '0') == '1' else None
 
 #FROM EXTERNAL ID
 def search_by_external_id(list_external_id):
@@ -62,19 +244,79 @@ def search_by_external_id(list_external_id):
        'amount.discount_amount', 'amount.grand_total', 'amount.sub_total',
        'amount.supplier_fee_amount']
     
-    query = f"""for i in payment_reconciliation_transactions
-    filter i.external_id IN {list_external_id}
-    return i"""
-    prt =  ArangoDB.to_pull_data('paper_payment',query, batch_size = 1000000)
+    #request lain yang sedang menarik semua external_id ini ditunggu saja
+    ids = frozenset(list_external_id)
+    prt = EXTERNAL_ID_FLIGHTS.do(
+        ids,
+        lambda: EXTERNAL_ID_BATCHER.get(list_external_id),
+        covers=lambda key: ids <= key,
+    )
+    prt = prt[prt['external_id'].isin(ids)]
     
     if prt.empty:
         return pd.DataFrame(columns = list_columns)
     
     return prt[list_columns]
 
+def pull_by_external_id(list_external_id):
+    return pull_chunks(pull_external_id_chunk, chunked(list_external_id, ARANGO_IN_CHUNK))
+
+def pull_external_id_chunk(list_external_id):
+    query = f"""for i in payment_reconciliation_transactions
+    filter i.external_id IN {list(list_external_id)}
+    return {PAYMENT_PROJECTION}"""
+    with arangodb_client() as ArangoDB:
+        prt =  ArangoDB.to_pull_data('paper_payment',query, batch_size = 1000000)
+    diagnostics.count('arango', queries=1)
+
+    if prt.empty:
+        return pd.DataFrame(columns = PAYMENT_COLUMNS)
+    return prt
+
+EXTERNAL_ID_BATCHER = LookupBatcher('batch_external_ids', pull_by_external_id, 'external_id',
+                                    window=LOOKUP_BATCH_WINDOW, max_keys=LOOKUP_BATCH_MAX_KEYS)
+
 def search_invoice(company_id, list_partner_name, start_date, end_date):
+    #kalau request lain sedang menarik partner yang sama untuk rentang yang mencakup ini, tunggu hasilnya saja
+    partner_names = tuple(i.lower() for i in list_partner_name)
+    data_invoice = INVOICE_FLIGHTS.do(
+        (company_id, partner_names, start_date, end_date),
+        lambda: fetch_invoices(company_id, list_partner_name, start_date, end_date),
+        covers=lambda key: key[:2] == (company_id, partner_names) and key[2] <= start_date and key[3] >= end_date,
+    )
+
+    in_range = pd.to_datetime(data_invoice['invoice_date']).between(start_date, end_date)
+    data_invoice = data_invoice[in_range].reset_index(drop=True)
+    try:
+        data_invoice['top'] = data_invoice.apply(lambda s: (s['due_date'] - s['invoice_date']).days, axis=1)
+    except:
+        data_invoice['top'] = None
+
+    return data_invoice  
+
+def fetch_invoices(company_id, list_partner_name, start_date, end_date):
+    if INVOICE_STORE is not None:
+        #dari memory, hanya rentang tanggal yang belum ada yang ditarik dari MySQL
+        data_invoice = INVOICE_STORE.window(company_id, list_partner_name, start_date, end_date)
+        return data_invoice.reindex(columns = INVOICE_COLUMNS)
+    return pull_invoices(company_id, list_partner_name, start_date, end_date)[INVOICE_COLUMNS]
+
+def pull_invoices(company_id, list_partner_name, start_date, end_date, changed_since=None):
+    """Invoices of these partners from MySQL, including `invoice_uuid` and `updated_at`.
+
+    With `changed_since` only invoices updated since then are returned, whatever
+    their status or deleted_at, so a cached copy can drop closed invoices.
+    """
+    partner_names = sql_in(i.lower() for i in list_partner_name)
+    if changed_since:
+        filter_state = f"and invoices.updated_at >= '{changed_since}'"
+    else:
+        filter_state = """and invoices.deleted_at is null
+    and invoices.status in (0,3)"""
+
     query = f"""select partners.name, invoices.number invoice_number, invoices.invoice_date, invoices.deleted_at, invoices.due_date, invoices.status invoice_status,
-    invoices.company_id, invoices.document_type_id, invoice_totals.grandTotalUnformatted
+    invoices.company_id, invoices.document_type_id, invoice_totals.grandTotalUnformatted,
+    invoices.uuid invoice_uuid, invoices.updated_at
     from invoices 
     JOIN invoice_totals
     ON invoices.uuid = invoice_totals.invoice_id
@@ -83,28 +325,354 @@ def search_invoice(company_id, list_partner_name, start_date, end_date):
 
     where 
     invoices.company_id = '{company_id}' 
-    and LOWER(partners.name) IN {tuple([i.lower() for i in list_partner_name])}
+    and LOWER(partners.name) IN {partner_names}
     and invoice_date >='{start_date}'
     and invoice_date <='{end_date}'
-    and invoices.deleted_at is null
-    and invoices.status in (0,3)
+    {filter_state}
     order by invoice_date , due_date
     """
 
     print(query)
-    data_invoice = MySQL.to_pull_data(query) 
-    try:
-        data_invoice['top'] = data_invoice.apply(lambda s: (s['due_date'] - s['invoice_date']).days, axis=1)
-    except:
-        data_invoice['top'] = None
+    with mysql_client() as MySQL:
+        data_invoice = MySQL.to_pull_data(query)
+    diagnostics.count('mysql', queries=1)
+
+    if data_invoice.empty:
+        return pd.DataFrame(columns = INVOICE_COLUMNS + ['invoice_uuid', 'updated_at'])
+    return data_invoice
+
+# open invoices per company and partner kept in memory, INVOICE_STORE_ENABLED=0 queries MySQL every time
+INVOICE_STORE = InvoiceStore(
+    pull_invoices,
+    max_bytes=int(os.getenv('INVOICE_STORE_MAX_BYTES', 256 * 1024 * 1024)),
+    refresh_interval=float(os.getenv('INVOICE_STORE_REFRESH_SECONDS', 30)),
+) if os.getenv('INVOICE_STORE_ENABLED', '1') == '1' else None
+
+# nama partner per company, dikelompokkan per nama yang sudah dinormalisasi
+PARTNER_CACHE = TTLCache('partners_by_company',
+                         ttl=float(os.getenv('PARTNER_CACHE_TTL', 600)),
+                         maxsize=int(os.getenv('PARTNER_CACHE_SIZE', 10_000)))
+# buyer yang tidak ada di index menarik ulang daftar partner paling sering sekali per interval ini
+PARTNER_MISS_REFRESH = float(os.getenv('PARTNER_MISS_REFRESH_SECONDS', 60))
+
+def pull_partner_names(company_id):
+    query = f"""select distinct partners.name from partners
+    where partners.company_id = '{company_id}'
+    """
+    with mysql_client() as MySQL:
+        partners = MySQL.to_pull_data(query)
+    diagnostics.count('mysql', queries=1)
+    if partners.empty:
+        return []
+    return partners['name'].dropna().astype(str).tolist()
+
+def partner_index(company_id, refresh=False):
+    """(pulled_at, {normalized name: lower-cased partners.name}) of one company, from PARTNER_CACHE"""
+    cached = PARTNER_CACHE.get(company_id)
+    if cached is None or refresh:
+        cached = (time.monotonic(), group_by_normalized_name(pull_partner_names(company_id)))
+        PARTNER_CACHE.set(company_id, cached)
+    return cached
+
+def partner_name_variants(company_id, buyer_name):
+    """Partner names of this company an invoice of this buyer is filed under"""
+    #satu key per buyer: nama tanpa PT, CV, Tbk dan tanda baca
+    key = normalize_name(buyer_name)
+    pulled_at, index = partner_index(company_id)
+    if key not in index and time.monotonic() - pulled_at >= PARTNER_MISS_REFRESH:
+        # partner baru sejak daftar ini ditarik
+        pulled_at, index = partner_index(company_id, refresh=True)
+    return index.get(key, [])
+
+def plan_invoice_queries(company_id, data_payment, days_before=60, days_after=1):
+    """(partner names, start_date, end_date) of each invoice query needed for one company's payments.
+
+    Every buyer gets its own window, from `days_before` before its first
+    payment to `days_after` after its last one. Buyers whose windows overlap
+    share one query over the union of their windows. Buyers without a
+    partner of the same normalized name need no query.
+    """
+    created_at = pd.to_datetime(data_payment['created_at'], utc=True, format='ISO8601')
+
+    windows = []
+    for buyer_name, created in created_at.groupby(data_payment['buyer_name']):
+        start_date = (created.min() - timedelta(days=days_before)).date()
+        end_date = (created.max() + timedelta(days=days_after)).date()
+        names = partner_name_variants(company_id, buyer_name)
+        if names:
+            windows.append((start_date, end_date, names))
+
+    merged = []
+    for start_date, end_date, names in sorted(windows, key=lambda w: w[0]):
+        if merged and start_date <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end_date)
+            merged[-1][2].extend(n for n in names if n not in merged[-1][2])
+        else:
+            merged.append([start_date, end_date, list(names)])
 
-    return data_invoice  
+    return [(names, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')) for start_date, end_date, names in merged]
+
+def search_invoice_for_payments(company_id, data_payment):
+    """Candidate invoices for one company's payments, one query per planned (buyers, window)"""
+    frames = []
+    for list_partner_name, start_date, end_date in plan_invoice_queries(company_id, data_payment):
+        print('search invoice from', company_id, list_partner_name, start_date, end_date)
+        frames.append(search_invoice(company_id, list_partner_name, start_date, end_date))
+
+    if not frames:
+        return pd.DataFrame(columns = INVOICE_COLUMNS + ['top'])
+    if len(frames) == 1:
+        return frames[0]
+
+    data_invoice = pd.concat(frames, ignore_index=True)
+    data_invoice = data_invoice.drop_duplicates(subset=['company_id', 'name', 'invoice_number'])
+    return data_invoice.sort_values(['invoice_date', 'due_date'], kind='stable').reset_index(drop=True)
+
+def pull_reconciliations(list_invoice_number, list_external_id):
+    chunks = list(zip_longest(chunked(list_invoice_number, BQ_IN_CHUNK), chunked(list_external_id, BQ_IN_CHUNK), fillvalue=[]))
+    if len(chunks) <= 1:
+        return pull_reconciliation_chunk(list_invoice_number, list_external_id)
+
+    data_in_bq = pull_chunks(lambda chunk: pull_reconciliation_chunk(*chunk), chunks)
+    # a row can match an invoice number and an external id from different chunks
+    duplicated = pd.Series([reconciliation_row_key(row) for row in data_in_bq.to_dict(orient = 'records')]).duplicated()
+    return data_in_bq[~duplicated.values].reset_index(drop=True)
+
+def pull_reconciliation_chunk(list_invoice_number, list_external_id):
+    filter_invoice = ''
+    filter_external_id = ''
+    if list_invoice_number:
+        filter_invoice = f"AND invoice_number IN {sql_in(list_invoice_number)}"
+
+    if list_external_id:
+        filter_external_id = sql_in(list_external_id)
+        if filter_invoice:
+            filter_external_id = f"OR external_id IN {filter_external_id}"
+        else:
+            filter_external_id = f"AND external_id IN {filter_external_id}"
+
+    query = f"""
+    SELECT * FROM datascience_public.invoice_reconciliations
+    WHERE 1=1  
+    {filter_invoice}
+    {filter_external_id}
+    """
+    print(query)
+    with bq_client() as BQ:
+        data_in_bq = BQ.to_pull_data(query)
+    diagnostics.count('bigquery', queries=1)
+    return data_in_bq
+
+def search_reconciliations(list_invoice_number, list_external_id):
+    """invoice_reconciliations rows for these ids, from RECONCILIATION_CACHE where possible.
+
+    Only ids that are not cached go to BigQuery. Every queried id is cached,
+    including the ones without rows (not reconciled yet, kept for a shorter TTL).
+    """
+    keys = [('invoice_number', i) for i in dict.fromkeys(list_invoice_number)]
+    keys += [('external_id', i) for i in dict.fromkeys(list_external_id)]
+
+    rows = {}
+    missing = []
+    for key in keys:
+        cached = RECONCILIATION_CACHE.get(key)
+        if cached is None:
+            missing.append(key)
+        else:
+            rows.update((reconciliation_row_key(row), row) for row in cached)
+
+    if missing:
+        #request lain yang sedang mengecek semua id ini di BQ ditunggu saja
+        missing_invoice_number = [i for field, i in missing if field == 'invoice_number']
+        missing_external_id = [i for field, i in missing if field == 'external_id']
+        flight = (frozenset(missing_invoice_number), frozenset(missing_external_id))
+        data_in_bq = RECONCILIATION_FLIGHTS.do(
+            flight,
+            lambda: pull_reconciliations(missing_invoice_number, missing_external_id),
+            covers=lambda key: flight[0] <= key[0] and flight[1] <= key[1],
+        )
+        fetched = data_in_bq.to_dict(orient = 'records')
+
+        found = {key: [] for key in missing}
+        for row in fetched:
+            matched = [key for key in reconciliation_cache_keys(row) if key in found]
+            for key in matched:
+                found[key].append(row)
+            if matched:
+                rows.setdefault(reconciliation_row_key(row), row)
+
+        for key, key_rows in found.items():
+            RECONCILIATION_CACHE.set(key, key_rows, ttl=None if key_rows else RECON_CACHE_NEGATIVE_TTL)
+
+    if not rows:
+        return pd.DataFrame(columns = ['invoice_number', 'external_id'])
+    return pd.DataFrame(list(rows.values()))
+
+def reconciliation_cache_keys(row):
+    keys = []
+    for field in ('invoice_number', 'external_id'):
+        values = row.get(field)
+        for value in values if isinstance(values, list) else [values]:
+            keys.append((field, value))
+    return keys
+
+def reconciliation_row_key(row):
+    return json.dumps(row, sort_keys=True, default=str)
+
+def invalidate_reconciliations(rows):
+    """Forget cached lookups for ids that were just written to invoice_reconciliations"""
+    RECONCILIATION_CACHE.invalidate(key for row in rows for key in reconciliation_cache_keys(row))
+
+def push_reconciliations(rows):
+    merge_reconciliations(rows)
+    invalidate_reconciliations(rows)
+
+def merge_reconciliations(rows, staging=None):
+    """Add rows to invoice_reconciliations unless their (invoice_number, external_id) is already there.
+
+    The rows are loaded into a staging table and MERGEd in, so the check holds
+    across restarts and instances. The staging table is dropped afterwards.
+    """
+    if not rows:
+        return
+    staging = staging or f'invoice_reconciliations_staging_{uuid.uuid4().hex}'
+    columns = ', '.join(RECONCILIATION_COLUMNS)
+    with bq_client() as BQ:
+        BQ.to_push_data(pd.DataFrame(rows, columns = RECONCILIATION_COLUMNS), 'datascience_public', staging, 'replace')
+        try:
+            run_bq_statement(BQ, f"""
+            MERGE datascience_public.invoice_reconciliations T
+            USING (SELECT DISTINCT * FROM datascience_public.{staging}) S
+            ON T.invoice_number = S.invoice_number AND T.external_id = S.external_id
+            WHEN NOT MATCHED THEN INSERT ({columns}) VALUES ({columns})
+            """)
+        finally:
+            run_bq_statement(BQ, f"DROP TABLE IF EXISTS datascience_public.{staging}")
+
+# result rows are written to invoice_reconciliations in the background, in batches
+RECONCILIATION_WRITER = ReconciliationWriter(
+    push_reconciliations,
+    max_rows=int(os.getenv('RECON_WRITE_BATCH', 500)),
+    flush_interval=float(os.getenv('RECON_WRITE_INTERVAL', 5)),
+    max_buffer=int(os.getenv('RECON_WRITE_BUFFER', 50_000)),
+    max_attempts=int(os.getenv('RECON_WRITE_MAX_ATTEMPTS', 5)),
+    dead_letter=os.getenv('RECON_DEAD_LETTER_PATH', '/tmp/reconciliation_dead_letter.jsonl'),
+)
+RECON_WRITEBACK_ENABLED = os.getenv('RECON_WRITEBACK_ENABLED', '1') == '1'
+
+# kolom invoice_reconciliations, sama dengan baris hasil process_recon
+RECONCILIATION_COLUMNS = ['company_id', 'buyer_name', 'top', 'ontime', 'payment_date', 'invoice_date',
+                          'external_id', 'invoice_number', 'payment_amount', 'payment_amount_wht',
+                          'invoice_amount', 'status']
+
+def reconciliation_rows(rows):
+    """Result rows as invoice_reconciliations rows: single matches only, cut to RECONCILIATION_COLUMNS.
+
+    Multi matches carry lists of ids and dates, which the table (and the
+    lookups reading it back) cannot hold, so they are not written.
+    """
+    return [
+        {column: row.get(column) for column in RECONCILIATION_COLUMNS}
+        for row in rows
+        if row.get('type', 'single_match') == 'single_match'
+        and not isinstance(row.get('external_id'), list) and not isinstance(row.get('invoice_number'), list)
+    ]
+
+def write_back(rows):
+    """Queue result rows for invoice_reconciliations, unless RECON_WRITEBACK_ENABLED is off"""
+    if not RECON_WRITEBACK_ENABLED:
+        return
+    rows = reconciliation_rows(rows)
+    if rows:
+        RECONCILIATION_WRITER.add(rows)
+
+RECON_TOLERANCES = [2_000,5_000]
+RECON_ADD_IDR = 10_000
+
+def recon_status(grand_total, amount, with_wht):
+    """Status of one payment/invoice pair in process_recon, None if they do not match"""
+    for TOLERANCES in RECON_TOLERANCES:
+    
+        if grand_total == amount:
+            return (f"""exactly match""")
+        elif grand_total == with_wht:
+            return (f"""exactly match with wht""")
+        elif abs(grand_total - amount)<=TOLERANCES:
+            return (f"""match with difference: {abs(grand_total - amount)}""")
+        elif abs(grand_total - with_wht)<=TOLERANCES:
+            return (f"""include wht match with difference: {abs(grand_total - with_wht)} """)
+        
+        
+        #10K rules
+        add_idr = RECON_ADD_IDR
+        if grand_total == (amount + add_idr):
+            return (f"""match with add 10K""")
+        elif grand_total == (with_wht + add_idr):
+            return (f"""match with wht and add 10K""")
+        elif abs(grand_total - (amount + add_idr)) <= TOLERANCES:
+            return (f"""match with add 10K, with difference: {abs(grand_total - amount)}""")
+        elif abs(grand_total - (with_wht + add_idr))<=TOLERANCES:
+            return (f"""include wht and add 10K, with difference: {abs(grand_total - with_wht)} """)
+    return None
+
+class InvoiceCandidates:
+    """Invoice rows of process_recon, indexed by grand total.
+
+    `find` returns, in frame order, the positions of the unconsumed invoices of
+    the payment's company and buyer dated on or before the payment whose total
+    is near enough to one of the amounts recon_status compares with. The
+    windows get 1 rupiah of slack, recon_status makes the final call.
+    """
+
+    def __init__(self, data_invoice):
+        self.rows = data_invoice.values
+        self.columns = {column: position for position, column in enumerate(data_invoice.columns)}
+        self.size = len(data_invoice)
+        if not self.size:
+            return
+
+        self.totals = pd.to_numeric(data_invoice['grandTotalUnformatted'], errors='coerce').to_numpy(dtype=float)
+        self.by_total = np.argsort(self.totals, kind='stable')
+        self.sorted_totals = self.totals[self.by_total]
+        self.dates = pd.to_datetime(data_invoice['invoice_date']).to_numpy().astype('datetime64[D]')
+        self.company_ids = data_invoice['company_id'].to_numpy(dtype=object)
+        self.names = NameIndex(data_invoice['name'])
+        self.consumed = np.zeros(self.size, dtype=bool)
+        self.by_number = {}
+        for position, invoice_number in enumerate(data_invoice['invoice_number']):
+            self.by_number.setdefault(invoice_number, []).append(position)
+
+    def find(self, company_id, buyer_name, payment_date, amount, with_wht):
+        if not self.size or not (np.isfinite(amount) and np.isfinite(with_wht)):
+            return []
+        slack = max(RECON_TOLERANCES) + 1
+        positions = []
+        for target in (amount, with_wht, amount + RECON_ADD_IDR, with_wht + RECON_ADD_IDR):
+            low = np.searchsorted(self.sorted_totals, target - slack, side='left')
+            high = np.searchsorted(self.sorted_totals, target + slack, side='right')
+            positions.append(self.by_total[low:high])
+        positions = np.unique(np.concatenate(positions))
+
+        keep = (~self.consumed[positions]) \
+               & (self.dates[positions] <= np.datetime64(payment_date, 'D')) \
+               & (self.company_ids[positions] == company_id) \
+               & np.isin(self.names.row_keys[positions], self.names.key_codes(buyer_name))
+        return positions[keep].tolist()
+
+    def value(self, position, column):
+        return self.rows[position][self.columns[column]]
+
+    def consume(self, invoice_number):
+        self.consumed[self.by_number.get(invoice_number, [])] = True
 
 def process_recon(prt,data_invoice):
     #FULLMOON
     FOUND = []
-    remarks = []
-    for _,i in prt.iterrows():
+    #invoice dicari lewat index nominal, invoice yang sudah match tidak dipakai lagi
+    candidates = InvoiceCandidates(data_invoice)
+    payment_columns = list(prt.columns)
+    for values in prt.values:
+        i = dict(zip(payment_columns, values))
         external_id = i['external_id']
         company_id = i['company_id']
         amount = i['amount.grand_total']
@@ -112,51 +680,16 @@ def process_recon(prt,data_invoice):
         buyer_name = i['buyer_name']
         payment_date = datetime.strptime(i['created_at'].split('T')[0], '%Y-%m-%d').date()
 
-        invoices = data_invoice[(data_invoice['invoice_date'] <= payment_date )\
-                                & (~data_invoice['invoice_number'].isin(remarks))\
-                               & (data_invoice['name'].transform(lambda s: buyer_name.upper() in s.upper() or s.upper() in buyer_name.upper()))
-                               & (data_invoice['company_id']==company_id)]
         status = ''
-        for _, j in invoices.iterrows():
-            invoice_number = j['invoice_number']
-            invoice_date = j['invoice_date']
-            grand_total = j['grandTotalUnformatted']
-            top = j['top']
-            ontime = 1 if (payment_date - invoice_date).days <= top else 0
-            
-            status = None
-            for TOLERANCES in [2_000,5_000]:
-            
-                if grand_total == amount:
-                    status = (f"""exactly match""")
-                    break
-                elif grand_total == with_wht:
-                    status = (f"""exactly match with wht""")
-                    break
-                elif abs(grand_total - amount)<=TOLERANCES:
-                    status = (f"""match with difference: {abs(grand_total - amount)}""")
-                    break
-                elif abs(grand_total - with_wht)<=TOLERANCES:
-                    status = (f"""include wht match with difference: {abs(grand_total - with_wht)} """)
-                    break
-                
-                
-                #10K rules
-                add_idr = 10_000
-                if grand_total == (amount + add_idr):
-                    status = (f"""match with add 10K""")
-                    break
-                elif grand_total == (with_wht + add_idr):
-                    status = (f"""match with wht and add 10K""")
-                    break
-                elif abs(grand_total - (amount + add_idr)) <= TOLERANCES:
-                    status = (f"""match with add 10K, with difference: {abs(grand_total - amount)}""")
-                    break
-                elif abs(grand_total - (with_wht + add_idr))<=TOLERANCES:
-                    status = (f"""include wht and add 10K, with difference: {abs(grand_total - with_wht)} """)
-                    break    
+        for position in candidates.find(company_id, buyer_name, payment_date, amount, with_wht):
+            grand_total = candidates.value(position, 'grandTotalUnformatted')
+            status = recon_status(grand_total, amount, with_wht)
             if status:
-                break                
+                invoice_number = candidates.value(position, 'invoice_number')
+                invoice_date = candidates.value(position, 'invoice_date')
+                top = candidates.value(position, 'top')
+                ontime = 1 if (payment_date - invoice_date).days <= top else 0
+                break
                 
                 
         if status:
@@ -174,7 +707,7 @@ def process_recon(prt,data_invoice):
                           'status':status
                          })
 
-            remarks.append(invoice_number)
+            candidates.consume(invoice_number)
             
         else:
             FOUND.append({'company_id':company_id,
@@ -199,31 +732,8 @@ def search_data(list_invoice_number:list = [] ,list_external_id:list = []):
     list_invoice_number = list_invoice_number if list_invoice_number else []
     list_external_id = list_external_id if list_external_id else []
 
-    BQ = call_bq()
-
     #check if the invoice number has been reconciliated 
-    # def search_by_invoice_number
-    filter_invoice = ''
-    filter_external_id = ''
-    if list_invoice_number:
-        filter_invoice = tuple(list_invoice_number) if len(list_invoice_number)>1 else f"('{list_invoice_number[0]}')"
-        filter_invoice = f"AND invoice_number IN {filter_invoice}"
-
-    if list_external_id:
-        filter_external_id = tuple(list_external_id) if len(list_external_id)>1 else f"('{list_external_id[0]}')"
-        if filter_invoice:
-            filter_external_id = f"OR external_id IN {filter_external_id}"
-        else:
-            filter_external_id = f"AND external_id IN {filter_external_id}"
-
-    query = f"""
-    SELECT * FROM datascience_public.invoice_reconciliations
-    WHERE 1=1  
-    {filter_invoice}
-    {filter_external_id}
-    """
-    print(query)
-    data_in_bq = BQ.to_pull_data(query)
+    data_in_bq = search_reconciliations(list_invoice_number, list_external_id)
     external_id_not_found = list(set(list_external_id)-set(data_in_bq['external_id']))
     invoice_number_not_found = list(set(list_invoice_number)-set(data_in_bq['invoice_number']))
 
@@ -232,10 +742,6 @@ def search_data(list_invoice_number:list = [] ,list_external_id:list = []):
     if not invoice_number_not_found and not external_id_not_found:
         return data_in_bq.to_dict(orient = 'records')
 
-    global MySQL
-    MySQL = call_mysql()
-    global ArangoDB
-    ArangoDB = call_arangodb()
     
     all_result = data_in_bq.to_dict(orient = 'records')
     # misalnya ada invoice_number yang tidak ketemu    
@@ -263,8 +769,8 @@ def search_data(list_invoice_number:list = [] ,list_external_id:list = []):
 
             if result:
 
-                #save to BQ
-                BQ.to_push_data(pd.DataFrame(result), 'datascience_public','invoice_reconciliations','append')
+                #save to BQ, lewat write-back buffer
+                write_back(result)
 
                 all_result.extend(result)
 
@@ -292,34 +798,14 @@ def search_data(list_invoice_number:list = [] ,list_external_id:list = []):
             #data per company_id
             data_payment = pay[pay['company_id']==company_id]
 
-            #get min created_at
-            # Convert 'created_at' to datetime and find the minimum
-            min_date = pd.to_datetime(pay['created_at']).min()
-            max_date = pd.to_datetime(pay['created_at']).max()
-
-            # Subtract 40 days
-            start_date = (min_date - timedelta(days=60)).strftime('%Y-%m-%d')
-            end_date = (max_date + timedelta(days=1)).strftime('%Y-%m-%d')
-
-            list_partner_name = list(pay['buyer_name'].unique())
-            for i in pay['buyer_name'].unique():
-
-                if i.startswith('PT'):
-                    #remove PT
-                    list_partner_name.append(i.replace('PT ','').strip())
-                else:
-                    #ADD PT
-                    list_partner_name.append(f"PT {i}".strip())    
-                
-            #cari posibillity invoice nya per company_id
-            print('search invoice from', company_id,list_partner_name)
-            data_invoice = search_invoice(company_id, list_partner_name, start_date, end_date)
+            #cari posibillity invoice nya per company_id dan buyer
+            data_invoice = search_invoice_for_payments(company_id, data_payment)
             #analysis
             print('payment:', data_payment.shape[0], 'invoice:',data_invoice.shape[0])
             result = process_recon(data_payment,data_invoice)   
             if [i for i in result if i['status']!='not found']:
-                #save to BQ
-                BQ.to_push_data(pd.DataFrame(result), 'datascience_public','invoice_reconciliations','append')
+                #save to BQ, lewat write-back buffer
+                write_back(result)
 
             all_result.extend(result)        
 
@@ -329,31 +815,10 @@ def search_datav2(list_invoice_number:list = [] ,list_external_id:list = []):
     list_invoice_number = list_invoice_number if list_invoice_number else []
     list_external_id = list_external_id if list_external_id else []
 
-    BQ = call_bq()
-
     #check if the invoice number has been reconciliated 
-    # def search_by_invoice_number
-    filter_invoice = ''
-    filter_external_id = ''
-    if list_invoice_number:
-        filter_invoice = tuple(list_invoice_number) if len(list_invoice_number)>1 else f"('{list_invoice_number[0]}')"
-        filter_invoice = f"AND invoice_number IN {filter_invoice}"
-
-    if list_external_id:
-        filter_external_id = tuple(list_external_id) if len(list_external_id)>1 else f"('{list_external_id[0]}')"
-        if filter_invoice:
-            filter_external_id = f"OR external_id IN {filter_external_id}"
-        else:
-            filter_external_id = f"AND external_id IN {filter_external_id}"
-
-    query = f"""
-    SELECT * FROM datascience_public.invoice_reconciliations
-    WHERE 1=1  
-    {filter_invoice}
-    {filter_external_id}
-    """
-    print(query)
-    data_in_bq = BQ.to_pull_data(query)
+    with diagnostics.phase('bigquery') as stats:
+        data_in_bq = search_reconciliations(list_invoice_number, list_external_id)
+        stats['rows'] = len(data_in_bq)
     external_id_not_found = list(set(list_external_id)-set(data_in_bq['external_id']))
     invoice_number_not_found = list(set(list_invoice_number)-set(data_in_bq['invoice_number']))
 
@@ -366,87 +831,153 @@ def search_datav2(list_invoice_number:list = [] ,list_external_id:list = []):
     if not invoice_number_not_found and not external_id_not_found:
         return all_result
 
-    global MySQL
-    MySQL = call_mysql()
-    global ArangoDB
-    ArangoDB = call_arangodb()
     
 
-    # misalnya ada invoice_number yang tidak ketemu    
-    if invoice_number_not_found:
+    # both branches run at the same time, each fanning out per company
+    with ThreadPoolExecutor(max_workers=2) as branches:
+        # misalnya ada invoice_number yang tidak ketemu
+        invoice_branch = branches.submit(diagnostics.bind(reconcile_invoice_numbers), invoice_number_not_found) if invoice_number_not_found else None
+        external_branch = branches.submit(diagnostics.bind(reconcile_external_ids), external_id_not_found) if external_id_not_found else None
 
-        #cari invoice nya
-        all_invoice = search_by_invoice(invoice_number_not_found)
+        if invoice_branch:
+            all_result.extend(invoice_branch.result())
+        if external_branch:
+            all_result.extend(external_branch.result())
 
-        for company_id in all_invoice['company_id'].unique():
+    return all_result
 
-            #data per company_id
-            data_invoice = all_invoice[all_invoice['company_id']==company_id]
+def iter_search_datav2(list_invoice_number:list = [] ,list_external_id:list = []):
+    """search_datav2 as a stream of result batches.
 
-            #get min created_at
-            start_date = str(data_invoice['invoice_date'].min())
+    The BigQuery hits come first, then the matches of each company as soon as
+    its matcher run finishes, in completion order.
+    """
+    for event, _, rows in iter_search_companies(list_invoice_number, list_external_id):
+        if event != 'companies' and rows:
+            yield rows
 
-            #cari posibillity payment nya per company_id
-            payment = search_payment(start_date, company_id)
+def iter_search_companies(list_invoice_number:list = [] ,list_external_id:list = [], executor=None):
+    """search_datav2 step by step, as (event, company, rows) tuples.
 
-            #analysis
-            print('payment:', payment.shape[0], 'invoice:',data_invoice.shape[0])
-   
-            result = match_payments_and_invoices(payment.astype(str).to_dict(orient = 'records'),
-                                   data_invoice.astype(str).to_dict(orient = 'records')) 
-            
-            all_result.extend(result['matches'])   
+    ('cached', None, rows) carries the BigQuery hits, ('companies', None,
+    companies) lists every (branch, company_id) unit that will run, and
+    ('company', (branch, company_id), matches) follows for each unit as it
+    finishes. Units run on `executor`, COMPANY_EXECUTOR by default.
+    """
+    executor = executor or COMPANY_EXECUTOR
+    list_invoice_number = list_invoice_number if list_invoice_number else []
+    list_external_id = list_external_id if list_external_id else []
 
-#             if result:
+    #check if the invoice number has been reconciliated 
+    with diagnostics.phase('bigquery') as stats:
+        data_in_bq = search_reconciliations(list_invoice_number, list_external_id)
+        stats['rows'] = len(data_in_bq)
+    external_id_not_found = list(set(list_external_id)-set(data_in_bq['external_id']))
+    invoice_number_not_found = list(set(list_invoice_number)-set(data_in_bq['invoice_number']))
 
-#                 #save to BQ
-#                 BQ.to_push_data(pd.DataFrame(result), 'datascience_public','invoice_reconciliations','append')
+    bq_result = data_in_bq.to_dict(orient = 'records')
+    [i.update({'type':'single_match'}) for i in bq_result]
+    yield 'cached', None, bq_result
+    del data_in_bq, bq_result
+
+    # both lookups run at the same time, then every company unit is reported as it finishes
+    with ThreadPoolExecutor(max_workers=2) as branches:
+        lookups = []
+        if invoice_number_not_found:
+            lookups.append(('invoice', branches.submit(diagnostics.bind(submit_invoice_companies), invoice_number_not_found, executor)))
+        if external_id_not_found:
+            lookups.append(('external_id', branches.submit(diagnostics.bind(submit_payment_companies), external_id_not_found, executor)))
+        companies = {future: (branch, company_id) for branch, lookup in lookups for company_id, future in lookup.result()}
+
+    yield 'companies', None, list(companies.values())
+    try:
+        for future in as_completed(companies):
+            yield 'company', companies[future], future.result()
+    finally:
+        #kalau berhenti di tengah (error atau dibatalkan), unit yang belum jalan tidak perlu dijalankan
+        for future in companies:
+            future.cancel()
+
+# background jobs match on their own, smaller process pool so /search keeps its workers
+JOB_MATCHER_WORKERS = int(os.getenv('JOB_MATCHER_WORKERS', 2))
+
+def matcher_pool():
+    """Process pool arguments of match_payments_and_invoices for the current work"""
+    if in_background_work():
+        return {'workers': JOB_MATCHER_WORKERS, 'pool_name': 'jobs'}
+    return {}
+
+def reconcile_invoice_numbers(invoice_number_not_found):
+    companies = submit_invoice_companies(invoice_number_not_found)
+    return [match for _, future in companies for match in future.result()]
+
+def submit_invoice_companies(invoice_number_not_found, executor=None):
+    #cari invoice nya
+    with diagnostics.phase('mysql') as stats:
+        all_invoice = search_by_invoice(invoice_number_not_found)
+        stats['rows'] = len(all_invoice)
 
-#                 all_result.extend(result)
+    #satu unit per company_id, jalan bersamaan
+    return [
+        (company_id, (executor or COMPANY_EXECUTOR).submit(diagnostics.bind(reconcile_invoice_company, company_id),
+                                                           company_id, all_invoice[all_invoice['company_id']==company_id]))
+        for company_id in all_invoice['company_id'].unique()
+    ]
 
+def reconcile_invoice_company(company_id, data_invoice):
+    #get min created_at
+    start_date = str(data_invoice['invoice_date'].min())
 
-    if external_id_not_found:
-        print('search external_id')
-        pay = search_by_external_id(external_id_not_found)
-        
-        for company_id in pay['company_id'].unique():
-            #data per company_id
-            data_payment = pay[pay['company_id']==company_id]
+    #cari posibillity payment nya per company_id, hanya amount yang bisa match (batasnya lihat payment_amount_windows)
+    amount_windows = PaymentInvoiceMatcher().payment_amount_windows(data_invoice['grandTotalUnformatted'].astype(float).tolist())
+    with diagnostics.phase('arango') as stats:
+        payment = search_payment(start_date, company_id, amount_windows)
+        stats['rows'] = len(payment)
 
-            #get min created_at
-            # Convert 'created_at' to datetime and find the minimum
-            min_date = pd.to_datetime(pay['created_at']).min()
-            max_date = pd.to_datetime(pay['created_at']).max()
-
-            # Subtract 40 days
-            start_date = (min_date - timedelta(days=60)).strftime('%Y-%m-%d')
-            end_date = (max_date + timedelta(days=1)).strftime('%Y-%m-%d')
-
-            list_partner_name = list(pay['buyer_name'].unique())
-            for i in pay['buyer_name'].unique():
-
-                if i.startswith('PT'):
-                    #remove PT
-                    list_partner_name.append(i.replace('PT ','').strip())
-                else:
-                    #ADD PT
-                    list_partner_name.append(f"PT {i}".strip())    
-                
-            #cari posibillity invoice nya per company_id
-            print('search invoice from', company_id,list_partner_name)
-            data_invoice = search_invoice(company_id, list_partner_name, start_date, end_date)
-            #analysis
-            print('payment:', data_payment.shape[0], 'invoice:',data_invoice.shape[0])
+    #analysis
+    print('payment:', payment.shape[0], 'invoice:',data_invoice.shape[0])
 
-            result = match_payments_and_invoices(data_payment.astype(str).to_dict(orient = 'records'),
-                                   data_invoice.astype(str).to_dict(orient = 'records')) 
-            
-            
-#             if [i for i in result if i['status']!='not found']:
-#                 #save to BQ
-#                 BQ.to_push_data(pd.DataFrame(result), 'datascience_public','invoice_reconciliations','append')
+    result = match_payments_and_invoices(payment, data_invoice, engine=MATCHER_ENGINE, partition_by_buyer=True, **matcher_pool())
+    diagnostics.record(result['phases'])
+    if 'assignment' in result:
+        print('assignment:', company_id, result['assignment'])
 
-            all_result.extend(result['matches'])        
+    #save to BQ, lewat write-back buffer
+    write_back(result['matches'])
 
-    return all_result
+    return result['matches']
 
+def reconcile_external_ids(external_id_not_found):
+    companies = submit_payment_companies(external_id_not_found)
+    return [match for _, future in companies for match in future.result()]
+
+def submit_payment_companies(external_id_not_found, executor=None):
+    print('search external_id')
+    with diagnostics.phase('arango') as stats:
+        pay = search_by_external_id(external_id_not_found)
+        stats['rows'] = len(pay)
+
+    #satu unit per company_id, jalan bersamaan
+    return [
+        (company_id, (executor or COMPANY_EXECUTOR).submit(diagnostics.bind(reconcile_payment_company, company_id),
+                                                           company_id, pay[pay['company_id']==company_id]))
+        for company_id in pay['company_id'].unique()
+    ]
+
+def reconcile_payment_company(company_id, data_payment):
+    #cari posibillity invoice nya per company_id dan buyer
+    with diagnostics.phase('mysql') as stats:
+        data_invoice = search_invoice_for_payments(company_id, data_payment)
+        stats['rows'] = len(data_invoice)
+    #analysis
+    print('payment:', data_payment.shape[0], 'invoice:',data_invoice.shape[0])
+
+    result = match_payments_and_invoices(data_payment, data_invoice, engine=MATCHER_ENGINE, partition_by_buyer=True, **matcher_pool())
+    diagnostics.record(result['phases'])
+    if 'assignment' in result:
+        print('assignment:', company_id, result['assignment'])
+
+    #save to BQ, lewat write-back buffer
+    write_back(result['matches'])
+
+    return result['matches']
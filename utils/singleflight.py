@@ -0,0 +1,59 @@
+import threading
+from concurrent.futures import Future
+
+from .cache import CACHES
+
+class SingleFlight:
+    """Collapses concurrent identical fetches into one.
+
+    `do(key, fn)` runs `fn()` unless a call with the same key is already
+    running, in which case it waits for that call and returns its result (or
+    raises its exception). With `covers`, a call under another key is joined
+    too when `covers(other_key)` says its result contains everything this call
+    needs; the caller then cuts its own rows out of the shared result. Results
+    are shared between threads, so callers must not modify them in place.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.flights = {}  # key -> Future of the running call
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+        CACHES[name] = self
+
+    def do(self, key, fn, covers=None):
+        with self.lock:
+            future = self.flights.get(key)
+            if future is None and covers is not None:
+                future = next((f for k, f in self.flights.items() if covers(k)), None)
+            if future is not None:
+                self.shared += 1
+                leader = False
+            else:
+                future = self.flights[key] = Future()
+                self.calls += 1
+                leader = True
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': len(self.flights),
+                'calls': self.calls,
+                'shared': self.shared,
+            }
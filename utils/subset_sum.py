@@ -0,0 +1,150 @@
+from typing import Callable, Collection, Iterator, List, Tuple
+import bisect
+import heapq
+
+import numpy as np
+
+class SubsetSumIndex:
+    """Finds combinations of items whose amounts sum into a given window.
+
+    Replaces `itertools.combinations` scans in the multi-payment and
+    multi-invoice phases. Single amounts are kept sorted for bisect lookups and
+    every pair sum is built once (amount-sorted) and reused for every outer
+    item. A combination of size n is searched as its smallest position plus a
+    (n-1)-combination of later positions, bottoming out in one bisect over the
+    singles (n=1) or the pair sums (n=2), so a size-3 lookup costs O(N log N)
+    instead of O(N^3).
+
+    That bound only holds up to size 3 and while pair sums exist. Each size
+    above 3 adds a factor N (size n costs O(N^(n-2) log N)). With more than
+    `pair_limit` pairs (about 2000 items at the default) no pair sums are
+    built, and size 2 falls back to one bisect per outer item, so size 3
+    costs O(N^2 log N). Those are the costs of a full search; combinations are
+    yielded lazily in position order, so a caller that stops at the first good
+    enough one usually pays far less, and matched items are `remove`d so later
+    lookups skip them.
+
+    Lookups return a superset of the real matches (windows are inclusive and
+    float sums are not re-checked); the caller still evaluates each combination
+    with the matcher rules.
+    """
+
+    def __init__(self, amounts: List[float], max_size: int = 3, pair_limit: int = 2_000_000,
+                 exclude: Collection[int] = ()):
+        self.amounts = amounts
+        # amounts that are not numbers can never satisfy a rule
+        positions = sorted(
+            (position for position, amount in enumerate(amounts) if amount == amount and position not in exclude),
+            key=lambda position: amounts[position]
+        )
+        self.sorted_positions = positions
+        self.active = np.zeros(len(amounts), dtype=bool)
+        self.active[positions] = True
+        self.sorted_amounts = [amounts[position] for position in positions]
+        self.min_amount = self.sorted_amounts[0] if positions else 0.0
+        self.max_amount = self.sorted_amounts[-1] if positions else 0.0
+
+        self.pair_sums = None
+        n_pairs = len(positions) * (len(positions) - 1) // 2
+        if max_size >= 3 and 0 < n_pairs <= pair_limit:
+            self._build_pairs(positions)
+
+    def _build_pairs(self, positions: List[int]):
+        """Sort every pair sum once; pairs are stored as (smaller, larger) position"""
+        ordered = np.array(sorted(positions), dtype=np.int64)
+        left, right = np.triu_indices(len(ordered), k=1)
+        left, right = ordered[left], ordered[right]
+        values = np.array(self.amounts, dtype=np.float64)
+        sums = values[left] + values[right]
+
+        order = np.argsort(sums, kind='stable')
+        self.pair_sums = sums[order]
+        self.pair_left = left[order]
+        self.pair_right = right[order]
+
+    def remove(self, position: int):
+        """Drop an item for good once it has been matched"""
+        if not self.active[position]:
+            return
+        self.active[position] = False
+        i = bisect.bisect_left(self.sorted_amounts, self.amounts[position])
+        while self.sorted_positions[i] != position:
+            i += 1
+        del self.sorted_positions[i]
+        del self.sorted_amounts[i]
+
+    def combinations(self, size: int, windows: List[Tuple[float, float]],
+                     is_valid: Callable[[int], bool]) -> Iterator[Tuple[int, ...]]:
+        """Position tuples of `size` valid items whose sum lies in any window.
+
+        Tuples are in increasing position order and are yielded lazily in the
+        order `itertools.combinations` would have produced them, so a caller
+        that has found a combination nothing later can beat stops the search
+        there instead of paying for every combination in the window. Of the
+        tuples whose amounts are the same, in the same order, only the first is
+        yielded: the others sum to the same float and could only tie it.
+        """
+        searches = [self._search(size, low, high, -1, is_valid)
+                    for low, high in windows if low == low and high == high]
+        previous = None
+        # windows can overlap, the same tuple then comes from several searches
+        for combo in heapq.merge(*searches):
+            if combo != previous:
+                yield combo
+                previous = combo
+
+    def _search(self, size: int, low: float, high: float, after: int,
+                is_valid: Callable[[int], bool]) -> Iterator[Tuple[int, ...]]:
+        """Valid combinations of positions after `after` summing into [low, high], in tuple order.
+
+        A position whose amount an earlier position at the same level already
+        had only finds rests the earlier one found too, so it is skipped.
+        """
+        if size == 1:
+            seen = set()
+            for position in sorted(self._singles(low, high)):
+                if position > after and self.amounts[position] not in seen and is_valid(position):
+                    seen.add(self.amounts[position])
+                    yield (position,)
+            return
+
+        if size == 2 and self.pair_sums is not None:
+            start = int(self.pair_sums.searchsorted(low, side='left'))
+            end = int(self.pair_sums.searchsorted(high, side='right'))
+            if start == end:
+                return
+            left, right = self.pair_left[start:end], self.pair_right[start:end]
+            keep = (left > after) & self.active[left] & self.active[right]
+            count = int(np.count_nonzero(keep))
+            if count == 0:
+                return
+            # few pairs: sort them; many: walk the first item instead, the
+            # caller usually stops long before every pair has been seen
+            if count <= len(self.sorted_positions):
+                seen_left, current, use_left = set(), None, False
+                for left, right in sorted(zip(left[keep].tolist(), right[keep].tolist())):
+                    if left != current:
+                        current, seen_right = left, set()
+                        use_left = self.amounts[left] not in seen_left and is_valid(left)
+                        if use_left:
+                            seen_left.add(self.amounts[left])
+                    if use_left and self.amounts[right] not in seen_right and is_valid(right):
+                        seen_right.add(self.amounts[right])
+                        yield (left, right)
+                return
+
+        # the other size-1 items add between rest*min_amount and rest*max_amount
+        rest = size - 1
+        seen = set()
+        for position in sorted(self._singles(low - rest * self.max_amount, high - rest * self.min_amount)):
+            amount = self.amounts[position]
+            if position <= after or amount in seen or not is_valid(position):
+                continue
+            seen.add(amount)
+            for combo in self._search(rest, low - amount, high - amount, position, is_valid):
+                yield (position,) + combo
+
+    def _singles(self, low: float, high: float) -> List[int]:
+        start = bisect.bisect_left(self.sorted_amounts, low)
+        end = bisect.bisect_right(self.sorted_amounts, high)
+        return self.sorted_positions[start:end]
@@ -0,0 +1,208 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from .cache import CACHES, TTLCache
+
+def reconciliation_key(row):
+    """(invoice_number, external_id) of a result row; multi matches carry lists"""
+    return (json.dumps(row.get('invoice_number'), default=str), json.dumps(row.get('external_id'), default=str))
+
+class ReconciliationWriter:
+    """Write-behind buffer for invoice_reconciliations.
+
+    `add` only queues rows; a background thread hands them to `push` in one
+    batch once `max_rows` are waiting or `flush_interval` seconds after the
+    oldest one came in. Rows are deduplicated on (invoice_number, external_id)
+    against the buffer and against the keys pushed in the last `dedupe_ttl`
+    seconds, so repeated searches and retries do not write the same pair
+    twice. That cache only covers this process; `push` itself has to skip
+    pairs already in the table to hold across restarts and instances.
+
+    A failed batch is split in halves and retried half by half, so a bad row
+    ends up alone and the rows around it still get written. A row that failed
+    on its own `max_attempts` times is appended to the `dead_letter` JSONL
+    file instead of being retried again. When both halves fail the backend is
+    taken to be down: the rows go back to the buffer without counting an
+    attempt, and flushes back off from `flush_interval` up to `max_backoff`
+    seconds until a push goes through. Beyond `max_buffer` rows the oldest
+    are dropped.
+    """
+
+    def __init__(self, push, max_rows=500, flush_interval=5.0, max_buffer=50_000, dedupe_ttl=86400, dedupe_size=200_000,
+                 max_attempts=5, dead_letter=None, max_backoff=300.0):
+        self.push = push
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.max_attempts = max_attempts
+        self.dead_letter = dead_letter
+        self.max_backoff = max_backoff
+        self.backoff = 0.0  # seconds added to the flush wait while the backend is down
+        self.written = TTLCache('reconciliations_written', ttl=dedupe_ttl, maxsize=dedupe_size)
+        self.attempts = {}  # key -> failed pushes so far
+
+        self.buffer = OrderedDict()  # key -> row, oldest first
+        self.oldest = None  # monotonic time the oldest buffered row came in
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.closed = False
+        self.added = 0
+        self.duplicates = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.failures = 0
+        self.dropped = 0
+        self.dead_lettered = 0
+        self.outages = 0
+        CACHES['writeback'] = self
+
+    def add(self, rows):
+        with self.lock:
+            for row in rows:
+                key = reconciliation_key(row)
+                if key in self.buffer or self.written.get(key) is not None:
+                    self.duplicates += 1
+                    continue
+                self.buffer[key] = row
+                self.added += 1
+            if self.buffer and self.oldest is None:
+                self.oldest = time.monotonic()
+            while len(self.buffer) > self.max_buffer:
+                key, _ = self.buffer.popitem(last=False)
+                self.attempts.pop(key, None)
+                self.dropped += 1
+            full = len(self.buffer) >= self.max_rows
+            if self.thread is None and not self.closed:
+                self.thread = threading.Thread(target=self._run, name='reconciliation-writer', daemon=True)
+                self.thread.start()
+        if full:
+            self.wakeup.set()
+
+    def _run(self):
+        while not self.closed:
+            with self.lock:
+                delay = self.flush_interval + self.backoff
+                wait = None if self.oldest is None else max(0.0, self.oldest + delay - time.monotonic())
+            self.wakeup.wait(wait if wait is not None else self.flush_interval)
+            self.wakeup.clear()
+            with self.lock:
+                due = self.buffer and time.monotonic() - self.oldest >= self.backoff \
+                      and (len(self.buffer) >= self.max_rows or time.monotonic() - self.oldest >= delay)
+            if due:
+                self.flush()
+
+    def flush(self):
+        """Push everything buffered now; returns the number of rows written"""
+        with self.lock:
+            if not self.buffer:
+                return 0
+            batch = list(self.buffer.items())
+            self.buffer.clear()
+            self.oldest = None
+        if self._push(batch):
+            return len(batch)
+
+        # isolate the failing rows: retry half by half while one half still goes through
+        written = 0
+        failed = []  # rows that failed on their own while others went through
+        unsent = []  # rows of parts that failed whole, most likely the backend and not the rows
+        pending = [batch] if len(batch) > 1 else []
+        if not pending:
+            unsent.extend(batch)
+        while pending:
+            part = pending.pop()
+            if len(part) == 1:
+                failed.extend(part)
+                continue
+            halves = [part[:len(part) // 2], part[len(part) // 2:]]
+            pushed = [self._push(half) for half in halves]
+            written += sum(len(half) for half, ok in zip(halves, pushed) if ok)
+            if not any(pushed):
+                unsent.extend(part)
+            else:
+                pending.extend(half for half, ok in zip(halves, pushed) if not ok)
+        self._retry_later(failed, unsent)
+        return written
+
+    def _push(self, batch):
+        try:
+            self.push([row for _, row in batch])
+        except Exception as e:
+            print('reconciliation write-back failed for', len(batch), 'rows:', e)
+            with self.lock:
+                self.failures += 1
+            return False
+        for key, _ in batch:
+            self.written.set(key, True)
+        with self.lock:
+            self.flushes += 1
+            self.rows_written += len(batch)
+            self.backoff = 0.0
+            for key, _ in batch:
+                self.attempts.pop(key, None)
+        return True
+
+    def _retry_later(self, failed, unsent=()):
+        """Put failed rows back in front of the buffer, or dead-letter them after max_attempts.
+
+        Only `failed` rows, which failed on their own, count an attempt.
+        `unsent` rows go back as they are and the next flushes back off.
+        """
+        retry, dead = list(unsent), []
+        with self.lock:
+            for key, row in failed:
+                self.attempts[key] = self.attempts.get(key, 0) + 1
+                if self.attempts[key] >= self.max_attempts:
+                    del self.attempts[key]
+                    dead.append(row)
+                else:
+                    retry.append((key, row))
+            if unsent:
+                self.outages += 1
+                self.backoff = min(self.max_backoff, max(self.flush_interval, self.backoff * 2))
+            if retry:
+                pending = OrderedDict(retry)
+                pending.update((k, r) for k, r in self.buffer.items() if k not in pending)
+                self.buffer = pending
+                self.oldest = time.monotonic()
+            self.dead_lettered += len(dead)
+        if dead:
+            self._dead_letter(dead)
+
+    def _dead_letter(self, rows):
+        print('reconciliation write-back gave up on', len(rows), 'rows')
+        if self.dead_letter is None:
+            return
+        try:
+            with open(self.dead_letter, 'a') as f:
+                for row in rows:
+                    f.write(json.dumps(row, default=str) + '\n')
+        except OSError as e:
+            print('reconciliation dead letter write failed:', e)
+
+    def close(self):
+        """Stop the background thread and push what is left"""
+        self.closed = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.flush_interval + 1)
+        self.flush()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'buffered': len(self.buffer),
+                'added': self.added,
+                'duplicates': self.duplicates,
+                'flushes': self.flushes,
+                'rows_written': self.rows_written,
+                'failures': self.failures,
+                'dropped': self.dropped,
+                'dead_lettered': self.dead_lettered,
+                'retrying': len(self.attempts),
+                'outages': self.outages,
+                'backoff_seconds': self.backoff,
+            }